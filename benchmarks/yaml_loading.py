@@ -0,0 +1,72 @@
+""" Compares loading of exported YAML files with the pure Python loader and helpers.yamlhelper
+
+Usage: python benchmarks/yaml_loading.py [--files 20000] [--workers N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import yamlhelper  # noqa: E402
+
+
+def generate_files(dir_name, count):
+    """ Writes files looking like exported Relationships """
+    file_names = list()
+    for index in range(count):
+        file_name = os.path.join(dir_name, "{0}.yaml".format(index))
+        with open(file_name, 'w') as file:
+            file.write(yaml.dump({
+                'DDP_Migrator_Id__c': "00000000-0000-0000-0000-{0:012d}".format(index),
+                'Loop__DDP__c': '00000000-0000-0000-0000-000000000000',
+                'Loop__Filter__c': "WHERE Id = '{0}'\nORDER BY Name".format(index),
+                'Loop__Index__c': str(index),
+                'Loop__Parent_Object__c': 'Opportunity',
+                'Loop__Related_Object_Alias__c': "Alias {0}".format(index),
+                'Name': 'OpportunityLineItem'
+            }, default_flow_style=False, width=1024))
+        file_names.append(file_name)
+    return file_names
+
+
+def load_with_default_loader(file_names):
+    """ Loader used before helpers.yamlhelper.load_yaml_files """
+    rows = list()
+    for file_name in file_names:
+        with open(file_name, 'r') as file:
+            rows.append(yaml.load(file, Loader=yaml.SafeLoader))
+    return rows
+
+
+def measure(name, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print("{0:<32} {1:8.2f}s".format(name, time.perf_counter() - start))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YAML loading benchmark')
+    parser.add_argument('--files', type=int, default=20000, help='number of files to load')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    print("libyaml available: {0}".format(yaml.__with_libyaml__))
+    with tempfile.TemporaryDirectory() as dir_name:
+        file_names = generate_files(dir_name, args.files)
+        expected = measure('Pure Python loader', load_with_default_loader, file_names)
+        results = [
+            measure('C loader, 1 process', yamlhelper.load_yaml_files, file_names, 1),
+            measure('C loader, process pool', yamlhelper.load_yaml_files, file_names, args.workers)
+        ]
+        for result in results:
+            if result != expected:
+                raise Exception("Loaded objects differ")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,56 @@
 from datetime import datetime
+from helpers import cachehelper, csvhelper
+from helpers.batchsize import BatchSizeController
+from helpers.jobpoller import JobPoller
 from sfdclib import \
     SfdcBulkApi, \
     SfdcMetadataApi, \
+    SfdcRestApi, \
     SfdcSession, \
     SfdcToolingApi
 
+import concurrent.futures
 import fieldhandlers
 import logging
 import os
 import operator
+import re
+import threading
 
 class DdpCommandBase:
     _LOOP_DIR_NAME = "loop"
     _DATA_DIR_NAME = "data"
     _DOCS_DIR_NAME = "documents"
+    _DEFAULT_REFERENCE_CACHE_DIR = "~/.ddpmigrator/cache"
+    _DEFAULT_MAX_CONCURRENT_JOBS = 4
+    _DEFAULT_MAX_PARALLEL_BATCHES = 10
+    _DEFAULT_INITIAL_BATCH_SIZE = 2000
+    # Errors caused by Loop triggers, rows failed with them are retried in smaller batches
+    # Bulk API fires triggers for chunks of 200 records, larger batches don't take more CPU time per transaction
+    _BULK_TRIGGER_CHUNK_SIZE = 200
+    _RETRYABLE_BULK_ERROR_RE = re.compile(r'UNABLE_TO_LOCK_ROW|CPU time limit', re.IGNORECASE)
+    _SIMPLE_QUERY_RE = re.compile(
+        r'^\s*SELECT\s+(.+?)\s+FROM\s+(\w+)(?:\s+WHERE\s+(.+?))?(?:\s+(ORDER\s+BY\s+.+?))?\s*$', re.I | re.S)
+    # SOQL statement can't be longer than 20,000 characters, leave some room for the rest of the statement
+    _MAX_IN_CLAUSE_LENGTH = 10000
+    _RECORD_ID_RE = re.compile(r'^[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?$')
+    # Errors of queries filtered by values the field doesn't accept, the whole table is loaded instead
+    _INVALID_FILTER_ERROR_RE = re.compile(r'INVALID_QUERY_FILTER_OPERATOR|MALFORMED_ID|invalid ID field')
 
     """ Base command class """
     def __init__(self, settings, **kwargs):
         self._kwargs = kwargs
         self._unique_key = settings['unique-key']
-        self._update_batch_size = int(settings['update-batch-size'])
+        batch_size_settings = settings.get('batch-size', dict())
+        self._initial_batch_size = int(batch_size_settings.get('initial', self._DEFAULT_INITIAL_BATCH_SIZE))
+        self._max_batch_size = int(batch_size_settings.get('max', csvhelper.BULK_MAX_BATCH_ROWS))
+        self._max_concurrent_jobs = int(settings.get('max-concurrent-jobs', self._DEFAULT_MAX_CONCURRENT_JOBS))
+        self._max_parallel_batches = int(settings.get('max-parallel-batches', self._DEFAULT_MAX_PARALLEL_BATCHES))
         self._table_settings = settings['tables']
         self._excluded_fields = settings['excluded-fields']
+        reference_cache_settings = settings.get('reference-cache', dict())
+        self._reference_cache_dir = reference_cache_settings.get('dir', self._DEFAULT_REFERENCE_CACHE_DIR)
+        self._reference_cache_objects = reference_cache_settings.get('objects', list())
         self._source_dir = os.path.normpath(kwargs['source_dir'])
         # Instance of SfdcSession class
         self._session = None
@@ -31,6 +60,18 @@ class DdpCommandBase:
         self._bapi = None
         # Instance of SfdcMetadataApi class
         self._mapi = None
+        # Instance of SfdcRestApi class
+        self._rapi = None
+        # Tracks all outstanding Bulk and Metadata API jobs
+        self._job_poller = JobPoller()
+        # Batch sizes per object, sizes are saved per org once connected
+        self._batch_sizes = BatchSizeController(None, self._initial_batch_size, self._max_batch_size)
+        # Reference tables required by field handlers in (object, query): {'header', 'rows'} format
+        self._reference_data = dict()
+        # Tables are processed by several threads, reference data is shared between them
+        self._reference_data_lock = threading.Lock()
+        # Key prefixes of objects in 'Object name': 'Key prefix' format
+        self._key_prefixes = dict()
         # Resolve table dependencies
         self._forward = dict()
         self._reverse = dict()
@@ -70,6 +111,18 @@ class DdpCommandBase:
         # Create an instance of Metadata API class
         self._mapi = SfdcMetadataApi(self._session)
 
+        # Create an instance of REST API class
+        self._rapi = SfdcRestApi(self._session)
+
+        # Load batch sizes which worked in this org before
+        self._batch_sizes = BatchSizeController(
+            os.path.join(os.path.expanduser(self._reference_cache_dir), self._get_org_id(), 'batch-sizes.json'),
+            self._initial_batch_size, self._max_batch_size)
+
+    def _get_org_id(self):
+        """ Extracts organization ID from the session ID which is in <Org ID>!<Token> format """
+        return self._session.get_session_id().split('!')[0]
+
     def _get_loop_dir(self):
         return os.path.join(self._source_dir, self._LOOP_DIR_NAME)
 
@@ -110,7 +163,7 @@ class DdpCommandBase:
     def _extract_table_name_from_path(self, file_name):
         # Extract table name
         rel_path = os.path.relpath(file_name, self._get_relative_data_dir())
-        table_alias = rel_path.split('\\')[1]
+        table_alias = rel_path.split(os.sep)[1]
         # Remove '.yaml' for parent table files
         # noinspection PyTypeChecker
         if table_alias.endswith('.yaml'):
@@ -142,6 +195,55 @@ class DdpCommandBase:
                 self._forward[dep].append(table_name)
                 self._reverse[table_name].append(dep)
 
+    def _get_table_dependencies(self, table_name):
+        """ Returns tables which have to be imported before the table: its parent and tables its handlers look up """
+        dependencies = list(self._reverse[table_name])
+        table_names_by_dev_name = {self._parse_table_name(name)[1]: name for name in self._table_settings}
+        field_handlers = self._table_settings[table_name].get('field-handlers', dict())
+        for field_name in field_handlers:
+            handler_class = self._locate_handler_class(field_handlers[field_name]['class'])
+            for dev_name in handler_class.tables_referenced_by_encode():
+                dependency = table_names_by_dev_name.get(dev_name)
+                if dependency is not None and dependency != table_name and dependency not in dependencies:
+                    dependencies.append(dependency)
+        return dependencies
+
+    def _run_in_dependency_order(self, table_names, action):
+        """ Calls action(table_name) for each table as soon as all tables it depends on are processed
+            Independent tables are processed concurrently by up to max-concurrent-jobs threads """
+        pending = dict()
+        for table_name in table_names:
+            pending[table_name] = set(
+                dependency for dependency in self._get_table_dependencies(table_name) if dependency in table_names)
+
+        error = None
+        running = dict()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_concurrent_jobs) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                # Start tables whose dependencies are processed, stop starting new ones after a failure
+                if error is None:
+                    ready = [table_name for table_name in pending if len(pending[table_name]) == 0]
+                    for table_name in self._resolve_import_order(ready):
+                        del pending[table_name]
+                        running[executor.submit(action, table_name)] = table_name
+                if len(running) == 0:
+                    if error is not None:
+                        break
+                    raise Exception("Circular dependency between tables: {0}".format(', '.join(sorted(pending))))
+
+                done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    table_name = running.pop(future)
+                    if future.exception() is not None:
+                        if error is None:
+                            error = future.exception()
+                        continue
+                    for dependencies in pending.values():
+                        dependencies.discard(table_name)
+
+        if error is not None:
+            raise error
+
     @staticmethod
     def _parse_table_name(table_name):
         if '.' in table_name:
@@ -168,17 +270,355 @@ class DdpCommandBase:
 
         return fields
 
+    def _submit_bulk_batch(self, operation, dev_name, job_id, batch_id):
+        """ Starts tracking Bulk API batch, returns Future resolved with batch status """
+        def check_status():
+            status = self._bapi._get_batch_state(job_id, batch_id)
+            return status['state'], status['state'] in ['Completed', 'Failed', 'Not Processed'], status
+        return self._job_poller.submit("{0} {1}".format(operation, dev_name), check_status)
+
+    def _wait_for_bulk_batch(self, operation, dev_name, job_id, batch_id):
+        """ Blocks until Bulk API batch is processed, returns batch status """
+        return self._submit_bulk_batch(operation, dev_name, job_id, batch_id).result()
+
     def _retrieve_data(self, dev_name, query):
-        return self._bapi.export(dev_name, query)
+        """ Exports query results in CSV format using Bulk API """
+        job_id = self._bapi._create_job('query', dev_name, 'CSV')
+        batch_id = self._bapi._add_batch(job_id, query)
+        self._bapi._close_job(job_id)
+
+        status = self._wait_for_bulk_batch('query', dev_name, job_id, batch_id)
+        if status['state'] != 'Completed':
+            raise Exception("Batch failed: {0}".format(status['message']))
+
+        if status['processed'] == '0':
+            return ''
+        return self._bapi._get_batch_result(job_id, batch_id)
+
+    def _rest_query(self, query):
+        """ Runs SOQL query using REST API and returns all records """
+        res = self._rapi.soql_query(query)
+        records = res['records']
+        while not res['done']:
+            next_url = res['nextRecordsUrl']
+            res = self._rapi.get(next_url[next_url.index('/query'):])
+            records += res['records']
+        return records
 
-    def _upsert_data(self, dev_name, csv_data, external_id_field):
-        return self._bapi.upsert(dev_name, csv_data, external_id_field)
+    @staticmethod
+    def _convert_rest_value(value):
+        """ Converts REST API value into the same string Bulk API puts into CSV """
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value)
 
-    def _update_data(self, dev_name, csv_data):
-        return self._bapi.update(dev_name, csv_data)
+    @staticmethod
+    def _normalize_modstamp(value):
+        """ Truncates Bulk (.000Z) and REST (.000+0000) date/time values to YYYY-MM-DDThh:mm:ss """
+        return value[:19]
+
+    def _retrieve_persistent_reference_table(self, dev_name, query, id_key):
+        """ Serves reference table from the on-disk cache and revalidates it using SystemModstamp """
+        match = self._SIMPLE_QUERY_RE.match(query)
+        if match is None:
+            return None
+        fields, where = match.group(1), match.group(3)
+        cache_file_name = cachehelper.get_cache_file_name(
+            self._reference_cache_dir, self._get_org_id(), self._session.get_api_version(), dev_name, query)
+        cache = cachehelper.load_cache(cache_file_name)
+
+        if cache is not None:
+            # Fetch records changed since the last run
+            condition = "SystemModstamp >= {0}Z".format(cache['watermark'])
+            if where:
+                condition = "({0}) AND {1}".format(where, condition)
+            self._logger.info("      Revalidating cached {0} object ...".format(dev_name))
+            header = cache['header']
+            rows = cache['rows']
+            watermark = cache['watermark']
+            for record in self._rest_query("SELECT {0},SystemModstamp FROM {1} WHERE {2}".format(
+                    fields, dev_name, condition)):
+                row_id = record[id_key]
+                rows[row_id] = [self._convert_rest_value(record[field]) for field in header]
+                watermark = max(watermark, self._normalize_modstamp(record['SystemModstamp']))
+            # Deleted records and records restored with an older SystemModstamp don't show up in the query above,
+            # compare record IDs instead
+            id_query = "SELECT {0} FROM {1}".format(id_key, dev_name)
+            if where:
+                id_query += " WHERE {0}".format(where)
+            org_ids = set(record[id_key] for record in self._rest_query(id_query))
+            if all(row_id in rows for row_id in org_ids):
+                deleted_ids = [row_id for row_id in rows if row_id not in org_ids]
+                for row_id in deleted_ids:
+                    del rows[row_id]
+                if watermark != cache['watermark'] or len(deleted_ids) > 0:
+                    cachehelper.save_cache(cache_file_name, {'watermark': watermark, 'header': header, 'rows': rows})
+                return {
+                    'header': header,
+                    'rows': rows
+                }
+            self._logger.info("      Cached {0} records are missing some of the records ...".format(dev_name))
+
+        # Full export
+        self._logger.info("      Exporting {0} object from Salesforce ...".format(dev_name))
+        full_query = "SELECT {0},SystemModstamp FROM {1}".format(fields, dev_name)
+        if where:
+            full_query += " WHERE {0}".format(where)
+        raw_data = self._retrieve_data(dev_name, full_query)
+        header, rows = csvhelper.load_csv_with_one_id_key(raw_data, id_key)
+        watermark = '0001-01-01T00:00:00'
+        if len(rows) > 0:
+            modstamp_index = header.index('SystemModstamp')
+            del header[modstamp_index]
+            for row in rows.values():
+                watermark = max(watermark, self._normalize_modstamp(row[modstamp_index]))
+                del row[modstamp_index]
+            cachehelper.save_cache(cache_file_name, {'watermark': watermark, 'header': header, 'rows': rows})
+        return {
+            'header': header,
+            'rows': rows
+        }
 
-    def _delete_data(self, dev_name, csv_data):
-        return self._bapi.delete(dev_name, csv_data)
+    @staticmethod
+    def _quote_soql_value(value):
+        return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+    def _split_in_clause_values(self, values):
+        """ Quotes values and splits them into chunks so each chunk fits in one IN clause """
+        chunks = list()
+        chunk = list()
+        chunk_length = 0
+        for value in values:
+            quoted_value = self._quote_soql_value(value)
+            if len(chunk) > 0 and chunk_length + len(quoted_value) + 1 > self._MAX_IN_CLAUSE_LENGTH:
+                chunks.append(chunk)
+                chunk = list()
+                chunk_length = 0
+            chunk.append(quoted_value)
+            chunk_length += len(quoted_value) + 1
+        if len(chunk) > 0:
+            chunks.append(chunk)
+        return chunks
+
+    @classmethod
+    def _add_in_clause(cls, query, field_name, quoted_values):
+        """ Adds '<field> IN (<values>)' condition to WHERE clause of the query """
+        match = cls._SIMPLE_QUERY_RE.match(query)
+        if match is None:
+            raise Exception("Could not parse query [{0}]".format(query))
+        fields, object_name, where, order_by = match.groups()
+        condition = "{0} IN ({1})".format(field_name, ','.join(quoted_values))
+        if where:
+            condition = "({0}) AND {1}".format(where, condition)
+        query = "SELECT {0} FROM {1} WHERE {2}".format(fields, object_name, condition)
+        if order_by:
+            query += " {0}".format(order_by)
+        return query
+
+    def _retrieve_data_in_chunks(self, dev_name, query, field_name, values):
+        """ Runs the query with '<field> IN (<values>)' condition, values are split into length-safe chunks
+            Chunks are exported concurrently and results are merged into one CSV """
+        queries = [
+            self._add_in_clause(query, field_name, chunk)
+            for chunk in self._split_in_clause_values(sorted(set(values)))]
+        if len(queries) <= 1:
+            return csvhelper.merge_csv(self._retrieve_data(dev_name, chunk_query) for chunk_query in queries)
+        max_workers = min(self._max_concurrent_jobs, len(queries))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return csvhelper.merge_csv(
+                executor.map(lambda chunk_query: self._retrieve_data(dev_name, chunk_query), queries))
+
+    def _retrieve_table_in_chunks(self, dev_name, query, id_key, field_name, values):
+        """ Runs the query once per chunk of values and merges results into one table """
+        return csvhelper.load_csv_with_one_id_key(
+            self._retrieve_data_in_chunks(dev_name, query, field_name, values), id_key)
+
+    def _get_key_prefix(self, dev_name):
+        """ Returns the first 3 characters of IDs of the object's records """
+        with self._reference_data_lock:
+            key_prefix = self._key_prefixes.get(dev_name)
+        if key_prefix is None:
+            key_prefix = self._rapi.get('/sobjects/{0}/'.format(dev_name))['objectDescribe']['keyPrefix'] or ''
+            with self._reference_data_lock:
+                self._key_prefixes[dev_name] = key_prefix
+        return key_prefix
+
+    def _get_valid_filter_values(self, dev_name, field_name, values):
+        """ Skips values which can't be IDs of the object's records, they would fail the whole query """
+        if field_name != 'Id':
+            return values
+        key_prefix = self._get_key_prefix(dev_name)
+        return [value for value in values if self._RECORD_ID_RE.match(value) and value.startswith(key_prefix)]
+
+    def _retrieve_reference_table(self, dev_name, query, id_key, table_filter=None):
+        """ Returns reference table required by a field handler, each table is exported once per run """
+        # Objects cached on disk are always loaded in full
+        if dev_name in self._reference_cache_objects:
+            table_filter = None
+        cache_key = (dev_name, query)
+        if table_filter is not None:
+            cache_key += (table_filter['field'], tuple(table_filter['values']))
+        with self._reference_data_lock:
+            table = self._reference_data.get(cache_key)
+        if table is None:
+            if dev_name in self._reference_cache_objects:
+                table = self._retrieve_persistent_reference_table(dev_name, query, id_key)
+            elif table_filter is not None:
+                self._logger.info("      Exporting {0} record(s) of {1} object from Salesforce ...".format(
+                    len(table_filter['values']), dev_name))
+                values = self._get_valid_filter_values(dev_name, table_filter['field'], table_filter['values'])
+                try:
+                    header, rows = self._retrieve_table_in_chunks(
+                        dev_name, query, id_key, table_filter['field'], values)
+                    table = {
+                        'header': header,
+                        'rows': rows
+                    }
+                except Exception as ex:
+                    if self._INVALID_FILTER_ERROR_RE.search(str(ex)) is None:
+                        raise
+                    self._logger.info("      Could not export filtered {0} object: {1}".format(dev_name, ex))
+            if table is None:
+                self._logger.info("      Exporting {0} object from Salesforce ...".format(dev_name))
+                raw_data = self._retrieve_data(dev_name, query)
+                header, rows = csvhelper.load_csv_with_one_id_key(raw_data, id_key)
+                table = {
+                    'header': header,
+                    'rows': rows
+                }
+            with self._reference_data_lock:
+                self._reference_data[cache_key] = table
+        return table
+
+    def _retrieve_required_data(self, tables_to_load):
+        """ Loads tables returned by tables_required_by_decode()/tables_required_by_encode() """
+        required_data = dict()
+        for table_to_load_name, table_to_load in tables_to_load.items():
+            required_data[table_to_load_name] = self._retrieve_reference_table(
+                table_to_load_name, table_to_load['query'], table_to_load['id'], table_to_load.get('filter'))
+        return required_data
+
+    def _invalidate_reference_data(self, dev_name):
+        """ Drops cached reference tables of an object changed by this tool """
+        with self._reference_data_lock:
+            for cache_key in [key for key in self._reference_data if key[0] == dev_name]:
+                del self._reference_data[cache_key]
+
+    def _run_bulk_job(self, operation, dev_name, batches, external_id_field=None):
+        """ Runs Bulk API job adding one batch per (row IDs, CSV data) tuple, batches are sent as they are generated
+            Salesforce processes batches of a job in parallel, at most max-parallel-batches of them are in flight
+            Returns list of batch statuses, unlike SfdcBulkApi methods it always downloads per-row results
+            Results are in CSV format with "Id","Success","Created","Error" columns, rows are in input order """
+        job_id = self._bapi._create_job(operation, dev_name, 'CSV', external_id_field)
+        running = dict()
+        statuses = list()
+
+        def collect(futures):
+            for future in futures:
+                batch_id, row_ids, batch_index = running.pop(future)
+                status = future.result()
+                status['row_ids'] = row_ids
+                status['batch_index'] = batch_index
+                status['results'] = ''
+                if status['state'] == 'Completed':
+                    status['results'] = self._bapi._get_batch_result(job_id, batch_id, True)
+                statuses.append(status)
+
+        try:
+            try:
+                for batch_index, (row_ids, csv_data) in enumerate(batches):
+                    if len(running) >= self._max_parallel_batches:
+                        done, not_done = concurrent.futures.wait(
+                            running, return_when=concurrent.futures.FIRST_COMPLETED)
+                        collect(done)
+                    batch_id = self._bapi._add_batch(job_id, csv_data)
+                    running[self._submit_bulk_batch(operation, dev_name, job_id, batch_id)] = \
+                        (batch_id, row_ids, batch_index)
+            finally:
+                # Job is closed even if a batch could not be added or checked
+                self._bapi._close_job(job_id)
+            collect(list(running))
+        except Exception:
+            # Batches which are still outstanding aren't polled anymore
+            for future in list(running):
+                self._job_poller.cancel(future)
+            raise
+
+        statuses.sort(key=lambda batch_status: batch_status['batch_index'])
+        return statuses
+
+    def _run_adaptive_bulk_job(self, operation, dev_name, table, external_id_field=None, names_to_ids=None):
+        """ Runs Bulk API job for all rows of the table, batch size is controlled by BatchSizeController
+            Rows failed due to CPU time limit or record locks are retried in batches half the size of the failed batch
+            Returns maps 'Row ID': 'Record Id' of processed rows and 'Row ID': 'Error' of failed rows """
+        ids = dict()
+        errors = dict()
+        pending = table
+        while len(pending) > 0:
+            batch_size = self._batch_sizes.get(dev_name)
+            batches = csvhelper.generate_csv_batches(pending, max_rows=batch_size, names_to_ids=names_to_ids)
+            statuses = self._run_bulk_job(operation, dev_name, batches, external_id_field)
+
+            retry_errors = dict()
+            failed_messages = list()
+            # Size of the largest batch containing rows to retry
+            failed_batch_size = 0
+            for status in statuses:
+                if status['state'] != 'Completed':
+                    if self._RETRYABLE_BULK_ERROR_RE.search(str(status['message'])):
+                        retry_errors.update((row_id, status['message']) for row_id in status['row_ids'])
+                        failed_batch_size = max(failed_batch_size, len(status['row_ids']))
+                    else:
+                        failed_messages.append(str(status['message']))
+                    continue
+                batch_ids, batch_errors = csvhelper.load_bulk_results(status['results'], status['row_ids'])
+                ids.update(batch_ids)
+                for row_id, error in batch_errors.items():
+                    if self._RETRYABLE_BULK_ERROR_RE.search(error):
+                        retry_errors[row_id] = error
+                        failed_batch_size = max(failed_batch_size, len(status['row_ids']))
+                    else:
+                        errors[row_id] = error
+
+            # Failures are collected per batch so one failed batch doesn't hide the others
+            if len(failed_messages) > 0:
+                raise Exception("{0} call failed for {1} of {2} batch(es): {3}".format(
+                    operation.capitalize(), len(failed_messages), len(statuses), '; '.join(failed_messages)))
+
+            if len(retry_errors) == 0:
+                self._batch_sizes.record_success(dev_name, batch_size)
+                break
+            # Rows are split into batches half the size of the batch which failed, not of the configured size
+            if not self._batch_sizes.record_failure(
+                    dev_name, min(batch_size, failed_batch_size, self._BULK_TRIGGER_CHUNK_SIZE)):
+                errors.update(retry_errors)
+                break
+            self._logger.info("  {0} row(s) failed due to CPU time limit or record locks. Will retry in batches "
+                              "of {1} ...".format(len(retry_errors), self._batch_sizes.get(dev_name)))
+            pending = pending.select_rows(sorted(retry_errors))
+        return ids, errors
+
+    # Reference tables of the object are invalidated once the job has finished,
+    # tables imported concurrently may have cached rows retrieved while the job was running
+    def _upsert_data(self, dev_name, table, external_id_field):
+        try:
+            return self._run_adaptive_bulk_job('upsert', dev_name, table, external_id_field)
+        finally:
+            self._invalidate_reference_data(dev_name)
+
+    def _update_data(self, dev_name, table, names_to_ids):
+        try:
+            return self._run_adaptive_bulk_job('update', dev_name, table, names_to_ids=names_to_ids)
+        finally:
+            self._invalidate_reference_data(dev_name)
+
+    def _delete_data(self, dev_name, table):
+        try:
+            return self._run_adaptive_bulk_job('delete', dev_name, table)
+        finally:
+            self._invalidate_reference_data(dev_name)
 
     def do(self):
         raise NotImplementedError("Method do() is not overridden")
@@ -1,67 +1,125 @@
-from collections import OrderedDict
 from commands.ddpcommandbase import DdpCommandBase
 from datetime import datetime
-from helpers import csvhelper, yamlhelper
+from helpers import cachehelper, csvhelper, yamlhelper
 
-import io
+import concurrent.futures
 import glob
+import json
 import os
-import pathlib
-import shutil
-import time
+import tempfile
 import zipfile
-import yaml
-
-
-def str_presenter(dumper, data):
-    if len(data.splitlines()) > 1:  # check for multi-line string
-        # PyYAML doesn't like carriage return, remove it
-        return dumper.represent_scalar('tag:yaml.org,2002:str', data.replace('\r\n', '\n'), style='|')
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data)
-
-
-def ordered_dict_presenter(dumper, data):
-    return dumper.represent_dict(data.items())
 
 
 class DdpExport(DdpCommandBase):
     """ Class handling export command """
+    _EXPORT_STATE_DIR_NAME = '.ddpmigrator'
+    # Metadata API retrieves are limited to 10,000 files and 39 MB zipped, documents are split into smaller requests
+    # Byte limit applies to the sum of Document.BodyLength values, i.e. uncompressed size of the document bodies
+    # retrieved by one request. It is a conservative stand-in for the zip size which isn't known before the retrieve,
+    # a single document larger than the limit is retrieved on its own
+    _MAX_RETRIEVE_DOCUMENTS = 2500
+    _MAX_RETRIEVE_BYTES = 30 * 1024 * 1024
+
     def __init__(self, settings, **kwargs):
         super().__init__(settings, **kwargs)
+        # Tables in 'Table name': Table format
         self._data = dict()
+        # Maps in 'Table name': {'Id': 'Unique key'} format
+        self._id_to_uk = dict()
         self._ddp_ids = None
+        # State of the previous incremental export in
+        # 'Table name': {'watermark': 'Max SystemModstamp', 'files': {'Id': 'File name'}} format
+        self._export_state = None
+        # Current records in 'Table name': {'Id': ('SystemModstamp', 'Parent Id')} format
+        self._modstamps = dict()
+        # Documents referenced by DDP files in 'Folder/Document': 'Document Id' format
+        self._document_ids = dict()
+
+    def _is_incremental(self):
+        """ Records modified since the previous incremental export are exported only if its state is known """
+        return self._export_state is not None
+
+    def _get_export_state_file_name(self):
+        """ <Source-Directory>/.ddpmigrator/export-<Org-Id>.json """
+        return os.path.join(self._source_dir, *[
+            self._EXPORT_STATE_DIR_NAME,
+            "export-{0}.json".format(self._get_org_id())])
+
+    def _load_export_state(self):
+        file_name = self._get_export_state_file_name()
+        if not os.path.exists(file_name):
+            self._logger.info("  State of the previous export was not found, exporting all records ...")
+            return
+        with open(file_name, 'r', encoding='utf-8') as file:
+            self._export_state = json.load(file)
+
+    def _save_export_state(self, records):
+        """ Saves watermarks and file names of all current records """
+        state = dict()
+        for table_name, modstamps in self._modstamps.items():
+            old_state = self._export_state.get(table_name, dict()) if self._is_incremental() else dict()
+            files = {record_id: file_name for record_id, file_name in old_state.get('files', dict()).items()
+                     if record_id in modstamps}
+            for record_id, (file_name, header, row) in records[table_name].items():
+                files[record_id] = os.path.relpath(file_name, self._source_dir)
+            state[table_name] = {
+                'watermark': max([stamp for stamp, parent_id in modstamps.values()] +
+                                 [old_state.get('watermark', '')]),
+                'files': files
+            }
+        file_name = self._get_export_state_file_name()
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, 'w', encoding='utf-8') as file:
+            json.dump(state, file, indent=1, sort_keys=True)
 
-    def _export_table(self, table_name):
+    def _retrieve_modstamps(self, table_name):
+        """ Retrieves Id and SystemModstamp of all records, used to find modified and deleted records """
+        namespace, dev_name = self._parse_table_name(table_name)
+        fields = ['Id', 'SystemModstamp']
+        if 'parent-relationship' in self._table_settings[table_name]:
+            fields.append(self._table_settings[table_name]['parent-relationship']['field'])
+        header, rows = csvhelper.load_csv_with_one_id_key(
+            self._retrieve_data(dev_name, "SELECT {0} FROM {1}".format(','.join(fields), dev_name)), 'Id')
+        modstamps = {record_id: (row[0], row[1] if len(row) > 1 else '') for record_id, row in rows.items()}
+        if self._ddp_ids is None:
+            return modstamps
+        # Only the latest DDP of each name is exported, records of older ones are ignored
+        ddp_ids = set(self._ddp_ids)
+        return {record_id: (stamp, parent_id) for record_id, (stamp, parent_id) in modstamps.items()
+                if (parent_id if len(header) > 1 else record_id) in ddp_ids}
+
+    def _find_modified_ids(self, table_name):
+        """ Returns IDs of records created or modified since the previous export """
+        state = self._export_state.get(table_name, {'watermark': '', 'files': dict()})
+        return set(record_id for record_id, (stamp, parent_id) in self._modstamps[table_name].items()
+                   if stamp > state['watermark'] or record_id not in state['files'])
+
+    def _find_ids_to_export(self, table_name):
+        """ Returns IDs of modified records and children of modified parents, their file names may change """
+        record_ids = self._find_modified_ids(table_name)
+        if 'parent-relationship' in self._table_settings[table_name]:
+            parent_table_name = self._table_settings[table_name]['parent-relationship']['parent-table']
+            parent_ids = self._find_modified_ids(parent_table_name)
+            record_ids.update(record_id for record_id, (stamp, parent_id) in self._modstamps[table_name].items()
+                              if parent_id in parent_ids)
+        return sorted(record_ids)
+
+    def _export_table(self, table_name, record_ids=None):
         fields = self._retrieve_fields(table_name)
         namespace, dev_name = self._parse_table_name(table_name)
-        query = "SELECT {0} FROM {1}".format(",".join(fields), dev_name)
+        query = "SELECT {0} FROM {1} ORDER BY {2}".format(",".join(fields), dev_name, self._unique_key)
+        if record_ids is not None:
+            if len(record_ids) == 0:
+                return ''
+            return self._retrieve_data_in_chunks(dev_name, query, 'Id', record_ids)
         if self._ddp_ids:
             if 'parent-relationship' in self._table_settings[table_name]:
                 field_name = self._table_settings[table_name]['parent-relationship']['field']
             else:
                 field_name = 'Id'
-            query += " WHERE {0} IN ({1})".format(field_name, "'" + "','".join(self._ddp_ids) + "'")
-
-        query += " ORDER BY {0}".format(self._unique_key)
-        data = self._retrieve_data(dev_name, query)
-        return {
-            'fields': fields,
-            'raw_data': data
-        }
-
-    @staticmethod
-    def _persist_row(file_name, header, row):
-        obj = OrderedDict()
-        column_index = 0
-        while column_index < len(row):
-            obj[header[column_index]] = row[column_index]
-            column_index += 1
+            return self._retrieve_data_in_chunks(dev_name, query, field_name, self._ddp_ids)
 
-        dir_name = os.path.dirname(file_name)
-        if not os.path.exists(dir_name):
-            os.mkdir(dir_name)
-        with open(file_name, 'w') as file:
-            file.write(yaml.dump(obj, default_flow_style=False, explicit_start=False, width=1024))
+        return self._retrieve_data(dev_name, query)
 
     def _get_ddp_data_dir_name(self, ddp_name):
         """ loop/data/<DDP-Name> """
@@ -87,70 +145,116 @@ class DdpExport(DdpCommandBase):
 
     def _get_parent_record_name(self, table_name, parent_id):
         parent_table_name = self._table_settings[table_name]['parent-relationship']['parent-table']
-        header = self._data[parent_table_name]['header']
+        parent_table = self._data[parent_table_name]
         name_fields = self._table_settings[parent_table_name]['name']
         if isinstance(name_fields, str):
             name_fields = [name_fields]
-        name_field_indexes = list()
-        for name_field in name_fields:
-            name_field_indexes.append(header.index(name_field))
         names = list()
-        for name_field_index in name_field_indexes:
-            names.append(self._data[parent_table_name]['rows'][parent_id][name_field_index])
+        for name_field in name_fields:
+            names.append(parent_table.get(parent_id, name_field))
         return '-'.join(names)
 
-    def _save_parent_data(self, table_name):
-        header = self._data[table_name]['header']
-        rows = self._data[table_name]['rows']
+    def _get_parent_data_files(self, table_name):
+        """ Returns records of parent table in 'Unique key': (file name, header, row) format """
+        table = self._data[table_name]
+        header = table.header
         name_fields = self._table_settings[table_name]['name']
         if isinstance(name_fields, str):
             name_fields = [name_fields]
         name_field_indexes = list()
         for name_field in name_fields:
-            name_field_indexes.append(header.index(name_field))
-        for row_id, row in rows.items():
+            name_field_indexes.append(table.index(name_field))
+        records = dict()
+        for row_id, row in table.items():
             names = list()
             for name_field_index in name_field_indexes:
                 names.append(row[name_field_index])
-            self._persist_row(
-                self._get_parent_data_file_name('-'.join(names), table_name),
-                header,
-                row
-            )
-
-    def _save_child_data(self, table_name):
-        header = self._data[table_name]['header']
-        rows = self._data[table_name]['rows']
-        if len(rows) == 0:
-            return
+            records[row_id] = (self._get_parent_data_file_name('-'.join(names), table_name), header, row)
+        return records
+
+    def _get_child_data_files(self, table_name):
+        """ Returns records of child table in 'Unique key': (file name, header, row) format """
+        table = self._data[table_name]
+        if len(table) == 0:
+            return dict()
+        header = table.header
         name_fields = self._table_settings[table_name]['name']
         if isinstance(name_fields, str):
             name_fields = [name_fields]
         name_field_indexes = list()
         for name_field in name_fields:
-            name_field_indexes.append(header.index(name_field))
-        parent_id_index = header.index(self._table_settings[table_name]['parent-relationship']['field'])
-        for row_id, row in rows.items():
+            name_field_indexes.append(table.index(name_field))
+        parent_id_index = table.index(self._table_settings[table_name]['parent-relationship']['field'])
+        records = dict()
+        for row_id, row in table.items():
             names = list()
             for name_field_index in name_field_indexes:
                 names.append(row[name_field_index])
-            self._persist_row(
-                self._get_child_data_file_name(table_name, row[parent_id_index], '-'.join(names)),
-                header,
-                row
-            )
+            records[row_id] = \
+                (self._get_child_data_file_name(table_name, row[parent_id_index], '-'.join(names)), header, row)
+        return records
 
     def _save_data(self):
         """ Save resulting data """
-        yaml.add_representer(str, str_presenter)
-        yaml.add_representer(OrderedDict, ordered_dict_presenter)
-
+        # Records in 'Table name': {'Id': (file name, header, row)} format
+        records = dict()
         table_settings = self._table_settings
         for table_name, settings in table_settings.items():
             if 'parent-relationship' in settings:
-                self._save_child_data(table_name)
+                table_records = self._get_child_data_files(table_name)
             else:
-                self._save_parent_data(table_name)
+                table_records = self._get_parent_data_files(table_name)
+            # Tables are keyed by unique key
+            records[table_name] = {record_id: table_records[uk] for record_id, uk in self._id_to_uk[table_name].items()
+                                   if uk in table_records}
+
+        # Files are compared with their new content and written only if it has changed
+        all_records = [record for table_records in records.values() for record in table_records.values()]
+        written_count = yamlhelper.save_yaml_files(all_records)
+        saved_file_names = set(os.path.normpath(file_name) for file_name, header, row in all_records)
+        self._logger.info("  Saved {0} file(s), {1} file(s) unchanged ...".format(
+            written_count, len(saved_file_names) - written_count))
+        if self._is_incremental():
+            self._delete_files_of_removed_records(records, saved_file_names)
+        else:
+            self._delete_stale_data_files(saved_file_names)
+        if self._kwargs.get('incremental', False):
+            self._save_export_state(records)
+
+    def _delete_files_of_removed_records(self, records, saved_file_names):
+        """ Deletes files of records deleted since the previous export and old files of renamed records """
+        for table_name, state in self._export_state.items():
+            if table_name not in self._modstamps:
+                continue
+            for record_id, file_name in state['files'].items():
+                if record_id in self._modstamps[table_name] and record_id not in records[table_name]:
+                    continue
+                full_file_name = os.path.normpath(os.path.join(self._source_dir, file_name))
+                if full_file_name in saved_file_names or not os.path.exists(full_file_name):
+                    continue
+                self._logger.info("    Deleting {0}".format(full_file_name))
+                os.remove(full_file_name)
+                # Remove directories left empty
+                dir_name = os.path.dirname(full_file_name)
+                while dir_name != self._get_data_dir() and len(os.listdir(dir_name)) == 0:
+                    os.rmdir(dir_name)
+                    dir_name = os.path.dirname(dir_name)
+
+    def _delete_stale_data_files(self, saved_file_names):
+        """ Deletes files of records which no longer exist and empty directories """
+        if 'ddp' in self._kwargs:
+            data_dir_names = [self._get_ddp_data_dir_name(ddp_name) for ddp_name in self._kwargs['ddp']]
+        else:
+            data_dir_names = [self._get_data_dir()]
+        for data_dir_name in data_dir_names:
+            for dir_path, dir_names, file_names in os.walk(data_dir_name, topdown=False):
+                for file_name in file_names:
+                    full_file_name = os.path.normpath(os.path.join(dir_path, file_name))
+                    if full_file_name not in saved_file_names:
+                        self._logger.info("    Deleting {0}".format(full_file_name))
+                        os.remove(full_file_name)
+                if len(os.listdir(dir_path)) == 0:
+                    os.rmdir(dir_path)
 
     def _retrieve_ddp_ids(self, retrieve_all=False):
         key_field = 'Id'
@@ -158,9 +262,10 @@ class DdpExport(DdpCommandBase):
         date_field = 'LastModifiedDate'
         parent_table_name = 'Loop__DDP__c'
         query = "SELECT {0},{1},{2} FROM {3}".format(key_field, name_field, date_field, parent_table_name)
-        if not retrieve_all:
-            query += " WHERE Name IN ({0})".format("'" + "','".join(self._kwargs['ddp']) + "'")
-        raw_data = self._retrieve_data(parent_table_name, query)
+        if retrieve_all:
+            raw_data = self._retrieve_data(parent_table_name, query)
+        else:
+            raw_data = self._retrieve_data_in_chunks(parent_table_name, query, name_field, self._kwargs['ddp'])
         header, rows = csvhelper.load_csv_with_one_id_key(raw_data, key_field)
         name_index = header.index(name_field)
         date_index = header.index(date_field)
@@ -188,18 +293,31 @@ class DdpExport(DdpCommandBase):
         else:
             self._retrieve_ddp_ids(retrieve_all=True)
 
+        # Modification stamps are used to find records to export and saved as watermarks after export
+        if self._kwargs.get('incremental', False):
+            for table_name in self._table_settings:
+                self._modstamps[table_name] = self._retrieve_modstamps(table_name)
+
         # Export all tables first using Bulk API
-        for table_name in self._table_settings:
+        raw_data = dict()
+        for table_name, settings in self._table_settings.items():
             self._logger.info("  Exporting table: {0} ...".format(table_name))
-            self._data[table_name] = self._export_table(table_name)
+            # Parent tables are always exported in full, file names of children contain names of parents
+            if self._is_incremental() and 'parent-relationship' in settings:
+                record_ids = self._find_ids_to_export(table_name)
+                self._logger.info("    {0} record(s) modified since the previous export".format(len(record_ids)))
+                raw_data[table_name] = self._export_table(table_name, record_ids)
+            else:
+                raw_data[table_name] = self._export_table(table_name)
 
-        # Load CSV from string and create maps ID -> Unique key and Unique key -> ID in memory
+        # Load CSV from string and create map ID -> Unique key in memory
         for table_name in self._table_settings:
-            self._data[table_name]['IdToUk'], \
-                self._data[table_name]['UkToId'], \
-                self._data[table_name]['header'], \
-                self._data[table_name]['rows'] = csvhelper.load_csv_with_two_id_keys(
-                    self._data[table_name]['raw_data'], 'Id', self._unique_key)
+            self._id_to_uk[table_name], _, self._data[table_name] = csvhelper.load_csv_with_two_id_keys(
+                raw_data.pop(table_name), 'Id', self._unique_key)
+
+        # Document IDs are kept to find documents changed since they were retrieved
+        ddp_files = self._data['Loop.Loop__DDP_File__c']
+        document_ids = list(ddp_files.column('Loop__Document_ID__c')) if len(ddp_files) > 0 else list()
 
         # Replace IDs with external IDs (unique-key) and handle special fields
         for table_name, settings in self._table_settings.items():
@@ -215,6 +333,8 @@ class DdpExport(DdpCommandBase):
                     self._logger.info("    Field: {0}".format(field_name))
                     self._decode_field(table_name, field_name)
 
+        self._document_ids = dict(zip(self._get_list_of_ddp_files(), document_ids))
+
         # Save data
         self._save_data()
 
@@ -223,15 +343,12 @@ class DdpExport(DdpCommandBase):
         lookup_field = table_settings['parent-relationship']['field']
         self._logger.info("    Field: {0}".format(lookup_field))
         parent_table = table_settings['parent-relationship']['parent-table']
-        id_to_uk = self._data[parent_table]['IdToUk']
+        id_to_uk = self._id_to_uk[parent_table]
 
-        rows = self._data[table_name]['rows']
-        if len(rows) == 0:
+        table = self._data[table_name]
+        if len(table) == 0:
             return
-        header = self._data[table_name]['header']
-        lookup_field_index = header.index(lookup_field)
-        for row_id, row in rows.items():
-            row[lookup_field_index] = id_to_uk[row[lookup_field_index]]
+        table.set_column(lookup_field, [id_to_uk[parent_id] for parent_id in table.column(lookup_field)])
 
     def _decode_field(self, table_name, field_name):
         # Find handler class and create an instance of it
@@ -240,116 +357,144 @@ class DdpExport(DdpCommandBase):
         handler = handler_class(self._data[table_name], field_name)
         # Check whether handler class needs any other tables to be loaded
         tables_to_load = handler.tables_required_by_decode()
-        required_data = dict()
-        for table_to_load_name, table_to_load in tables_to_load.items():
-            raw_data = self._retrieve_data(table_to_load_name, table_to_load['query'])
-            header, rows = csvhelper.load_csv_with_one_id_key(raw_data, table_to_load['id'])
-            required_data[table_to_load_name] = {
-                'header': header,
-                'rows': rows
-            }
-        handler.set_required_data(required_data)
+        handler.set_required_data(self._retrieve_required_data(tables_to_load))
         # Convert values
         handler.decode()
 
     def _get_list_of_ddp_files(self):
         """ Get list of DDP files """
-        rows = self._data['Loop.Loop__DDP_File__c']['rows']
-        header = self._data['Loop.Loop__DDP_File__c']['header']
-        document_index = header.index('Loop__Document_ID__c')
-
-        documents = list()
-        for row_id, row in rows.items():
-            documents.append(row[document_index])
-
-        return documents
+        table = self._data['Loop.Loop__DDP_File__c']
+        if len(table) == 0:
+            return list()
+        return list(table.column('Loop__Document_ID__c'))
+
+    def _get_document_index_file_name(self):
+        """ <Source-Directory>/.ddpmigrator/documents-<Org-Id>.json """
+        return os.path.join(self._source_dir, *[
+            self._EXPORT_STATE_DIR_NAME,
+            "documents-{0}.json".format(self._get_org_id())])
+
+    def _find_document_files(self, document):
+        """ Returns names of files of the document, meta files are not included """
+        wildcard = os.path.join(self._get_docs_dir(), "{0}.*".format(document))
+        return [file_name for file_name in glob.glob(wildcard) if not file_name.endswith('-meta.xml')]
+
+    def _find_changed_documents(self, index):
+        """ Returns documents which are not on disk or were modified since they were retrieved,
+            updates index entries of all documents """
+        namespace, dev_name = self._parse_table_name('Document')
+        raw_data = self._retrieve_data_in_chunks(
+            dev_name, "SELECT Id,LastModifiedDate,BodyLength FROM Document", 'Id', list(self._document_ids.values()))
+        header, rows = csvhelper.load_csv_with_one_id_key(raw_data, 'Id')
+        # DDP files may contain 15 characters long IDs
+        rows = {record_id[:15]: row for record_id, row in rows.items()}
+        changed_documents = list()
+        for document, document_id in sorted(self._document_ids.items()):
+            entry = dict(zip(header, rows.get(document_id[:15], list())), Id=document_id)
+            if index.get(document) != entry or len(self._find_document_files(document)) == 0:
+                changed_documents.append(document)
+            index[document] = entry
+        return changed_documents
+
+    def _find_used_documents(self):
+        """ Returns documents referenced by DDP files stored in the data directory """
+        file_names = glob.glob(os.path.join(self._get_data_dir(), '**/Files/*.yaml'))
+        return set(ddp_file['Loop__Document_ID__c'] for ddp_file in yamlhelper.load_yaml_files(file_names))
+
+    def _delete_unused_documents(self, index, used_documents):
+        """ Deletes documents which are no longer referenced by DDP files """
+        for dir_path, dir_names, file_names in os.walk(self._get_docs_dir()):
+            for file_name in file_names:
+                full_file_name = os.path.join(dir_path, file_name)
+                document = os.path.relpath(full_file_name, self._get_docs_dir()).replace(os.sep, '/')
+                if document.endswith('-meta.xml'):
+                    document = document[:-len('-meta.xml')]
+                if os.path.splitext(document)[0] not in used_documents:
+                    self._logger.info("    Deleting {0}".format(full_file_name))
+                    os.remove(full_file_name)
+        for document in list(index):
+            if document not in used_documents:
+                del index[document]
 
     def _retrieve_files(self):
-        """ Retrieves DDP files using Metadata API """
+        """ Retrieves DDP files which are new or modified since they were retrieved using Metadata API """
+        index = cachehelper.load_cache(self._get_document_index_file_name()) or dict()
+        # Documents which are no longer used are deleted, other DDPs may still use documents of the exported ones
+        if 'ddp' in self._kwargs:
+            self._delete_unused_documents(index, self._find_used_documents())
+        elif not self._is_incremental():
+            self._delete_unused_documents(index, self._document_ids)
+        if len(self._document_ids) == 0:
+            self._logger.info("  There are no files to retrieve")
+        else:
+            documents = self._find_changed_documents(index)
+            self._logger.info("  {0} file(s) unchanged since they were retrieved".format(
+                len(self._document_ids) - len(documents)))
+            if len(documents) > 0:
+                self._retrieve_documents(
+                    self._split_documents(documents, {document: int(index[document].get('BodyLength') or 0)
+                                                      for document in documents}))
+        cachehelper.save_cache(self._get_document_index_file_name(), index)
+
+    def _split_documents(self, documents, sizes):
+        """ Splits documents into chunks bounded by number of documents and their total size """
+        chunks = list()
+        chunk_size = 0
+        for document in documents:
+            if len(chunks) == 0 or len(chunks[-1]) == self._MAX_RETRIEVE_DOCUMENTS or \
+                    (len(chunks[-1]) > 0 and chunk_size + sizes[document] > self._MAX_RETRIEVE_BYTES):
+                chunks.append(list())
+                chunk_size = 0
+            chunks[-1].append(document)
+            chunk_size += sizes[document]
+        return chunks
+
+    def _retrieve_documents(self, chunks):
+        """ Retrieves chunks of documents concurrently, each chunk is extracted as soon as it is retrieved """
+        self._logger.info("  Retrieving {0} file(s) in {1} request(s) ...".format(
+            sum(len(chunk) for chunk in chunks), len(chunks)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_concurrent_jobs) as executor:
+            futures = [executor.submit(self._retrieve_document_chunk, chunk) for chunk in chunks]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+    def _retrieve_document_chunk(self, documents):
+        """ Retrieves documents using Metadata API """
         options = {
             'single_package': 'true',
             'unpackaged': {
-                'Document': self._get_list_of_ddp_files()
+                'Document': documents
             }
         }
         async_process_id, state = self._mapi.retrieve(options)
-        state, error_message, messages = self._mapi.check_retrieve_status(async_process_id)
-        while state in ['InProgress', 'Pending']:
-            time.sleep(5)
-            state, error_message, messages = self._mapi.check_retrieve_status(async_process_id)
+
+        def check_status():
+            status = self._mapi.check_retrieve_status(async_process_id)
+            return status[0], status[0] not in ['InProgress', 'Pending', 'Queued'], status
+        state, error_message, messages = self._job_poller.wait("retrieve documents", check_status)
 
         # Print out any warnings
         for message in messages:
             self._logger.info("File: {0} Message: {1}".format(message['file'], message['message']))
 
         if state == "Succeeded":
-            state, error_message, messages, zip_bytes = self._mapi.retrieve_zip(async_process_id)
-            with io.BytesIO(zip_bytes) as zip_file:
+            with tempfile.TemporaryFile() as zip_file:
+                # Documents are extracted from disk, the zip isn't kept in memory while they are written
+                zip_file.write(self._mapi.retrieve_zip(async_process_id)[3])
+                zip_file.seek(0)
                 with zipfile.ZipFile(zip_file, 'r') as zip_file_obj:
-                    zip_file_obj.extractall(path=self._get_loop_dir())
-            os.remove(os.path.join(self._get_loop_dir(), "package.xml"))
+                    # Each request contains its own package.xml
+                    members = [name for name in zip_file_obj.namelist() if name != 'package.xml']
+                    zip_file_obj.extractall(path=self._get_loop_dir(), members=members)
         else:
             raise Exception("Could not retrieve DDP files: {0}".format(error_message))
 
-    def _extract_ddp_name_from_path(self, path):
-        return pathlib.Path(os.path.relpath(path, self._get_data_dir())).parts[0]
-
-    def _delete_non_shared_documents(self):
-        # Create DDP-document and document-DDP maps
-        ddps = dict()
-        documents = dict()
-        for filename in glob.glob(os.path.join(self._get_data_dir(), '**/Files/*.yaml')):
-            ddp_file = yamlhelper.load_one_yaml(filename)
-            doc_id = ddp_file['Loop__Document_ID__c']
-            ddp_name = self._extract_ddp_name_from_path(filename)
-            # Update document-DDP map
-            ddps_temp = documents.get(doc_id, set())
-            ddps_temp.add(ddp_name)
-            documents[doc_id] = ddps_temp
-            # Update DDP-document map
-            doc_temp = ddps.get(ddp_name, set())
-            doc_temp.add(doc_id)
-            ddps[ddp_name] = doc_temp
-        # Loop over DDPs that are being pulled down and figure out which ones can be deleted
-        documents_to_delete = set()
-        for ddp_name in self._kwargs['ddp']:
-            if ddp_name not in ddps:
-                continue
-            for doc_id in ddps[ddp_name]:
-                doc_temp = documents[doc_id]
-                doc_temp.remove(ddp_name)
-                documents[doc_id] = doc_temp
-                if len(doc_temp) == 0:
-                    documents_to_delete.add(doc_id)
-        # Delete documents
-        for doc_id in documents_to_delete:
-            for filename in glob.glob(os.path.join(self._get_docs_dir(), "{0}*".format(doc_id))):
-                if os.path.exists(filename):
-                    self._logger.info("    {0}".format(filename))
-                    os.remove(filename)
-
     def _prep_working_directory(self):
         loop_dir = self._get_loop_dir()
         data_dir = self._get_data_dir()
 
-        # Delete DDP directories (so deleted records don't persist after export)
-        if os.path.exists(data_dir) and os.path.isdir(data_dir):
-            if 'ddp' in self._kwargs:
-                # Delete documents that aren't shared with documents not being pulled down
-                self._logger.info("  Deleting old documents ...")
-                self._delete_non_shared_documents()
-
-                # Delete DDP directories listed in the command line
-                self._logger.info("  Deleting old data directories ...")
-                for ddp_name in self._kwargs['ddp']:
-                    ddp_dir_name = self._get_ddp_data_dir_name(ddp_name)
-                    if os.path.exists(ddp_dir_name) and os.path.isdir(ddp_dir_name):
-                        self._logger.info("    {0}".format(ddp_dir_name))
-                        shutil.rmtree(ddp_dir_name, ignore_errors=True)
-            else:
-                # Delete data and documents directory if we pull down all DDPs
-                shutil.rmtree(loop_dir, ignore_errors=True)
-
+        # Data files and documents are overwritten only if they have changed
+        # Files of deleted records and unused documents are removed after export
         if not os.path.exists(loop_dir):
             self._logger.info("  Creating new source directory {0} ...".format(loop_dir))
             os.mkdir(loop_dir)
@@ -359,12 +504,16 @@ class DdpExport(DdpCommandBase):
             os.mkdir(data_dir)
 
     def do(self):
-        self._logger.info("==> Preparing working directory ...")
-        self._prep_working_directory()
-
         self._logger.info("==> Connecting to Salesforce using {0} account ...".format(self._kwargs['username']))
         self._create_sfdc_session()
 
+        # State of the previous export is kept per org
+        if self._kwargs.get('incremental', False):
+            self._load_export_state()
+
+        self._logger.info("==> Preparing working directory ...")
+        self._prep_working_directory()
+
         self._logger.info("==> Exporting data ...")
         self._export_data()
 
@@ -1,13 +1,16 @@
 from commands.ddpcommandbase import DdpCommandBase
 from helpers import csvhelper, yamlhelper
+from helpers.manifest import FileManifest
+from helpers.table import Table
 
-import copy
+import concurrent.futures
 import glob
+import hashlib
 import os
+import re
 import shutil
 import subprocess
 import tempfile
-import time
 import zipfile
 
 
@@ -21,90 +24,90 @@ class DdpImport(DdpCommandBase):
 </Package>
 """
 
+    # Record IDs are returned by the API in 18 characters long form, files may contain 15 characters long ones
+    _RECORD_ID_RE = re.compile(r'^[a-zA-Z0-9]{15}([a-zA-Z0-9]{3})?$')
+
     """ Class handling import command """
     def __init__(self, settings, **kwargs):
         super().__init__(settings, **kwargs)
+        # Tables in 'Table name': Table format
         self._data = dict()
-        self._data_tempdir = None
         self._file_tempdir = None
-        self._import_tempdir = None
         self._data_changes = {'modified': list(), 'added': list()}
         self._file_changes = {'modified': list(), 'added': list()}
         self._changed_tables = dict()
         self._loaded_tables = list()
+        # Future of the document deployment running in the background
+        self._file_deployment = None
+        # Hashes of files imported into the org, used when neither baseline nor DDPs are specified
+        self._manifest = None
+        # Record IDs of upserted or exported rows in 'Table name': {'Unique key': 'Record Id'} format
+        self._guids_to_ids = dict()
+        # Current values of records in the org in 'Table name': Table keyed by unique key format
+        self._org_rows = dict()
+        # Records removed from the source directory are found by their parents
+        for table_name, table_settings in self._table_settings.items():
+            if table_settings.get('sync-on-import', False) and 'parent-relationship' not in table_settings:
+                raise Exception("sync-on-import requires parent-relationship settings of {0} table".format(table_name))
 
     def _find_new_and_changed_files(self):
-        # Find added or modified files using git diff
+        """ Yields (status, file name) of files added or modified since the baseline commit """
+        # Find added or modified files using one git diff, paths are NUL-delimited and never quoted or escaped
         args = [
             "git",
             "diff",
+            "-z",
             "--no-renames",
+            "--relative",
             "--name-status",
             "--diff-filter=AM",
             "{0}..HEAD".format(self._kwargs['baseline']),
-            "."
+            "--",
+            self._get_relative_loop_dir()
         ]
-        output_bytes = subprocess.check_output(args, cwd=self._get_loop_dir())
-        self._process_git_diff_output(output_bytes)
-
-    def _process_git_diff_output(self, output_bytes):
-        # Convert escaped unicode characters to utf-8, then to latin_1, then to utf-8 again
-        # b'Ench\\303\\250res' -> u'Ench\xc3\xa8res' -> b'Ench\xc3\xa8res' -> u'Enchères'
-        output = output_bytes.decode('unicode_escape').encode('latin_1').decode('utf-8')
-
-        # Parse the output to extract file names and their statuses
-        for line in output.split('\n'):
-            # Skip empty lines
-            if line.strip() == '':
-                continue
-            # Extract letter and file name
-            mod, filename = line.split('\t')
-            if mod not in ['A', 'M']:
-                raise Exception("Unexpected status: {0}".format(mod))
-            # Trim double-quotes
-            if filename[0] == '"':
-                filename = filename[1:-1]
-            full_filename = os.path.normpath(filename)
-            # Add file to corresponding change group
-            if full_filename.startswith(self._get_relative_data_dir()):
-                if mod == 'M':
-                    self._data_changes['modified'].append(full_filename)
-                else:
-                    self._data_changes['added'].append(full_filename)
-            else:
-                if mod == 'M':
-                    self._file_changes['modified'].append(full_filename)
-                else:
-                    self._file_changes['added'].append(full_filename)
-
-    def _fake_new_files_for_ddp_list(self):
-        # Add data files to the list of changed/new files first
-        temp_dir = tempfile.TemporaryDirectory()
+        process = subprocess.Popen(args, cwd=self._source_dir, stdout=subprocess.PIPE)
+        with process.stdout:
+            fields = self._read_nul_delimited(process.stdout)
+            for mod in fields:
+                if mod not in ['A', 'M']:
+                    raise Exception("Unexpected status: {0}".format(mod))
+                yield mod, os.path.normpath(next(fields))
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
+
+    @staticmethod
+    def _read_nul_delimited(stream, chunk_size=65536):
+        """ Yields NUL-terminated fields of a binary stream as they arrive """
+        remainder = b''
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            fields = (remainder + chunk).split(b'\0')
+            remainder = fields.pop()
+            for field in fields:
+                yield os.fsdecode(field)
+        if len(remainder) > 0:
+            yield os.fsdecode(remainder)
+
+    def _find_files_for_ddp_list(self):
+        """ Yields ('A', file name) of all data files of requested DDPs and documents referenced by their files """
         for ddp in self._kwargs['ddp']:
-            # Find added files using git diff
-            args = [
-                "git",
-                "diff",
-                "--no-index",
-                "--name-status",
-                "--diff-filter=AM",
-                temp_dir.name,
-                "{0}\\{1}".format(self._get_relative_data_dir(), ddp)
-            ]
-            try:
-                # We expect this command to fail (exit code 1). This is how git diff works
-                subprocess.check_output(args, cwd=self._source_dir)
-            except subprocess.CalledProcessError as ex:
-                self._process_git_diff_output(ex.output)
-        temp_dir.cleanup()
-        # Find new files in Files directories, extract Loop__Document_ID__c field and add it to changed files
-        for data_file in self._data_changes['added']:
-            if '\\Files\\' in data_file:
-                ddp_file = self._extract_ddp_file_name(data_file)
-                wildcard = os.path.join(self._source_dir, *[self._get_relative_docs_dir(), "{0}*".format(ddp_file)])
-                for file_name in glob.glob(wildcard):
-                    full_filename = os.path.relpath(os.path.normpath(file_name), self._source_dir)
-                    self._file_changes['added'].append(full_filename)
+            ddp_dir = os.path.join(self._get_relative_data_dir(), ddp)
+            if not os.path.isdir(os.path.join(self._source_dir, ddp_dir)):
+                raise Exception("Could not find DDP {0} in {1} directory".format(ddp, self._get_relative_data_dir()))
+            for dir_path, dir_names, file_names in os.walk(os.path.join(self._source_dir, ddp_dir)):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    data_file = os.path.relpath(os.path.join(dir_path, file_name), self._source_dir)
+                    yield 'A', data_file
+                    # Documents of new files are added to changed files using Loop__Document_ID__c field
+                    if self._extract_table_name_from_path(data_file) == 'Loop.Loop__DDP_File__c':
+                        yield from self._find_ddp_file_documents(data_file)
+
+    def _find_ddp_file_documents(self, data_file):
+        """ Yields ('A', file name) of the document and its meta file referenced by DDP file """
+        ddp_file = self._extract_ddp_file_name(data_file)
+        wildcard = os.path.join(self._source_dir, *[self._get_relative_docs_dir(), "{0}*".format(ddp_file)])
+        for file_name in sorted(glob.glob(wildcard)):
+            yield 'A', os.path.relpath(os.path.normpath(file_name), self._source_dir)
 
     def _extract_ddp_file_name(self, file_name):
         obj = yamlhelper.load_one_yaml(os.path.join(self._source_dir, file_name))
@@ -141,63 +144,95 @@ class DdpImport(DdpCommandBase):
             self._copy_file_to_temp(filename)
 
     def _create_temp_dirs(self):
-        self._data_tempdir = tempfile.TemporaryDirectory()
-        self._import_tempdir = os.path.join(self._data_tempdir.name, "import")
-        os.mkdir(self._import_tempdir)
         self._file_tempdir = tempfile.TemporaryDirectory()
 
+    def _is_manifest_mode(self):
+        return 'ddp' not in self._kwargs and 'baseline' not in self._kwargs
+
+    def _get_manifest_file_name(self):
+        """ Returns name of the manifest file, manifest is kept per org and source directory """
+        source_dir_hash = hashlib.sha1(os.path.abspath(self._source_dir).encode('utf-8')).hexdigest()
+        return os.path.join(
+            os.path.expanduser(self._reference_cache_dir), *[
+                self._get_org_id(),
+                "import-manifest-{0}.json".format(source_dir_hash)])
+
+    def _find_files_changed_since_last_import(self):
+        """ Yields (status, file name) of files added or modified since the last import into the org """
+        file_names = list()
+        for dir_path, dir_names, dir_file_names in os.walk(self._get_loop_dir()):
+            dir_names.sort()
+            file_names.extend(os.path.relpath(os.path.join(dir_path, file_name), self._source_dir)
+                              for file_name in sorted(dir_file_names))
+        self._manifest = FileManifest(self._get_manifest_file_name())
+        yield from self._manifest.find_changes(self._source_dir, file_names)
+
     def _calculate_delta(self):
         self._create_temp_dirs()
         if 'ddp' in self._kwargs:
-            self._fake_new_files_for_ddp_list()
+            changed_files = self._find_files_for_ddp_list()
+        elif 'baseline' in self._kwargs:
+            changed_files = self._find_new_and_changed_files()
         else:
-            self._find_new_and_changed_files()
-        self._find_changed_tables()
+            changed_files = self._find_files_changed_since_last_import()
+        # Files are classified as they are found
+        for mod, file_name in changed_files:
+            self._add_changed_file(mod, file_name)
         self._generate_file_delta()
 
-    def _find_changed_tables(self):
-        file_names = self._data_changes['added'] + self._data_changes['modified']
-        for file_name in file_names:
-            self._logger.info("Processing: {0}".format(file_name))
-            tail = os.path.basename(file_name)
-            if not tail.endswith('.yaml'):
-                raise Exception(".yaml extension was expected")
+    def _add_changed_file(self, mod, file_name):
+        """ Adds file to corresponding change group and data files to changed tables """
+        changes = self._data_changes if file_name.startswith(self._get_relative_data_dir()) else self._file_changes
+        changes['modified' if mod == 'M' else 'added'].append(file_name)
+        if changes is self._data_changes:
+            self._add_changed_table(file_name)
 
-            table_name = self._extract_table_name_from_path(file_name)
+    def _add_changed_table(self, file_name):
+        self._logger.info("Processing: {0}".format(file_name))
+        tail = os.path.basename(file_name)
+        if not tail.endswith('.yaml'):
+            raise Exception(".yaml extension was expected")
 
-            if table_name not in self._changed_tables and table_name not in self._table_settings:
-                raise Exception("Settings for table {0} are missing".format(table_name))
+        table_name = self._extract_table_name_from_path(file_name)
 
-            if table_name not in self._changed_tables:
-                self._changed_tables[table_name] = list()
-            self._changed_tables[table_name].append(file_name)
+        if table_name not in self._changed_tables and table_name not in self._table_settings:
+            raise Exception("Settings for table {0} are missing".format(table_name))
 
-    def _load_changed_rows(self, changed_rows):
-        """ Loads YAML from temporary data/delta directory and converts it to CSV """
-        header, rows = yamlhelper.load_multiple_yaml(changed_rows, self._unique_key, self._source_dir)
-        return {
-            'header': header,
-            'rows': rows
-        }
+        if table_name not in self._changed_tables:
+            self._changed_tables[table_name] = list()
+        self._changed_tables[table_name].append(file_name)
 
-    def _export_parent_table_ids(self, table_name):
-        parent_namespace, parent_object = \
-            self._table_settings[table_name]['parent-relationship']['parent-table'].split('.')
+    def _load_changed_rows(self, changed_rows):
+        """ Loads YAML files into a table """
+        return yamlhelper.load_multiple_yaml(changed_rows, self._unique_key, self._source_dir)
+
+    def _export_parent_table_ids(self, table_name, guids):
+        """ Returns map 'Unique key': 'Record Id' of parent records
+            IDs of records upserted by this run are known already, only the rest is exported """
+        parent_table = self._table_settings[table_name]['parent-relationship']['parent-table']
+        parent_namespace, parent_object = parent_table.split('.')
         parent_unique_key = self._table_settings[table_name]['parent-relationship']['parent-field']
-        query = 'SELECT Id,{0} FROM {1}'.format(parent_unique_key, parent_object)
-        self._logger.info("      Exporting {0} object from Salesforce ...".format(parent_object))
-        parent_raw_data = self._retrieve_data(parent_object, query)
-        return csvhelper.load_csv_with_one_id_key(parent_raw_data, parent_unique_key)
+        known_ids = self._guids_to_ids.setdefault(parent_table, dict())
+        unknown_guids = sorted(guid for guid in set(guids) if guid != '' and guid not in known_ids)
+        if len(unknown_guids) > 0:
+            query = 'SELECT Id,{0} FROM {1}'.format(parent_unique_key, parent_object)
+            self._logger.info("      Exporting {0} record(s) of {1} object from Salesforce ...".format(
+                len(unknown_guids), parent_object))
+            parent_header, parent_rows = self._retrieve_table_in_chunks(
+                parent_object, query, 'Id', parent_unique_key, unknown_guids)
+            if len(parent_rows) > 0:
+                unique_key_index = parent_header.index(parent_unique_key)
+                for record_id, row in parent_rows.items():
+                    known_ids[row[unique_key_index]] = record_id
+        return {guid: known_ids[guid] for guid in guids if guid in known_ids}
 
     def _update_lookup_field_values(self, table_name, lookup_field):
-        parent_header, parent_rows = self._export_parent_table_ids(table_name)
-        lookup_field_index = self._data[table_name]['header'].index(lookup_field)
-        rows = self._data[table_name]['rows']
-        for row_id in rows:
-            row_list = list(rows[row_id])
-            id_value = parent_rows[row_list[lookup_field_index]][0]
-            row_list[lookup_field_index] = id_value
-            rows[row_id] = tuple(row_list)
+        table = self._data[table_name]
+        parent_ids = self._export_parent_table_ids(table_name, table.column(lookup_field))
+        for guid in table.column(lookup_field):
+            if guid not in parent_ids:
+                raise Exception("Could not find parent record [{0}] of {1} table".format(guid, table_name))
+        table.set_column(lookup_field, [parent_ids[guid] for guid in table.column(lookup_field)])
 
     def _load_table(self, table_name):
         """ Loads table and its parents if applicable and converts values """
@@ -221,32 +256,21 @@ class DdpImport(DdpCommandBase):
         if 'retry-failed' in self._table_settings[table_name]['field-handlers'][field_name]:
             is_retry_failed = bool(self._table_settings[table_name]['field-handlers'][field_name]['retry-failed'])
         handler_class = self._locate_handler_class(handler_class_name)
+        # Handlers looking up documents need IDs of the deployed ones
+        if 'Document' in handler_class.tables_referenced_by_encode():
+            self._wait_for_file_deployment()
         handler = handler_class(self._data[table_name], field_name, is_retry_failed)
         # Check whether handler class needs any other tables to be loaded
         tables_to_load = handler.tables_required_by_encode()
-        required_data = dict()
-        for table_to_load in tables_to_load:
-            self._logger.info("      Exporting {0} object from Salesforce ...".format(table_to_load))
-            raw_data = self._retrieve_data(table_to_load, tables_to_load[table_to_load]['query'])
-            header, rows = csvhelper.load_csv_with_one_id_key(raw_data, tables_to_load[table_to_load]['id'])
-            required_data[table_to_load] = {
-                'header': header,
-                'rows': rows
-            }
-        handler.set_required_data(required_data)
+        handler.set_required_data(self._retrieve_required_data(tables_to_load))
         # Convert values
         handler.encode()
 
-        return handler.get_encoded_rows()
-
-    def _save_table_as_csv(self, table_name, encoded_rows):
-        csvhelper.save_csv(
-            os.path.join(self._import_tempdir, table_name),
-            self._data[table_name]['header'],
-            encoded_rows)
+        return handler
 
     def _convert_field_values(self, table_name):
-        is_retry_failed = False
+        """ Converts values of the whole table, returns handlers which could not convert some of the rows """
+        retry_handlers = list()
         table_settings = self._table_settings[table_name]
         # Replace IDs with external IDs (lookup fields) and handle special fields
         self._logger.info("  Translating IDs in table {0} ...".format(table_name))
@@ -257,16 +281,153 @@ class DdpImport(DdpCommandBase):
             self._logger.info("    Field: {0}".format(lookup_field))
             self._update_lookup_field_values(table_name, lookup_field)
 
-        encoded_rows = dict()
         # Execute special field handlers
         if 'field-handlers' in table_settings:
             for field_name in table_settings['field-handlers']:
                 self._logger.info("    Field: {0}".format(field_name))
-                if 'retry-failed' in table_settings['field-handlers'][field_name]:
-                    is_retry_failed |= bool(table_settings['field-handlers'][field_name]['retry-failed'])
-                encoded_rows = self._encode_field(table_name, field_name)
+                handler = self._encode_field(table_name, field_name)
+                if handler.should_retry():
+                    retry_handlers.append(handler)
+
+        return retry_handlers
+
+    def _find_row_dependencies(self, table_name, retry_handlers):
+        """ Returns rows which could not be converted in 'Row ID': {'Referenced row ID', ...} format """
+        table = self._data[table_name]
+        dependencies = dict()
+        for handler in retry_handlers:
+            missing_values = handler.get_missing_values()
+            for row_id in handler.get_retry_row_ids():
+                parents = dependencies.setdefault(row_id, set())
+                for value in missing_values.get(row_id, set()):
+                    # Referenced record is neither in Salesforce nor in the rows being imported
+                    if value not in table:
+                        raise Exception("Could not convert value [{0}] in row {1}".format(value, row_id))
+                    parents.add(value)
+        return dependencies
+
+    @staticmethod
+    def _order_pending_rows(dependencies):
+        """ Splits rows into import passes so that rows are imported after the rows they reference
+            Dependencies are in 'Row ID': {'Referenced row ID', ...} format, returns list of lists of row IDs """
+        # Rows referencing rows outside of dependencies are imported by the first pass
+        remaining = {
+            row_id: set(parent for parent in parents if parent in dependencies)
+            for row_id, parents in dependencies.items()
+        }
+        passes = list()
+        while len(remaining) > 0:
+            ready = sorted(row_id for row_id, parents in remaining.items() if len(parents) == 0)
+            if len(ready) == 0:
+                raise Exception("Circular reference between rows: {0}".format(', '.join(sorted(remaining))))
+            passes.append(ready)
+            for row_id in ready:
+                del remaining[row_id]
+            for parents in remaining.values():
+                parents.difference_update(ready)
+        return passes
+
+    def _encode_pending_rows(self, table_name, handlers_to_rows, row_ids, imported_ids):
+        """ Converts values of rows skipped by previous passes using IDs of records imported by the last pass """
+        namespace, dev_name = table_name.split('.')
+        table = self._data[table_name]
+        header = table.header
+        created_rows = dict()
+        for row_id, record_id in imported_ids.items():
+            values = dict(zip(header, table.row(row_id)))
+            values[self._unique_key] = row_id
+            created_rows[record_id] = values
+
+        pass_row_ids = set(row_ids)
+        for handler, handler_row_ids in handlers_to_rows:
+            if not handler.add_required_rows(dev_name, created_rows):
+                # Reference table contains columns which are not known locally, load it again
+                handler.set_required_data(self._retrieve_required_data(handler.tables_required_by_encode()))
+            handler.encode_rows([row_id for row_id in row_ids if row_id in handler_row_ids & pass_row_ids])
+            if handler.should_retry():
+                raise Exception("Could not convert {0} row(s) of {1} table: {2}".format(
+                    len(handler.get_retry_row_ids()), table_name, ', '.join(sorted(handler.get_retry_row_ids()))))
+
+    def _import_rows(self, table_name, rows):
+        """ Upserts rows and returns map 'Unique key': 'Record Id' of upserted records """
+        if len(rows) == 0:
+            return dict()
+        rows, ids = self._skip_unchanged_rows(table_name, rows)
+        if len(rows) > 0:
+            self._logger.info("  Upserting {0} row(s) ...".format(len(rows)))
+            ids.update(self._import_table(table_name, rows))
+        return ids
+
+    def _retrieve_org_rows(self, table_name):
+        """ Retrieves current values of all rows of the table which exist in the org """
+        table = self._data[table_name]
+        namespace, dev_name = table_name.split('.')
+        fields = ['Id'] + [field for field in table.header if field != 'Id']
+        if self._unique_key not in fields:
+            fields.append(self._unique_key)
+        query = "SELECT {0} FROM {1}".format(','.join(fields), dev_name)
+        self._logger.info("  Retrieving current values of {0} row(s) ...".format(len(table)))
+        raw_data = self._retrieve_data_in_chunks(dev_name, query, self._unique_key, table.row_ids())
+        id_to_uk, uk_to_id, org_rows = csvhelper.load_csv_with_two_id_keys(raw_data, 'Id', self._unique_key)
+        return uk_to_id, org_rows
+
+    def _get_id_fields(self, table_name):
+        """ Returns fields holding record IDs: the parent lookup and fields encoded by handlers """
+        table_settings = self._table_settings[table_name]
+        id_fields = set(table_settings.get('field-handlers', dict()))
+        if 'parent-relationship' in table_settings:
+            id_fields.add(table_settings['parent-relationship']['field'])
+        return id_fields
+
+    @classmethod
+    def _is_value_up_to_date(cls, value, org_value, is_id_field=False):
+        """ Compares encoded value with the value of the field in the org
+            15 and 18 characters long IDs are equal only in fields holding record IDs """
+        value = '' if value is None else str(value).replace('\r\n', '\n')
+        org_value = org_value.replace('\r\n', '\n')
+        # Bulk API ignores empty values, upsert wouldn't change the field
+        if value == '' or value == org_value:
+            return True
+        if is_id_field and len(value) != len(org_value) and \
+                cls._RECORD_ID_RE.match(value) and cls._RECORD_ID_RE.match(org_value):
+            return value[:15] == org_value[:15]
+        if value.lower() in ('true', 'false'):
+            return value.lower() == org_value.lower()
+        try:
+            return float(value) == float(org_value)
+        except ValueError:
+            return False
+
+    def _skip_unchanged_rows(self, table_name, rows):
+        """ Removes rows which are identical to the records in the org,
+            returns remaining rows and map 'Unique key': 'Record Id' of skipped rows """
+        # Records are deleted before the import, there is nothing to compare with
+        if self._table_settings[table_name]['recreate-on-import']:
+            return rows, dict()
+        # Current values are retrieved once, for all rows of the table
+        if table_name not in self._org_rows:
+            self._org_rows[table_name] = self._retrieve_org_rows(table_name)
+        uk_to_id, org_rows = self._org_rows[table_name]
+        if len(org_rows) == 0:
+            return rows, dict()
+
+        positions = [org_rows.index(field) if org_rows.has_column(field) else None for field in rows.header]
+        id_fields = self._get_id_fields(table_name)
+        are_id_fields = [field in id_fields for field in rows.header]
+        skipped_ids = dict()
+        for row_id, row in rows.items():
+            if row_id not in org_rows:
+                continue
+            org_row = org_rows.row(row_id)
+            if all(position is not None and self._is_value_up_to_date(value, org_row[position], is_id_field)
+                   for value, position, is_id_field in zip(row, positions, are_id_fields)):
+                skipped_ids[row_id] = uk_to_id[row_id]
+        if len(skipped_ids) == 0:
+            return rows, dict()
 
-        return is_retry_failed, encoded_rows
+        self._logger.info("  Skipping {0} row(s) already up to date ...".format(len(skipped_ids)))
+        self._guids_to_ids.setdefault(table_name, dict()).update(skipped_ids)
+        return rows.select_rows([row_id for row_id in rows.row_ids() if row_id not in skipped_ids]), skipped_ids
 
     def _import_data(self):
         """ Loads data, converts values and imports it into Salesforce """
@@ -279,74 +440,101 @@ class DdpImport(DdpCommandBase):
         for table_name in ordered_import_list:
             self._logger.info(" ({0}) {1}...".format(ordered_import_list.index(table_name), table_name))
 
-        # Convert values and import data. Data should be imported in the right order
-        import_order = 0
-        while import_order < len(ordered_import_list):
-            table_name = ordered_import_list[import_order]
-            row_count = len(self._data[table_name]['rows'])
-            self._logger.info("Importing {0} table ({1} row(s))...".format(table_name, row_count))
-            if self._table_settings[table_name]['recreate-on-import']:
-                self._delete_records(table_name)
-            last_count = 0
-            imported_ids = list()
-            while True:
-                rows_backup = copy.deepcopy(self._data[table_name]['rows'])
-                is_retry_failed, encoded_rows = self._convert_field_values(table_name)
-                for index in imported_ids:
-                    if index in encoded_rows:
-                        del encoded_rows[index]
-                self._save_table_as_csv(table_name, encoded_rows)
-                encoded_row_count = len(encoded_rows)
-                self._logger.info("  Upserting {0} row(s) ...".format(encoded_row_count))
-                self._import_table(table_name)
-                imported_ids += list(encoded_rows)
-                last_count += encoded_row_count
-                if not is_retry_failed or last_count == row_count:
-                    break
-                else:
-                    self._logger.info("  Could not import {0} row(s). Will retry ...".format(row_count - last_count))
-                    self._data[table_name]['rows'] = rows_backup
-            import_order += 1
+        # Convert values and import data. Tables are imported after tables they depend on
+        self._run_in_dependency_order(ordered_import_list, self._import_changed_table)
+
+    def _import_changed_table(self, table_name):
+        """ Converts values of one table and imports it into Salesforce """
+        row_count = len(self._data[table_name])
+        self._logger.info("Importing {0} table ({1} row(s))...".format(table_name, row_count))
+        if self._table_settings[table_name]['recreate-on-import']:
+            self._delete_records(table_name)
+        table = self._data[table_name]
+        # Values are converted once, rows referencing records which don't exist yet are left pending
+        retry_handlers = self._convert_field_values(table_name)
+        handlers_to_rows = [(handler, handler.get_retry_row_ids()) for handler in retry_handlers]
+        passes = self._order_pending_rows(self._find_row_dependencies(table_name, retry_handlers))
+        pending_count = sum(len(row_ids) for row_ids in passes)
+        pending_ids = set(row_id for row_ids in passes for row_id in row_ids)
+        imported_ids = self._import_rows(
+            table_name, table.select_rows([row_id for row_id in table.row_ids() if row_id not in pending_ids]))
+        # Every pass resolves rows referencing records created by the previous one
+        for row_ids in passes:
+            self._logger.info("  Could not import {0} row(s). Will retry ...".format(pending_count))
+            self._encode_pending_rows(table_name, handlers_to_rows, row_ids, imported_ids)
+            imported_ids = self._import_rows(table_name, table.select_rows(row_ids))
+            pending_count -= len(row_ids)
+        # Records are upserted in place, only the ones removed from the source directory are deleted
+        if self._table_settings[table_name].get('sync-on-import', False):
+            self._delete_removed_records(table_name)
+
+    def _retrieve_child_records(self, table_name, fields, parent_ids):
+        """ Retrieves records of the table which belong to specified parents """
+        parent_key_field = self._table_settings[table_name]['parent-relationship']['field']
+        parent_ids = sorted(set(parent_ids))
+        # There are no records if parents don't exist yet
+        if len(parent_ids) == 0:
+            return ''
+        # Retrieve children
+        dev_namespace, dev_name = table_name.split('.')
+        query = "SELECT {0} FROM {1}".format(','.join(fields), dev_name)
+        self._logger.info("  Retrieving IDs of existing records ...")
+        return self._retrieve_data_in_chunks(dev_name, query, parent_key_field, parent_ids)
 
     def _delete_records(self, table_name):
         """ Deletes records from specified table based on parent relationship """
-        # Find unique parent IDs
-        parent_ids = list()
-        parent_guids = list()
+        # Records are deleted before conversion, parent lookups still hold unique keys
         parent_key_field = self._table_settings[table_name]['parent-relationship']['field']
-        parent_key_field_index = self._data[table_name]['header'].index(parent_key_field)
-        for row_id, row in self._data[table_name]['rows'].items():
-            if row[parent_key_field_index] not in parent_guids:
-                parent_guids.append(row[parent_key_field_index])
-        # Convert parent GUIDs to record IDs
-        parent_header, parent_rows = self._export_parent_table_ids(table_name)
-        for guid in parent_guids:
-            if guid in parent_rows.keys():
-                parent_ids.append(parent_rows[guid][0])
-        # Abort deletion if there is nothing to delete
-        if len(parent_ids) == 0:
-            return
-        # Retrieve IDs of children
-        dev_namespace, dev_name = table_name.split('.')
-        query = "SELECT Id FROM {0} WHERE {1} IN ('{2}')".format(dev_name, parent_key_field, "','".join(parent_ids))
-        self._logger.info("  Retrieving IDs of old records ...")
-        ids_to_delete = self._retrieve_data(dev_name, query)
+        parent_guids = set(self._data[table_name].column(parent_key_field))
+        parent_ids = self._export_parent_table_ids(table_name, parent_guids).values()
+        ids_to_delete = self._retrieve_child_records(table_name, ['Id'], parent_ids)
         # Abort deletion if there is nothing to delete
         if len(ids_to_delete) == 0:
             return
-        _, rows = csvhelper.load_csv_with_one_id_key(ids_to_delete, 'Id')
+        rows = csvhelper.load_csv_table(ids_to_delete, 'Id')
         # Delete records by IDs
+        dev_namespace, dev_name = table_name.split('.')
         self._logger.info("  Deleting {0} old record(s) ...".format(len(rows)))
-        self._delete_data(dev_name, ids_to_delete)
+        ids_table = Table(['Id'], {record_id: [record_id] for record_id in rows.row_ids()})
+        self._delete_data(dev_name, ids_table)
+
+    def _find_source_guids(self, table_name):
+        """ Returns unique keys of all rows stored in directories of imported rows """
+        guids = set(self._data[table_name].row_ids())
+        for directory in sorted(set(os.path.dirname(file_name) for file_name in self._changed_tables[table_name])):
+            file_names = [os.path.join(directory, file_name)
+                          for file_name in sorted(os.listdir(os.path.join(self._source_dir, directory)))
+                          if file_name.endswith('.yaml')]
+            guids.update(self._load_changed_rows(file_names).row_ids())
+        return guids
+
+    def _delete_removed_records(self, table_name):
+        """ Deletes records of imported rows' parents which are no longer in the source directory """
+        # Rows have been converted already, parent lookups hold record IDs
+        parent_key_field = self._table_settings[table_name]['parent-relationship']['field']
+        raw_data = self._retrieve_child_records(
+            table_name, ['Id', self._unique_key], self._data[table_name].column(parent_key_field))
+        if len(raw_data) == 0:
+            return
+        id_to_uk, uk_to_id, records = csvhelper.load_csv_with_two_id_keys(raw_data, 'Id', self._unique_key)
+        source_guids = self._find_source_guids(table_name)
+        ids_to_delete = sorted(record_id for record_id, guid in id_to_uk.items() if guid not in source_guids)
+        if len(ids_to_delete) == 0:
+            return
+        dev_namespace, dev_name = table_name.split('.')
+        self._logger.info("  Deleting {0} record(s) no longer in the source directory ...".format(len(ids_to_delete)))
+        self._delete_data(dev_name, Table(['Id'], {record_id: [record_id] for record_id in ids_to_delete}))
 
-    def _import_table(self, table_name):
-        with open(os.path.join(self._import_tempdir, table_name), mode='r', encoding='utf-8') as csv_file:
-            csv_data = csv_file.read()
-            csv_file.close()
+    def _import_table(self, table_name, rows):
+        """ Upserts rows streaming them as CSV batches, returns map 'Unique key': 'Record Id' """
         namespace, dev_name = table_name.split('.')
-        status = self._upsert_data(dev_name, csv_data, self._unique_key)
-        if int(status['failed']) > 0:
-            raise Exception("   Could not upsert {0} row(s)\n{1}".format(status['failed'], status['results']))
+        ids, errors = self._upsert_data(dev_name, rows, self._unique_key)
+        if len(errors) > 0:
+            raise Exception("   Could not upsert {0} row(s)\n{1}".format(
+                len(errors), '\n'.join("{0}: {1}".format(row_id, errors[row_id]) for row_id in sorted(errors))))
+        # Child tables look up IDs of their parents here instead of exporting them
+        self._guids_to_ids.setdefault(table_name, dict()).update(ids)
+        return ids
 
     def _create_package_xml(self):
         package_xml = self._PACKAGE_XML_START
@@ -377,6 +565,30 @@ class DdpImport(DdpCommandBase):
         zip_file.close()
         return zip_temp_file
 
+    def _check_deploy_status(self, deployment_id):
+        """ Logs deployment progress, returns (state, is_done, state) tuple expected by JobPoller """
+        deployment_state, state_detail, deployment_detail, unit_test_detail = \
+            self._mapi.check_deploy_status(deployment_id)
+        if state_detail is None:
+            self._logger.info("  State: {0}".format(deployment_state))
+        else:
+            if int(deployment_detail['deployed_count']) + \
+                    int(deployment_detail['failed_count']) < \
+                    int(deployment_detail['total_count']):
+                progress = "(%s/%s) " % (
+                    deployment_detail['deployed_count'] +
+                    deployment_detail['failed_count'],
+                    deployment_detail['total_count']
+                )
+            else:
+                progress = "(%s/%s) " % (
+                    unit_test_detail['completed_count'],
+                    unit_test_detail['total_count']
+                )
+
+            self._logger.info("  State: {0} - {1}{2}".format(deployment_state, progress, state_detail))
+        return deployment_state, deployment_state not in ['Queued', 'Pending', 'InProgress'], deployment_state
+
     def _import_files(self):
         # Create package.xml file
         self._create_package_xml()
@@ -388,42 +600,44 @@ class DdpImport(DdpCommandBase):
         }
         deployment_id, deployment_state = self._mapi.deploy(zip_file, options)
         self._logger.info("  State: {0}".format(deployment_state))
-        while deployment_state in ['Queued', 'Pending', 'InProgress']:
-            time.sleep(5)
-            deployment_state, state_detail, deployment_detail, unit_test_detail = \
-                self._mapi.check_deploy_status(deployment_id)
-            if state_detail is None:
-                self._logger.info("  State: {0}".format(deployment_state))
-            else:
-                if int(deployment_detail['deployed_count']) + \
-                        int(deployment_detail['failed_count']) < \
-                        int(deployment_detail['total_count']):
-                    progress = "(%s/%s) " % (
-                        deployment_detail['deployed_count'] +
-                        deployment_detail['failed_count'],
-                        deployment_detail['total_count']
-                    )
-                else:
-                    progress = "(%s/%s) " % (
-                        unit_test_detail['completed_count'],
-                        unit_test_detail['total_count']
-                    )
-
-                self._logger.info("  State: {0} - {1}{2}".format(deployment_state, progress, state_detail))
+        deployment_state = self._job_poller.wait("deploy documents", lambda: self._check_deploy_status(deployment_id))
 
         if deployment_state != 'Succeeded':
             raise Exception('Deployment of documents failed')
 
-    def do(self):
-        self._logger.info("==> Calculating delta ...")
-        self._calculate_delta()
+        # Deployed documents have new IDs or modification stamps
+        self._invalidate_reference_data('Document')
+
+    def _wait_for_file_deployment(self):
+        """ Blocks until documents are deployed, re-raises deployment errors """
+        if self._file_deployment is not None:
+            self._file_deployment.result()
 
+    def do(self):
+        # Manifest is kept per org so the org has to be known before calculating delta
+        if self._is_manifest_mode():
+            self._connect()
+            self._logger.info("==> Calculating delta since the last import ...")
+            self._calculate_delta()
+        else:
+            self._logger.info("==> Calculating delta ...")
+            self._calculate_delta()
+            self._connect()
+
+        # Documents are deployed in the background, only Loop__DDP_File__c references Document Id and waits for them
+        self._logger.info("==> Importing documents and data ...")
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._file_deployment = executor.submit(self._import_files)
+        try:
+            self._import_data()
+            self._wait_for_file_deployment()
+        finally:
+            executor.shutdown()
+
+        # Files are recorded only after everything has been imported, failed imports are repeated next time
+        if self._manifest is not None:
+            self._manifest.save()
+
+    def _connect(self):
         self._logger.info("==> Connecting to Salesforce using {0} account ...".format(self._kwargs['username']))
         self._create_sfdc_session()
-
-        # Documents need to be imported first so we can reference Document Id in Loop__DDP_File__c
-        self._logger.info("==> Importing documents ...")
-        self._import_files()
-
-        self._logger.info("==> Importing data ...")
-        self._import_data()
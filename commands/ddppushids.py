@@ -1,95 +1,91 @@
 from commands.ddpcommandbase import DdpCommandBase
 from helpers import csvhelper, yamlhelper
+from helpers.table import Table
 
 import os
 import subprocess
-import tempfile
 
 
 class DdpPushIds(DdpCommandBase):
     """ Class handling export command """
     def __init__(self, settings, **kwargs):
         super().__init__(settings, **kwargs)
+        # Tables loaded from Salesforce in 'Table name': Table format, rows are keyed by name tuples
         self._data = dict()
+        # Tables loaded from the source directory in 'Table name': Table format, rows are keyed by unique key
+        self._src_data = dict()
+        # Maps in 'Table name': {'Id': name tuple} and 'Table name': {name tuple: 'Id'} formats
+        self._ids_to_names = dict()
+        self._names_to_ids = dict()
         self._ddp_ids = None
 
-    def _select_latest_rows(self, table_name, header, rows, names, select_empty_ext_id_only):
-        names_to_ids = dict()
-        latest_rows = dict()
-        name_indexes = list()
+    def _select_latest_rows(self, table_name, table, names, select_empty_ext_id_only):
+        latest_row_ids = dict()
+        if len(table) == 0:
+            return Table(table.header), dict(), dict()
 
-        last_modified_index = header.index('LastModifiedDate')
+        last_modified_dates = table.column('LastModifiedDate')
+        name_columns = list()
         for name in names:
-            name_indexes.append(header.index(name))
+            name_columns.append(table.column(name))
 
         # Append parent's unique key for child tables
         if 'parent-relationship' in self._table_settings[table_name]:
-            name_indexes.append(header.index(self._table_settings[table_name]['parent-relationship']['field']))
-
-        for row_id in rows:
-            row = rows[row_id]
-
-            keys = list()
-            for name_index in name_indexes:
-                keys.append(row[name_index])
-
-            key_tuple = tuple(keys)
-            if key_tuple in latest_rows:
-                if DdpCommandBase._convert_sfdc_date_time(row[last_modified_index]) < \
-                   DdpCommandBase._convert_sfdc_date_time(latest_rows[key_tuple][last_modified_index]):
+            name_columns.append(table.column(self._table_settings[table_name]['parent-relationship']['field']))
+
+        for position, row_id in enumerate(table.row_ids()):
+            key_tuple = tuple(name_column[position] for name_column in name_columns)
+            if key_tuple in latest_row_ids:
+                latest_position = latest_row_ids[key_tuple][0]
+                if DdpCommandBase._convert_sfdc_date_time(last_modified_dates[position]) < \
+                   DdpCommandBase._convert_sfdc_date_time(last_modified_dates[latest_position]):
                     continue
-            latest_rows[key_tuple] = row
-            names_to_ids[key_tuple] = row_id
+            latest_row_ids[key_tuple] = (position, row_id)
 
         # If overwrite option is not set. Do not update records that have GUID field already populated
         if select_empty_ext_id_only:
-            key_tuples_to_remove = list()
-            guid_index = header.index(self._unique_key)
-            for key_tuple in latest_rows:
-                if latest_rows[key_tuple][guid_index] != '':
-                    key_tuples_to_remove.append(key_tuple)
-            for key_tuple in key_tuples_to_remove:
-                del latest_rows[key_tuple]
-                del names_to_ids[key_tuple]
-
-        # Create an index Id -> Composite name key
+            guids = table.column(self._unique_key)
+            for key_tuple in [key_tuple for key_tuple, (position, row_id) in latest_row_ids.items()
+                              if guids[position] != '']:
+                del latest_row_ids[key_tuple]
+
+        # Create a table keyed by composite name key and indexes Id -> Composite name key and back
+        latest_rows = Table(table.header)
+        names_to_ids = dict()
         ids_to_names = dict()
-        for key_tuple in names_to_ids:
-            ids_to_names[names_to_ids[key_tuple]] = key_tuple
+        for key_tuple, (position, row_id) in latest_row_ids.items():
+            latest_rows.add_row(key_tuple, table.row(row_id))
+            names_to_ids[key_tuple] = row_id
+            ids_to_names[row_id] = key_tuple
 
         # Return table and additional index
         return latest_rows, ids_to_names, names_to_ids
 
-    def _replace_parent_ids(self, table_name, header, rows):
+    def _replace_parent_ids(self, table_name, table):
         parent_table_name = self._table_settings[table_name]['parent-relationship']['parent-table']
         parent_field_name = self._table_settings[table_name]['parent-relationship']['parent-field']
 
-        parent_header = self._data[parent_table_name]['header']
-        parent_rows = self._data[parent_table_name]['rows']
-        parent_ids_to_name = self._data[parent_table_name]['ids-to-names']
-        parent_field_index = parent_header.index(parent_field_name)
+        parent_table = self._data[parent_table_name]
+        parent_ids_to_name = self._ids_to_names[parent_table_name]
 
         field_name = self._table_settings[table_name]['parent-relationship']['field']
-        field_index = header.index(field_name)
 
         missing_row_ids = list()
-        for row_id in rows:
-            row = rows[row_id]
-            parent_id = row[field_index]
+        parent_guids = list()
+        for row_id, parent_id in zip(table.row_ids(), table.column(field_name)):
             if parent_id not in parent_ids_to_name:
                 missing_row_ids.append(row_id)
+                parent_guids.append(parent_id)
                 continue
-            name_tuple = parent_ids_to_name[parent_id]
-            row[field_index] = parent_rows[name_tuple][parent_field_index]
+            parent_guids.append(parent_table.get(parent_ids_to_name[parent_id], parent_field_name))
+        table.set_column(field_name, parent_guids)
 
         # Remove rows that don't have parent records
-        for row_id in missing_row_ids:
-            del rows[row_id]
+        table.remove_rows(missing_row_ids)
 
     def _get_parent_ids(self, table_name):
         parent_table_name = self._table_settings[table_name]['parent-relationship']['parent-table']
-        parent_ids_to_name = self._data[parent_table_name]['ids-to-names']
-        return list(parent_ids_to_name.keys())
+        return list(self._ids_to_names[parent_table_name].keys())
 
     def _export_unique_keys(self, table_name, select_empty_ext_id_only):
         table_settings = self._table_settings[table_name]
@@ -105,23 +101,14 @@ class DdpPushIds(DdpCommandBase):
         namespace, dev_name = self._parse_table_name(table_name)
         query = "SELECT {0} FROM {1}".format(','.join(fields), dev_name)
         if 'parent-relationship' in table_settings:
-            parent_ids = self._get_parent_ids(table_name)
-            query += " WHERE {0} IN ({1})".format(
-                table_settings['parent-relationship']['field'],
-                "'" + "','".join(parent_ids) + "'"
-            )
-        raw_data = self._retrieve_data(dev_name, query)
-        header, all_rows = csvhelper.load_csv_with_one_id_key(raw_data, 'Id')
-        if 'parent-relationship' in table_settings:
-            self._replace_parent_ids(table_name, header, all_rows)
-        rows, ids_to_names, names_to_ids = self._select_latest_rows(
-            table_name, header, all_rows, names, select_empty_ext_id_only)
-        return {
-            'header': header,
-            'rows': rows,
-            'ids-to-names': ids_to_names,
-            'names-to-ids': names_to_ids
-        }
+            raw_data = self._retrieve_data_in_chunks(
+                dev_name, query, table_settings['parent-relationship']['field'], self._get_parent_ids(table_name))
+        else:
+            raw_data = self._retrieve_data(dev_name, query)
+        all_rows = csvhelper.load_csv_table(raw_data, 'Id')
+        if 'parent-relationship' in table_settings and len(all_rows) > 0:
+            self._replace_parent_ids(table_name, all_rows)
+        return self._select_latest_rows(table_name, all_rows, names, select_empty_ext_id_only)
 
     def _load_data(self):
         """ Loads data from YAML files from the source directory """
@@ -165,91 +152,54 @@ class DdpPushIds(DdpCommandBase):
         # Load data
         for table_name in self._table_settings:
             self._logger.info("  Loading {0} table ...".format(table_name))
-            header, rows = yamlhelper.load_multiple_yaml(files[table_name], self._unique_key, self._source_dir)
-            self._data[table_name] = {
-                'src_header': header,
-                'src_rows': rows
-            }
+            self._src_data[table_name] = yamlhelper.load_multiple_yaml(
+                files[table_name], self._unique_key, self._source_dir)
 
     def _lookup_record_by_name_tuple(self, table_name, name_tuple):
-        if name_tuple in self._data[table_name]['rows']:
+        if name_tuple in self._data[table_name]:
             return name_tuple
 
         return None
 
     def _replace_id_values(self, table_name):
-        src_header = self._data[table_name]['src_header']
-        src_rows = self._data[table_name]['src_rows']
+        src_table = self._src_data[table_name]
+        if len(src_table) == 0:
+            return
 
         table_settings = self._table_settings[table_name]
-        # Find indexes of name columns
+        # Find name columns
         names = table_settings['name']
         if isinstance(names, str):
             names = [names]
-        name_indexes = list()
+        name_columns = list()
         for name in names:
-            name_indexes.append(src_header.index(name))
+            name_columns.append(src_table.column(name))
         if 'parent-relationship' in table_settings:
-            name_indexes.append(src_header.index(table_settings['parent-relationship']['field']))
-
-        header = self._data[table_name]['header']
-        rows = self._data[table_name]['rows']
-        ext_id_index = header.index(self._unique_key)
+            name_columns.append(src_table.column(table_settings['parent-relationship']['field']))
 
-        for ext_id in src_rows:
-            src_row = src_rows[ext_id]
+        table = self._data[table_name]
+        for position, ext_id in enumerate(src_table.row_ids()):
             # Compose name tuple
-            keys = list()
-            for name_index in name_indexes:
-                keys.append(src_row[name_index])
-
-            row_id = self._lookup_record_by_name_tuple(table_name, tuple(keys))
+            row_id = self._lookup_record_by_name_tuple(
+                table_name, tuple(name_column[position] for name_column in name_columns))
             if row_id is None:
                 continue
 
-            row = rows[row_id]
-            row[ext_id_index] = ext_id
+            table.set(row_id, self._unique_key, ext_id)
 
     def _remove_columns(self, table_name, field_names):
-        header = self._data[table_name]['header']
-        field_indexes = list()
-        # Find indexes of fields to be removed
-        for field_name in field_names:
-            field_indexes.append(header.index(field_name))
-
-        # Remove fields from header
-        for field_name in field_names:
-            header.remove(field_name)
-
-        # Remove fields from data
-        rows = self._data[table_name]['rows']
-        for row_id in rows:
-            row = rows[row_id]
-            new_row = list()
-            index = 0
-            while index < len(row):
-                if index not in field_indexes:
-                    new_row.append(row[index])
-                index += 1
-            rows[row_id] = new_row
-
-    def _update_batch(self, table_name, rows):
-        temp_file = tempfile.TemporaryFile(mode='w+', encoding='utf-8', newline='')
-        # Save resulting table as CSV
-        csvhelper.save_csv_with_ids(
-            temp_file.file,
-            self._data[table_name]['header'],
-            rows,
-            self._data[table_name]['names-to-ids']
-        )
-        # Load CSV as text
+        self._data[table_name].remove_columns(field_names)
+
+    def _update_rows(self, table_name, rows):
+        """ Updates rows using one Bulk API job, its batches are processed in parallel """
         namespace, dev_name = table_name.split('.')
-        temp_file.file.seek(0)
-        csv_data = temp_file.read()
         # Update data in Salesforce
-        status = self._update_data(dev_name, csv_data)
-        if int(status['failed']) > 0:
-            raise Exception("    Could not update {0} row(s)\n{1}".format(status['failed'], status['results']))
+        ids, errors = self._update_data(dev_name, rows, self._names_to_ids[table_name])
+        # Report failed rows of all batches at once
+        if len(errors) > 0:
+            names_to_ids = self._names_to_ids[table_name]
+            raise Exception("    Could not update {0} row(s)\n{1}".format(len(errors), '\n'.join(
+                "{0}: {1}".format(names_to_ids[row_id], errors[row_id]) for row_id in sorted(errors))))
 
     def _update_table(self, table_name):
         # Remove all columns but Id and external Id
@@ -263,49 +213,30 @@ class DdpPushIds(DdpCommandBase):
         if 'parent-relationship' in self._table_settings[table_name]:
             field_names.append(self._table_settings[table_name]['parent-relationship']['field'])
         self._remove_columns(table_name, field_names)
-        rows = self._data[table_name]['rows']
-        row_count = 0
-        batch = dict()
-        for row_id in rows:
-            batch[row_id] = rows[row_id]
-            row_count += 1
-            if row_count % self._update_batch_size == 0:
-                self._logger.info("  Updating data in {0} table ({1}/{2}) ...".format(
-                    table_name, row_count, len(rows)))
-                self._update_batch(table_name, batch)
-                batch = dict()
-
-        if len(batch) > 0:
-            if len(batch) == row_count:
-                self._logger.info("  Updating data in {0} table ...".format(table_name))
-            else:
-                self._logger.info("  Updating data in {0} table ({1}/{2}) ...".format(table_name, row_count, len(rows)))
-            self._update_batch(table_name, batch)
+        rows = self._data[table_name]
+        self._logger.info("  Updating data in {0} table ({1} row(s)) ...".format(table_name, len(rows)))
+        self._update_rows(table_name, rows)
 
     def _update_ids(self):
-        # Update external IDs
-        ordered_import_list = self._resolve_import_order(list(self._table_settings.keys()))
-
-        # Update external IDs starting from the parent table
-        import_order = 0
-        while import_order < len(ordered_import_list):
-            table_name = ordered_import_list[import_order]
-            self._logger.info("  Exporting {0} table ...".format(table_name))
-            keys = self._export_unique_keys(table_name, not self._kwargs['overwrite'])
-            self._data[table_name].update(keys)
-
-            if len(self._data[table_name]['rows']) == 0:
-                self._logger.info("  No rows to update")
-            else:
-                # Replace Ids with GUIDs from source directory
-                self._replace_id_values(table_name)
-                # Update data in Salesforce
-                self._update_table(table_name)
-
-            # Download data again so we have GUIDs in memory
-            keys = self._export_unique_keys(table_name, False)
-            self._data[table_name].update(keys)
-            import_order += 1
+        # Update external IDs starting from the parent table, tables are updated after tables they depend on
+        self._run_in_dependency_order(list(self._table_settings.keys()), self._update_table_ids)
+
+    def _update_table_ids(self, table_name):
+        self._logger.info("  Exporting {0} table ...".format(table_name))
+        self._data[table_name], self._ids_to_names[table_name], self._names_to_ids[table_name] = \
+            self._export_unique_keys(table_name, not self._kwargs['overwrite'])
+
+        if len(self._data[table_name]) == 0:
+            self._logger.info("  No rows to update")
+        else:
+            # Replace Ids with GUIDs from source directory
+            self._replace_id_values(table_name)
+            # Update data in Salesforce
+            self._update_table(table_name)
+
+        # Download data again so we have GUIDs in memory
+        self._data[table_name], self._ids_to_names[table_name], self._names_to_ids[table_name] = \
+            self._export_unique_keys(table_name, False)
 
     def do(self):
         self._logger.info("==> Loading data from source directory ...")
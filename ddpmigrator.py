@@ -3,6 +3,7 @@ from helpers.log import setup_custom_logger
 from helpers.yamlhelper import ordered_load
 
 import argparse
+import multiprocessing
 import os
 import sys
 
@@ -31,11 +32,17 @@ def parse_command_line_args():
     parser.add_argument('-s', '--source-dir', type=str, required=True,
                         help='path to directory containing metadata')
     parser.add_argument('-b', '--baseline', type=str,
-                        help='SHA of base commit')
+                        help='SHA of base commit, files changed since the last import into the org are imported '
+                             'if neither baseline nor DDPs are specified')
     parser.add_argument('-d', '--ddp', nargs='*',
                         help='Name of one or more DDPs to be exported')
+    parser.add_argument('-i', '--incremental', dest='incremental', action='store_true',
+                        help='export only records modified since the previous incremental export')
     args = parser.parse_args()
 
+    if args.incremental and (args.command != 'export' or args.ddp):
+        parser.error('--incremental can only be used to export all DDPs')
+
     if args.ddp:
         ddps = list()
         for ddp in args.ddp:
@@ -87,6 +94,8 @@ def main():
     # Choose command class name based on command
     if args.command == 'export':
         from commands.ddpexport import DdpExport
+        if args.incremental:
+            kwargs['incremental'] = True
         class_ = DdpExport
     elif args.command == 'import':
         from commands.ddpimport import DdpImport
@@ -107,4 +116,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # YAML files are loaded in worker processes, they have to start in the packaged executable too
+    multiprocessing.freeze_support()
     main()
@@ -1,5 +1,6 @@
 """ Base field handler class """
 import logging
+import re
 
 
 class FieldHandlerBase:
@@ -8,84 +9,251 @@ class FieldHandlerBase:
     # Hash-tables in 'Table name': 'query' format
     _TABLES_REQUIRED_BY_DECODE = dict()
     _TABLES_REQUIRED_BY_ENCODE = dict()
+    # Hash-table in 'Table name': ('Column', ...) format
+    # Columns compose a natural key used to look up record IDs when encoding values
+    _NATURAL_KEYS = dict()
+    # Hash-tables in 'Table name': 'Field name' format
+    # Reference tables are filtered by values found in the field being translated
+    _DECODE_FILTERS = dict()
+    _ENCODE_FILTERS = dict()
+    # Hash-table in 'Table name': 'Key prefix' format
+    # Values filtering tables by Id must start with the key prefix, names like 'ContactRequests' look like IDs too
+    _KEY_PREFIXES = dict()
+
+    _SALESFORCE_ID_RE = re.compile(r'^[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?$')
+    _QUERY_FIELDS_RE = re.compile(r'^\s*SELECT\s+(.+?)\s+FROM\s', re.IGNORECASE)
 
     def __init__(self, table_data, field_name, is_retry_failed=False):
         self._table_data = table_data
         self._field_name = field_name
         self._required_data = None
         self._is_retry_failed = is_retry_failed
+        # Handlers append IDs of rows which could not be encoded to this list
         self._retry_row_ids = list()
+        # Hash-table in 'Row ID': {'Value', ...} format, values which could not be encoded yet
+        self._missing_values = dict()
+        # Natural key indexes of reference tables in 'Table name': {(Key values): 'Record Id'} format
+        self._key_indexes = dict()
         # Logger
         self._logger = logging.getLogger('root')
 
+    @staticmethod
+    def _convert_distinct_values(values, convert):
+        """ Converts each distinct value once and scatters results back """
+        converted = dict()
+        for value in values:
+            if value not in converted:
+                converted[value] = convert(value)
+        return [converted[value] for value in values]
+
+    def _prepare_decode(self):
+        """ Called once per column before values are decoded, handlers compute column indexes here """
+
     def _decode_one_value(self, value):
         raise NotImplementedError("_decode_one_value method has not been overridden")
 
+    def decode_column(self, values):
+        """ Converts list of sandbox specific values into list of sandbox-independent values (export)
+            Handlers implementing _decode_one_value only get it called once per distinct value """
+        self._prepare_decode()
+        return self._convert_distinct_values(values, self._decode_one_value)
+
     def decode(self):
         """ Converts sandbox specific data into sandbox-independent data (export) """
-        rows = self._table_data['rows']
-        if len(rows) == 0:
+        table = self._table_data
+        if len(table) == 0:
             return
-        header = self._table_data['header']
-        id_index = header.index(self._field_name)
-        for row_id, row in rows.items():
-            decoded_value = self._decode_one_value(row[id_index])
-            row[id_index] = decoded_value
+        table.set_column(self._field_name, self.decode_column(list(table.column(self._field_name))))
+
+    def _prepare_encode(self):
+        """ Called once per column before values are encoded, looks up natural key indexes of reference tables """
+        self._key_indexes = {
+            table_name: self._build_key_index(self._required_data[table_name], tuple(columns))
+            for table_name, columns in self._NATURAL_KEYS.items() if table_name in self._required_data}
 
     def _encode_one_value(self, value, value_row_id):
         raise NotImplementedError("_encode_one_value method has not been overridden")
 
+    def encode_column(self, values, row_ids):
+        """ Converts list of sandbox-independent values into list of sandbox specific values (import)
+            Handlers implementing _encode_one_value only get it called once per distinct value, with ID of the first
+            row holding it. Rows sharing a value with a row marked for retry are marked too """
+        self._prepare_encode()
+        encoded_values = dict()
+        first_row_ids = dict()
+        for value, row_id in zip(values, row_ids):
+            if value not in encoded_values:
+                first_row_ids[value] = row_id
+                encoded_values[value] = self._encode_one_value(value, row_id)
+        retry_row_ids = set(self._retry_row_ids)
+        if len(retry_row_ids) > 0:
+            for value, row_id in zip(values, row_ids):
+                first_row_id = first_row_ids[value]
+                if first_row_id in retry_row_ids and row_id not in retry_row_ids:
+                    retry_row_ids.add(row_id)
+                    self._retry_row_ids.append(row_id)
+                    if first_row_id in self._missing_values:
+                        self._missing_values[row_id] = set(self._missing_values[first_row_id])
+        return [encoded_values[value] for value in values]
+
     def encode(self):
         """ Converts sandbox-independent data into sandbox specific data (import) """
-        rows = self._table_data['rows']
+        table = self._table_data
         self._retry_row_ids = list()
-        header = self._table_data['header']
-        id_index = header.index(self._field_name)
-        for row_id, row in rows.items():
-            encoded_value = self._encode_one_value(row[id_index], row_id)
-            # Tuple can't be updated so create a list, update it and then convert it to tuple
-            row_list = list(row)
-            row_list[id_index] = encoded_value
-            rows[row_id] = tuple(row_list)
+        self._missing_values = dict()
+        if len(table) == 0:
+            return
+        table.set_column(
+            self._field_name,
+            self.encode_column(list(table.column(self._field_name)), table.row_ids()))
+
+    def encode_rows(self, row_ids):
+        """ Converts values of specified rows only, used to retry rows which could not be encoded before """
+        table = self._table_data
+        self._retry_row_ids = list()
+        self._missing_values = dict()
+        row_ids = list(row_ids)
+        values = [table.get(row_id, self._field_name) for row_id in row_ids]
+        for row_id, value in zip(row_ids, self.encode_column(values, row_ids)):
+            table.set(row_id, self._field_name, value)
+
+    @staticmethod
+    def _build_id_index(table):
+        """ Creates an index of 15 characters long IDs -> IDs and stores it in the table """
+        if 'id-index' not in table:
+            id_index = dict()
+            for row_id in table['rows']:
+                # Keep the first matching row the same way linear search did
+                id_index.setdefault(row_id[:15], row_id)
+            table['id-index'] = id_index
+        return table['id-index']
+
+    @staticmethod
+    def _build_key_index(table, columns):
+        """ Creates an index of natural key tuples -> IDs and stores it in the table """
+        key_indexes = table.setdefault('key-indexes', dict())
+        if columns not in key_indexes:
+            key_index = dict()
+            if len(table['rows']) > 0:
+                column_indexes = [table['header'].index(column) for column in columns]
+                for row_id, row in table['rows'].items():
+                    key = tuple(row[column_index] for column_index in column_indexes)
+                    # Keep the first matching row the same way linear search did
+                    key_index.setdefault(key, row_id)
+            key_indexes[columns] = key_index
+        return key_indexes[columns]
+
+    def _lookup_id_by_key(self, table_name, *key_values):
+        """ Returns ID of the record matching natural key declared in _NATURAL_KEYS or None """
+        return self._key_indexes[table_name].get(key_values)
 
     def _is_id_in_list(self, record_id, table_name):
         """ Checks whether 18 or 15 characters long Salesforce ID is in list """
-        for index in self._required_data[table_name]['rows']:
-            if record_id == index \
-               or record_id[:15] == index \
-               or record_id == index[:15] \
-               or record_id[:15] == index[:15]:
-                return True
-        return False
+        return record_id[:15] in self._required_data[table_name]['id-index']
 
     def _get_value_by_id(self, record_id, table_name):
         """ Checks whether 18 or 15 characters long Salesforce ID is in list """
-        for index, row in self._required_data[table_name]['rows'].items():
-            if record_id == index \
-               or record_id[:15] == index \
-               or record_id == index[:15] \
-               or record_id[:15] == index[:15]:
-                return row
-        raise Exception("Could not find {0} record in {1} table".format(record_id, table_name))
+        row_id = self._required_data[table_name]['id-index'].get(record_id[:15])
+        if row_id is None:
+            raise Exception("Could not find {0} record in {1} table".format(record_id, table_name))
+        return self._required_data[table_name]['rows'][row_id]
+
+    @classmethod
+    def _is_salesforce_id(cls, value):
+        return cls._SALESFORCE_ID_RE.match(value) is not None
+
+    def _get_distinct_values(self):
+        """ Returns set of non-empty values of the field being translated """
+        if len(self._table_data) == 0:
+            return set()
+        values = set(self._table_data.column(self._field_name))
+        values.discard('')
+        return values
+
+    def _decode_filter_values(self, table_name, values):
+        """ Converts distinct field values into values of the reference table's filter field """
+        key_prefix = self._KEY_PREFIXES.get(table_name)
+        return set(
+            value for value in values
+            if self._is_salesforce_id(value) and (key_prefix is None or value[:3] == key_prefix))
+
+    def _encode_filter_values(self, table_name, values):
+        """ Converts distinct field values into values of the reference table's filter field """
+        return values
+
+    def _add_filters(self, tables, filters, filter_values):
+        """ Adds 'filter' entry to tables which can be loaded partially """
+        if len(filters) == 0:
+            return tables
+        values = self._get_distinct_values()
+        filtered_tables = dict()
+        for table_name, table in tables.items():
+            if table_name in filters:
+                table = dict(table)
+                table['filter'] = {
+                    'field': filters[table_name],
+                    'values': sorted(filter_values(table_name, values))
+                }
+            filtered_tables[table_name] = table
+        return filtered_tables
+
+    @classmethod
+    def tables_referenced_by_encode(cls):
+        """ Returns names of objects this handler looks up when encoding values """
+        return list(cls._TABLES_REQUIRED_BY_ENCODE)
 
     def tables_required_by_decode(self):
-        return self._TABLES_REQUIRED_BY_DECODE
+        return self._add_filters(self._TABLES_REQUIRED_BY_DECODE, self._DECODE_FILTERS, self._decode_filter_values)
 
     def tables_required_by_encode(self):
-        return self._TABLES_REQUIRED_BY_ENCODE
+        return self._add_filters(self._TABLES_REQUIRED_BY_ENCODE, self._ENCODE_FILTERS, self._encode_filter_values)
 
     def set_required_data(self, required_data):
         self._required_data = required_data
+        for table in self._required_data.values():
+            self._build_id_index(table)
+
+    def add_required_rows(self, table_name, rows):
+        """ Adds records created during import to the reference table
+            Rows are in 'Id': {'Field': value} format. Returns False if the rows don't have all columns of the table """
+        if table_name not in self._required_data:
+            return False
+        table = self._required_data[table_name]
+        header = table['header']
+        if len(header) == 0 and len(table['rows']) == 0:
+            # Empty query result has no header, take column names from the query itself
+            match = self._QUERY_FIELDS_RE.match(self._TABLES_REQUIRED_BY_ENCODE[table_name]['query'])
+            id_key = self._TABLES_REQUIRED_BY_ENCODE[table_name]['id']
+            header = [field.strip() for field in match.group(1).split(',') if field.strip() != id_key]
+        for values in rows.values():
+            if any(column not in values for column in header):
+                return False
+
+        table['header'] = header
+        for record_id, values in rows.items():
+            table['rows'][record_id] = [values[column] for column in header]
+        # Indexes are rebuilt on the next lookup
+        table.pop('id-index', None)
+        table.pop('key-indexes', None)
+        self._build_id_index(table)
+        return True
 
     def get_encoded_rows(self):
-        rows = self._table_data['rows']
+        """ Returns table of rows that have been encoded successfully """
+        table = self._table_data
         if not self._is_retry_failed:
-            return rows
-        encoded_rows = dict()
-        for row_id, row in rows.items():
-            if row_id not in self._retry_row_ids:
-                encoded_rows[row_id] = row
-        return encoded_rows
+            return table
+        retry_row_ids = set(self._retry_row_ids)
+        return table.select_rows([row_id for row_id in table.row_ids() if row_id not in retry_row_ids])
+
+    def get_retry_row_ids(self):
+        """ Returns set of IDs of rows which could not be encoded """
+        return set(self._retry_row_ids)
+
+    def get_missing_values(self):
+        """ Returns values which could not be encoded in 'Row ID': {'Value', ...} format
+            Handlers report them so rows can be retried once the referenced records are imported """
+        return self._missing_values
 
     def should_retry(self):
         if self._is_retry_failed and len(self._retry_row_ids) > 0:
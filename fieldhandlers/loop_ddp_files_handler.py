@@ -19,29 +19,51 @@ class LoopDDPFilesHandler(FieldHandlerBase):
         }
     }
 
+    _NATURAL_KEYS = {
+        'Loop__DDP_File__c': ('DDP_Migrator_Id__c',)
+    }
+
+    _DECODE_FILTERS = {
+        'Loop__DDP_File__c': 'Id'
+    }
+
+    _ENCODE_FILTERS = {
+        'Loop__DDP_File__c': 'DDP_Migrator_Id__c'
+    }
+
+    def _decode_filter_values(self, table_name, values):
+        ddpfile_ids = set()
+        for value in values:
+            ddpfile_ids.update(value.split(';'))
+        return super()._decode_filter_values(table_name, ddpfile_ids)
+
+    def _encode_filter_values(self, table_name, values):
+        ddpfile_guids = set()
+        for value in values:
+            ddpfile_guids.update(value.split(';'))
+        return ddpfile_guids
+
+    def _prepare_decode(self):
+        table = self._required_data['Loop__DDP_File__c']
+        if len(table['rows']) > 0:
+            self._mig_id_index = table['header'].index('DDP_Migrator_Id__c')
+
     def _decode_one_value(self, value):
         """ Converts semi-colon separated list of Loop DDP File IDs into list of DDP File Migrator IDs """
-        header = self._required_data['Loop__DDP_File__c']['header']
-        mig_id_index = header.index('DDP_Migrator_Id__c')
         ddpfile_migratorids = list()
         for ddpfile_id in value.split(';'):
-            if self._is_id_in_list(ddpfile_id, 'Loop__DDP_File__c'):
-                table_name = 'Loop__DDP_File__c'
-            else:
+            if not self._is_id_in_list(ddpfile_id, 'Loop__DDP_File__c'):
                 raise Exception(
                     "Could not find {0} id in Loop__DDP_File__c tables".format(ddpfile_id))
 
-            row = self._get_value_by_id(ddpfile_id, table_name)
-            ddpfile_migratorids.append("{0}".format(row[mig_id_index]))
+            row = self._get_value_by_id(ddpfile_id, 'Loop__DDP_File__c')
+            ddpfile_migratorids.append("{0}".format(row[self._mig_id_index]))
         return ";".join(ddpfile_migratorids)
 
     def _lookup_id_by_name(self, ddpFilesGuid):
-        header = self._required_data['Loop__DDP_File__c']['header']
-        rows = self._required_data['Loop__DDP_File__c']['rows']
-        mig_id_index = header.index('DDP_Migrator_Id__c')
-        for row_id, row in rows.items():
-            if ddpFilesGuid == row[mig_id_index]:
-                return row_id
+        row_id = self._lookup_id_by_key('Loop__DDP_File__c', ddpFilesGuid)
+        if row_id is not None:
+            return row_id
         raise Exception("Could not convert value [{0}]".format(ddpFilesGuid))
 
     def _encode_one_value(self, value, value_row_id):
@@ -27,26 +27,48 @@ class LoopDocumentIdHandler(FieldHandlerBase):
         }
     }
 
-    def _decode_one_value(self, value):
-        # Document table
-        doc_header = self._required_data['Document']['header']
-        doc_row = self._required_data['Document']['rows'][value]
-        doc_dev_name_index = doc_header.index('DeveloperName')
-        doc_folder_id_index = doc_header.index('FolderId')
-        folder_id = doc_row[doc_folder_id_index]
-        # Folder table
-        fol_header = self._required_data['Folder']['header']
-        fol_row = self._required_data['Folder']['rows'][folder_id]
-        fol_namespace_index = fol_header.index('NamespacePrefix')
-        fol_dev_name_index = fol_header.index('DeveloperName')
-        fol_namespace = fol_row[fol_namespace_index]
-
-        if fol_namespace == "":
-            folder_name = fol_row[fol_dev_name_index]
-        else:
-            folder_name = "{0}__{1}".format(fol_namespace, fol_row[fol_dev_name_index])
+    _NATURAL_KEYS = {
+        'Document': ('FolderId', 'DeveloperName'),
+        'Folder': ('NamespacePrefix', 'DeveloperName')
+    }
 
-        return "{0}/{1}".format(folder_name, doc_row[doc_dev_name_index])
+    _DECODE_FILTERS = {
+        'Document': 'Id'
+    }
+
+    _KEY_PREFIXES = {
+        'Document': '015'
+    }
+
+    _ENCODE_FILTERS = {
+        'Document': 'DeveloperName'
+    }
+
+    def _encode_filter_values(self, table_name, values):
+        return set(value.split('/')[-1] for value in values)
+
+    def _prepare_decode(self):
+        # Folder names by folder ID, documents are looked up by their own ID
+        self._documents = self._required_data['Document']
+        if len(self._documents['rows']) > 0:
+            self._doc_dev_name_index = self._documents['header'].index('DeveloperName')
+            self._doc_folder_id_index = self._documents['header'].index('FolderId')
+        self._folder_names = dict()
+        folders = self._required_data['Folder']
+        if len(folders['rows']) > 0:
+            fol_namespace_index = folders['header'].index('NamespacePrefix')
+            fol_dev_name_index = folders['header'].index('DeveloperName')
+            for folder_id, fol_row in folders['rows'].items():
+                fol_namespace = fol_row[fol_namespace_index]
+                if fol_namespace == "":
+                    self._folder_names[folder_id] = fol_row[fol_dev_name_index]
+                else:
+                    self._folder_names[folder_id] = "{0}__{1}".format(fol_namespace, fol_row[fol_dev_name_index])
+
+    def _decode_one_value(self, value):
+        doc_row = self._documents['rows'][value]
+        folder_name = self._folder_names[doc_row[self._doc_folder_id_index]]
+        return "{0}/{1}".format(folder_name, doc_row[self._doc_dev_name_index])
 
     def _lookup_folder_id_by_name(self, folder_name):
         if '__' in folder_name:
@@ -54,27 +76,16 @@ class LoopDocumentIdHandler(FieldHandlerBase):
         else:
             namespace, dev_name = '', folder_name
 
-        # Folder table
-        header = self._required_data['Folder']['header']
-        rows = self._required_data['Folder']['rows']
-        namespace_index = header.index('NamespacePrefix')
-        dev_name_index = header.index('DeveloperName')
-
-        for row_id, row in rows.items():
-            if row[namespace_index] == namespace and row[dev_name_index] == dev_name:
-                return row_id
+        row_id = self._lookup_id_by_key('Folder', namespace, dev_name)
+        if row_id is not None:
+            return row_id
 
         raise Exception("Could not find folder [{0}]".format(folder_name))
 
     def _lookup_document_id_by_name(self, folder_id, dev_name):
-        header = self._required_data['Document']['header']
-        rows = self._required_data['Document']['rows']
-        folder_id_index = header.index('FolderId')
-        dev_name_index = header.index('DeveloperName')
-
-        for row_id, row in rows.items():
-            if row[folder_id_index] == folder_id and row[dev_name_index] == dev_name:
-                return row_id
+        row_id = self._lookup_id_by_key('Document', folder_id, dev_name)
+        if row_id is not None:
+            return row_id
 
         raise Exception("Could not find document [{0}] in folder [{1}]".format(dev_name, folder_id))
 
@@ -19,30 +19,46 @@ class LoopParentObjectHandler(FieldHandlerBase):
         }
     }
 
+    _NATURAL_KEYS = {
+        'Loop__Related_Object__c': ('DDP_Migrator_Id__c',)
+    }
+
+    _DECODE_FILTERS = {
+        'Loop__Related_Object__c': 'Id'
+    }
+
+    _ENCODE_FILTERS = {
+        'Loop__Related_Object__c': 'DDP_Migrator_Id__c'
+    }
+
+    def _encode_filter_values(self, table_name, values):
+        # Only GUID values are converted
+        return set(value for value in values if '-' in value)
+
+    def _prepare_decode(self):
+        table = self._required_data['Loop__Related_Object__c']
+        self._rows = table['rows']
+        if len(self._rows) > 0:
+            self._unique_index = table['header'].index('DDP_Migrator_Id__c')
+
     def _decode_one_value(self, value):
-        if value not in self._required_data['Loop__Related_Object__c']['rows']:
+        if value not in self._rows:
             return value
-        header = self._required_data['Loop__Related_Object__c']['header']
-        row = self._required_data['Loop__Related_Object__c']['rows'][value]
-        unique_index = header.index('DDP_Migrator_Id__c')
-        return row[unique_index]
+        return self._rows[value][self._unique_index]
 
     def _encode_one_value(self, value, value_row_id):
         # Do not convert non-GUID values
         if '-' not in value:
             return value
-        header = self._required_data['Loop__Related_Object__c']['header']
-        rows = self._required_data['Loop__Related_Object__c']['rows']
-        if len(rows) > 0:
-            unique_index = header.index('DDP_Migrator_Id__c')
-            for row_id, row in rows.items():
-                if row[unique_index] == value:
-                    return row_id
+        row_id = self._lookup_id_by_key('Loop__Related_Object__c', value)
+        if row_id is not None:
+            return row_id
 
         if self._is_retry_failed:
+            # Rows referencing missing records will be imported during the next pass
             self._logger.info("        Missing value: {0}".format(value))
-            if value_row_id not in self._retry_row_ids:
-                self._retry_row_ids.append(value_row_id)
+            self._retry_row_ids.append(value_row_id)
+            self._missing_values.setdefault(value_row_id, set()).add(value)
             return value
 
         raise Exception("Could not convert value [{0}]".format(value))
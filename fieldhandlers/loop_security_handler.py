@@ -43,37 +43,78 @@ class LoopSecurityHandler(FieldHandlerBase):
         }
     }
 
+    _NATURAL_KEYS = {
+        'Profile': ('Name',),
+        'PermissionSet': ('Name',),
+        'Group': ('Name',),
+        'UserRole': ('Name',)
+    }
+
+    _DECODE_FILTERS = {
+        'Profile': 'Id',
+        'PermissionSet': 'Id',
+        'Group': 'Id',
+        'UserRole': 'Id'
+    }
+
+    _KEY_PREFIXES = {
+        'Profile': '00e',
+        'PermissionSet': '0PS',
+        'Group': '00G',
+        'UserRole': '00E'
+    }
+
+    _ENCODE_FILTERS = {
+        'Profile': 'Name',
+        'PermissionSet': 'Name',
+        'Group': 'Name',
+        'UserRole': 'Name'
+    }
+
+    def _decode_filter_values(self, table_name, values):
+        security_ids = set()
+        for value in values:
+            for quoted_security_id in value.split(','):
+                security_ids.add(quoted_security_id.replace("'", ""))
+        return super()._decode_filter_values(table_name, security_ids)
+
+    def _encode_filter_values(self, table_name, values):
+        security_names = set()
+        for value in values:
+            for security_name in value.splitlines():
+                security_type, security_value = security_name.split('.', 1)
+                if security_type == table_name:
+                    security_names.add(security_value)
+        return security_names
+
+    def _prepare_decode(self):
+        # Names of security records in 'ID (15 characters long)': 'Table name.Name' format
+        self._security_names = dict()
+        for table_name in ('Profile', 'PermissionSet', 'Group', 'UserRole'):
+            table = self._required_data[table_name]
+            if len(table['rows']) == 0:
+                continue
+            name_index = table['header'].index('Name')
+            for row_id, row in table['rows'].items():
+                self._security_names.setdefault(row_id[:15], "{0}.{1}".format(table_name, row[name_index]))
+
     def _decode_one_value(self, value):
         """ Converts comma-separated list of profile IDs into comma-separated list of profile names """
-        header = self._required_data['Profile']['header']
-        name_index = header.index('Name')
         security_names = list()
         for quoted_profile_id in value.split(','):
             security_id = quoted_profile_id.replace("'", "")
-            if self._is_id_in_list(security_id, 'Profile'):
-                table_name = 'Profile'
-            elif self._is_id_in_list(security_id, 'PermissionSet'):
-                table_name = 'PermissionSet'
-            elif self._is_id_in_list(security_id, 'Group'):
-                table_name = 'Group'
-            elif self._is_id_in_list(security_id, 'UserRole'):
-                table_name = 'UserRole'
-            else:
+            security_name = self._security_names.get(security_id[:15])
+            if security_name is None:
                 raise Exception(
                     "Could not find {0} id in Profile, PermissionSet, Group and UserRole tables".format(security_id))
-
-            row = self._get_value_by_id(security_id, table_name)
-            security_names.append("{0}.{1}".format(table_name, row[name_index]))
+            security_names.append(security_name)
         security_names.sort()
         return "\n".join(security_names)
 
     def _lookup_id_by_name(self, table_name, security_name):
-        header = self._required_data[table_name]['header']
-        rows = self._required_data[table_name]['rows']
-        name_index = header.index('Name')
-        for row_id, row in rows.items():
-            if security_name == row[name_index]:
-                return row_id
+        row_id = self._lookup_id_by_key(table_name, security_name)
+        if row_id is not None:
+            return row_id
         raise Exception("Could not convert value [{0}]".format(security_name))
 
     def _encode_one_value(self, values, value_row_id):
@@ -19,25 +19,24 @@ class RecordTypeIdHandler(FieldHandlerBase):
         }
     }
 
+    _NATURAL_KEYS = {
+        'RecordType': ('NamespacePrefix', 'SobjectType', 'DeveloperName')
+    }
+
+    def _prepare_decode(self):
+        table = self._required_data['RecordType']
+        self._rows = table['rows']
+        if len(self._rows) > 0:
+            self._key_columns = [table['header'].index(column) for column in self._NATURAL_KEYS['RecordType']]
+
     def _decode_one_value(self, value):
-        header = self._required_data['RecordType']['header']
-        row = self._required_data['RecordType']['rows'][value]
-        namespace_index = header.index('NamespacePrefix')
-        s_obj_type_index = header.index('SobjectType')
-        dev_name_index = header.index('DeveloperName')
-        return "{0}.{1}.{2}".format(row[namespace_index], row[s_obj_type_index], row[dev_name_index])
+        row = self._rows[value]
+        return '.'.join(row[column_index] for column_index in self._key_columns)
 
     def _encode_one_value(self, value, value_row_id):
-        header = self._required_data['RecordType']['header']
-        rows = self._required_data['RecordType']['rows']
-        namespace_index = header.index('NamespacePrefix')
-        s_obj_type_index = header.index('SobjectType')
-        dev_name_index = header.index('DeveloperName')
         namespace, s_obj_type, dev_name = value.split('.')
-        for row_id, row in rows.items():
-            if namespace == row[namespace_index] \
-               and s_obj_type == row[s_obj_type_index] \
-               and dev_name == row[dev_name_index]:
-                return row_id
+        row_id = self._lookup_id_by_key('RecordType', namespace, s_obj_type, dev_name)
+        if row_id is not None:
+            return row_id
 
         raise Exception("Could not convert value [{0}]".format(value))
@@ -0,0 +1,47 @@
+""" Adaptive Bulk API batch size """
+from helpers import cachehelper
+
+import threading
+
+
+class BatchSizeController:
+    """ Keeps Bulk API batch size per object
+        Size is halved when Loop triggers hit CPU time limit or lock records and doubled after successful jobs.
+        Last size which worked is saved per object so the next run starts with it """
+
+    def __init__(self, file_name, initial_size, max_size, min_size=1):
+        self._file_name = file_name
+        self._initial_size = initial_size
+        self._max_size = max_size
+        self._min_size = min_size
+        self._lock = threading.Lock()
+        # Hash-tables in 'Object name': size format
+        self._working_sizes = dict()
+        if file_name is not None:
+            self._working_sizes = cachehelper.load_cache(file_name) or dict()
+        self._sizes = dict(self._working_sizes)
+
+    def get(self, object_name):
+        """ Returns batch size to use for the object """
+        with self._lock:
+            return self._sizes.get(object_name, self._initial_size)
+
+    def record_success(self, object_name, size):
+        """ Grows batch size after all batches of the size succeeded """
+        with self._lock:
+            self._sizes[object_name] = min(self._max_size, max(self._sizes.get(object_name, size), size * 2))
+            self._working_sizes[object_name] = size
+            self._save()
+
+    def record_failure(self, object_name, size):
+        """ Shrinks batch size after a batch of the size failed, returns False if it can't be reduced any further
+            Smaller size is used by this run only, it is saved once a job succeeds with it """
+        with self._lock:
+            if size <= self._min_size:
+                return False
+            self._sizes[object_name] = max(self._min_size, size // 2)
+            return True
+
+    def _save(self):
+        if self._file_name is not None:
+            cachehelper.save_cache(self._file_name, self._working_sizes)
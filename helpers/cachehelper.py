@@ -0,0 +1,35 @@
+import hashlib
+import json
+import os
+
+
+def get_cache_file_name(cache_dir, org_id, api_version, object_name, query):
+    """ Returns name of the file caching result of the query in specified org """
+    query_hash = hashlib.sha1(query.encode('utf-8')).hexdigest()
+    return os.path.join(
+        os.path.expanduser(cache_dir), *[
+            org_id,
+            api_version,
+            "{0}-{1}.json".format(object_name, query_hash)])
+
+
+def load_cache(file_name):
+    """ Loads cached table, returns None if the file does not exist or can't be parsed """
+    if not os.path.exists(file_name):
+        return None
+    try:
+        with open(file_name, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except ValueError:
+        return None
+
+
+def save_cache(file_name, data):
+    """ Saves cached table, replaces the file atomically so an interrupted run can't corrupt it """
+    dir_name = os.path.dirname(file_name)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    temp_file_name = "{0}.tmp".format(file_name)
+    with open(temp_file_name, 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+    os.replace(temp_file_name, file_name)
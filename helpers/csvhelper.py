@@ -1,16 +1,32 @@
+from helpers.table import Table
+
 import csv
 import io
 
+# Bulk API limits per batch
+BULK_MAX_BATCH_ROWS = 10000
+BULK_MAX_BATCH_BYTES = 10000000
+
+
+class _LineWriter:
+    """ File-like object keeping the last line written by csv.writer """
+    __slots__ = ('line',)
+
+    def __init__(self):
+        self.line = ''
+
+    def write(self, line):
+        self.line = line
+
 
 def load_csv_with_two_id_keys(csv_text, id_key, unique_key):
-    """ Loads CSV file from a string, creates key1->key2 and key2->key1 maps and removes Id column """
+    """ Loads CSV file from a string into a table keyed by unique key,
+        creates key1->key2 and key2->key1 maps and removes Id column """
     id_to_uk = dict()
     uk_to_id = dict()
-    rows = dict()
-    header = list()
 
     if len(csv_text) == 0:
-        return id_to_uk, uk_to_id, header, rows
+        return id_to_uk, uk_to_id, Table()
 
     stream = io.StringIO(csv_text)
     reader = csv.reader(stream)
@@ -20,6 +36,7 @@ def load_csv_with_two_id_keys(csv_text, id_key, unique_key):
     # Remove Id column from the header
     del header[id_index]
 
+    table = Table(header)
     for row in reader:
         uk = row[uk_index]
         row_id = row[id_index]
@@ -28,9 +45,9 @@ def load_csv_with_two_id_keys(csv_text, id_key, unique_key):
         uk_to_id[uk] = row_id
         # Remove Id column
         del row[id_index]
-        rows[uk] = row
+        table.add_row(uk, row)
 
-    return id_to_uk, uk_to_id, header, rows
+    return id_to_uk, uk_to_id, table
 
 
 def load_csv_with_one_id_key(csv_text, id_key):
@@ -55,47 +72,99 @@ def load_csv_with_one_id_key(csv_text, id_key):
     return header, rows
 
 
-def save_csv(file, header, rows):
-    """ Saves table (header + rows) as CSV file """
-    should_close = True
-    if isinstance(file, str):
-        csv_file = open(file, 'w', encoding='utf-8', newline='')
-    else:
-        csv_file = file
-        should_close = False
+def load_csv_table(csv_text, id_key):
+    """ Loads CSV file from a string into a table keyed by Id """
+    if len(csv_text) == 0:
+        return Table()
 
-    writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+    stream = io.StringIO(csv_text)
+    reader = csv.reader(stream)
+    header = next(reader)
+    id_index = header.index(id_key)
+    # Remove Id column from the header
+    del header[id_index]
+
+    table = Table(header)
+    for row in reader:
+        row_id = row[id_index]
+        # Remove Id column
+        del row[id_index]
+        table.add_row(row_id, row)
+
+    return table
+
+
+def merge_csv(csv_texts):
+    """ Merges CSV texts having the same header into one, empty texts are skipped """
+    merged = list()
+    for csv_text in csv_texts:
+        if len(csv_text) == 0:
+            continue
+        if len(merged) == 0:
+            merged.append(csv_text)
+        else:
+            # Header is always on the first line
+            merged.append(csv_text[csv_text.index('\n') + 1:])
+        if not csv_text.endswith('\n'):
+            merged.append('\n')
+    return ''.join(merged)
+
+
+def load_bulk_results(csv_text, row_ids):
+    """ Loads Bulk API results, returns maps 'row ID': 'record Id' of processed rows and 'row ID': 'error' of the rest
+        Results are expected to be in the same order as row IDs """
+    ids = dict()
+    errors = dict()
+    if len(csv_text) == 0:
+        return ids, errors
+
+    stream = io.StringIO(csv_text)
+    reader = csv.reader(stream)
+    header = next(reader)
+    id_index = header.index('Id')
+    success_index = header.index('Success')
+    error_index = header.index('Error')
+    for row_id, row in zip(row_ids, reader):
+        if row[success_index] == 'true':
+            ids[row_id] = row[id_index]
+        else:
+            errors[row_id] = row[error_index]
+
+    return ids, errors
+
+
+def generate_csv_batches(table, max_rows=BULK_MAX_BATCH_ROWS, max_bytes=BULK_MAX_BATCH_BYTES, names_to_ids=None):
+    """ Yields (row IDs, CSV text) tuples, each batch starts with the header and fits into both limits
+        Rows are sorted by row ID. If names_to_ids is passed Id column is prepended and filled using this map """
+    line_writer = _LineWriter()
+    writer = csv.writer(line_writer, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+    header = table.header
+    if names_to_ids is not None:
+        header.insert(0, 'Id')
     writer.writerow(header)
-    keys = list(rows.keys())
-    # Saving CSV files sorted by unique key ensures 'git diff' will show only real changes
-    keys.sort()
-    for key in keys:
-        writer.writerow(rows[key])
-
-    if should_close:
-        csv_file.close()
-
-
-def save_csv_with_ids(file, header, rows, names_to_ids):
-    """ Saves table (header + rows) as CSV file """
-    should_close = True
-    if isinstance(file, str):
-        csv_file = open(file, 'w', encoding='utf-8', newline='')
-    else:
-        csv_file = file
-        should_close = False
-
-    writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-    header_with_id = list(header)
-    header_with_id.insert(0, 'Id')
-    writer.writerow(header_with_id)
-    keys = list(rows.keys())
-    # Saving CSV files sorted by unique key ensures 'git diff' will show only real changes
+    header_line = line_writer.line
+    header_size = len(header_line.encode('utf-8'))
+
+    keys = table.row_ids()
     keys.sort()
+    batch_keys = list()
+    lines = [header_line]
+    size = header_size
     for key in keys:
-        row_with_id = list(rows[key])
-        row_with_id.insert(0, names_to_ids[key])
-        writer.writerow(row_with_id)
+        row = table.row(key)
+        if names_to_ids is not None:
+            row.insert(0, names_to_ids[key])
+        writer.writerow(row)
+        line_size = len(line_writer.line.encode('utf-8'))
+        if len(batch_keys) > 0 and (len(batch_keys) >= max_rows or size + line_size > max_bytes):
+            yield batch_keys, ''.join(lines)
+            batch_keys = list()
+            lines = [header_line]
+            size = header_size
+        batch_keys.append(key)
+        lines.append(line_writer.line)
+        size += line_size
+
+    if len(batch_keys) > 0:
+        yield batch_keys, ''.join(lines)
 
-    if should_close:
-        csv_file.close()
@@ -0,0 +1,118 @@
+""" Tracks asynchronous Salesforce jobs: Bulk API batches, Metadata API deployments and retrievals """
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+class JobPoller:
+    """ Polls all outstanding jobs from one background thread
+        Each job is polled shortly after it is submitted, the interval grows with every poll up to a limit """
+    # States reported by Bulk and Metadata APIs before processing starts
+    _QUEUED_STATES = ('Queued', 'Pending')
+
+    def __init__(self, initial_interval=0.5, max_interval=10.0, backoff_factor=1.5):
+        self._initial_interval = initial_interval
+        self._max_interval = max_interval
+        self._backoff_factor = backoff_factor
+        self._jobs = list()
+        # Finished jobs in {'name', 'queue_time', 'processing_time', 'polls'} format
+        self._statistics = list()
+        self._condition = threading.Condition()
+        self._thread = None
+        # Logger
+        self._logger = logging.getLogger('root')
+
+    def submit(self, name, check_status, callback=None):
+        """ Starts tracking a job and returns Future which is resolved with the job's result
+            check_status() returns (state, is_done, result) tuple and raises an exception if the job failed
+            callback(future) is called once the job is finished """
+        now = time.monotonic()
+        job = {
+            'name': name,
+            'check_status': check_status,
+            'future': concurrent.futures.Future(),
+            'interval': self._initial_interval,
+            'next_poll': now + self._initial_interval,
+            'submitted': now,
+            'started': None,
+            'polls': 0
+        }
+        if callback is not None:
+            job['future'].add_done_callback(callback)
+        with self._condition:
+            self._jobs.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='JobPoller', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return job['future']
+
+    def wait(self, name, check_status):
+        """ Tracks a job and blocks until it is finished, returns the job's result """
+        return self.submit(name, check_status).result()
+
+    def cancel(self, future):
+        """ Stops tracking the job and cancels its Future, returns False if the job has finished already """
+        with self._condition:
+            for job in self._jobs:
+                if job['future'] is future:
+                    self._jobs.remove(job)
+                    return future.cancel()
+        return False
+
+    def get_statistics(self):
+        """ Returns queue and processing times of finished jobs, times are measured with polling precision """
+        with self._condition:
+            return list(self._statistics)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._jobs) == 0:
+                    self._condition.wait()
+                now = time.monotonic()
+                due_jobs = [job for job in self._jobs if job['next_poll'] <= now]
+                if len(due_jobs) == 0:
+                    self._condition.wait(min(job['next_poll'] for job in self._jobs) - now)
+                    continue
+            for job in due_jobs:
+                self._poll(job)
+
+    def _poll(self, job):
+        job['polls'] += 1
+        try:
+            state, is_done, result = job['check_status']()
+        except Exception as ex:
+            if self._finish(job):
+                job['future'].set_exception(ex)
+            return
+
+        now = time.monotonic()
+        if job['started'] is None and state not in self._QUEUED_STATES:
+            job['started'] = now
+        if is_done:
+            if self._finish(job):
+                job['future'].set_result(result)
+        else:
+            job['interval'] = min(job['interval'] * self._backoff_factor, self._max_interval)
+            job['next_poll'] = now + job['interval']
+
+    def _finish(self, job):
+        """ Stops tracking the job, returns False if it has been cancelled """
+        now = time.monotonic()
+        started = job['started'] if job['started'] is not None else now
+        statistics = {
+            'name': job['name'],
+            'queue_time': started - job['submitted'],
+            'processing_time': now - started,
+            'polls': job['polls']
+        }
+        with self._condition:
+            if job not in self._jobs:
+                return False
+            self._jobs.remove(job)
+            self._statistics.append(statistics)
+        self._logger.debug("    Job {0} finished: queued {1:.1f}s, processing {2:.1f}s, {3} status call(s)".format(
+            statistics['name'], statistics['queue_time'], statistics['processing_time'], statistics['polls']))
+        return True
@@ -0,0 +1,47 @@
+""" Hashes of files imported into an org, used to find files changed since the last import without git """
+from helpers import cachehelper
+
+import concurrent.futures
+import hashlib
+import os
+
+
+class FileManifest:
+    """ Keeps size, modification time and SHA-1 hash of each file as of the last successful import
+        Files whose size and modification time haven't changed are not hashed again """
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, file_name, max_workers=None):
+        self._file_name = file_name
+        self._max_workers = max_workers
+        # Hash-tables in 'File name': [size, modification time in ns, hash] format
+        self._entries = cachehelper.load_cache(file_name) or dict()
+        self._new_entries = dict()
+
+    def find_changes(self, root_dir, file_names):
+        """ Hashes files in parallel and yields ('A' or 'M', file name) of files added or modified
+            since the manifest was saved, file names are relative to the root directory """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            entries = executor.map(lambda file_name: self._get_entry(root_dir, file_name), file_names)
+            for file_name, entry in zip(file_names, entries):
+                self._new_entries[file_name] = entry
+                old_entry = self._entries.get(file_name)
+                if old_entry is None:
+                    yield 'A', file_name
+                elif old_entry[2] != entry[2]:
+                    yield 'M', file_name
+
+    def save(self):
+        """ Saves entries of files found by the last find_changes() call """
+        cachehelper.save_cache(self._file_name, self._new_entries)
+
+    def _get_entry(self, root_dir, file_name):
+        stat = os.stat(os.path.join(root_dir, file_name))
+        old_entry = self._entries.get(file_name)
+        if old_entry is not None and old_entry[0] == stat.st_size and old_entry[1] == stat.st_mtime_ns:
+            return old_entry
+        file_hash = hashlib.sha1()
+        with open(os.path.join(root_dir, file_name), 'rb') as file:
+            for chunk in iter(lambda: file.read(self._CHUNK_SIZE), b''):
+                file_hash.update(chunk)
+        return [stat.st_size, stat.st_mtime_ns, file_hash.hexdigest()]
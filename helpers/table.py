@@ -0,0 +1,141 @@
+""" Columnar table shared by all commands """
+import sys
+
+# Short strings (IDs, GUIDs, names, picklist values) repeat a lot so they are interned
+_MAX_INTERNED_LENGTH = 80
+
+
+def _intern(value):
+    if isinstance(value, str) and len(value) <= _MAX_INTERNED_LENGTH:
+        return sys.intern(value)
+    return value
+
+
+class Table:
+    """ Table stored as a list of columns
+        Rows are addressed by row ID which is either record Id, unique key or a tuple of names """
+    __slots__ = ('_header', '_positions', '_row_ids', '_row_positions', '_columns')
+
+    def __init__(self, header=None, rows=None):
+        self._header = list(header) if header is not None else list()
+        self._positions = dict()
+        self._row_ids = list()
+        self._row_positions = dict()
+        self._columns = [list() for _ in self._header]
+        self._update_positions()
+        if rows is not None:
+            for row_id, row in rows.items():
+                self.add_row(row_id, row)
+
+    def _update_positions(self):
+        self._positions = {column_name: position for position, column_name in enumerate(self._header)}
+
+    @property
+    def header(self):
+        return list(self._header)
+
+    def __len__(self):
+        return len(self._row_ids)
+
+    def __contains__(self, row_id):
+        return row_id in self._row_positions
+
+    def __iter__(self):
+        return iter(list(self._row_ids))
+
+    def has_column(self, column_name):
+        return column_name in self._positions
+
+    def index(self, column_name):
+        """ Returns position of the column """
+        if column_name not in self._positions:
+            raise ValueError("Column {0} is not in table".format(column_name))
+        return self._positions[column_name]
+
+    def row_ids(self):
+        return list(self._row_ids)
+
+    def add_row(self, row_id, row):
+        """ Appends a row or replaces values of the existing one """
+        if len(row) != len(self._columns):
+            raise ValueError("Row {0} has {1} value(s), {2} expected".format(row_id, len(row), len(self._columns)))
+        position = self._row_positions.get(row_id)
+        if position is None:
+            self._row_positions[row_id] = len(self._row_ids)
+            self._row_ids.append(row_id)
+            for column, value in zip(self._columns, row):
+                column.append(_intern(value))
+        else:
+            for column, value in zip(self._columns, row):
+                column[position] = _intern(value)
+
+    def row(self, row_id):
+        """ Returns a copy of the row as a list """
+        position = self._row_positions[row_id]
+        return [column[position] for column in self._columns]
+
+    def items(self):
+        """ Iterates over (row ID, row) pairs, rows are copies """
+        columns = self._columns
+        for position, row_id in enumerate(list(self._row_ids)):
+            yield row_id, [column[position] for column in columns]
+
+    def get(self, row_id, column_name):
+        return self._columns[self.index(column_name)][self._row_positions[row_id]]
+
+    def set(self, row_id, column_name, value):
+        self._columns[self.index(column_name)][self._row_positions[row_id]] = _intern(value)
+
+    def column(self, column_name):
+        """ Returns values of the column in row ID order, the list must not be modified """
+        return self._columns[self.index(column_name)]
+
+    def set_column(self, column_name, values):
+        """ Replaces values of the column, values must be in row ID order """
+        if len(values) != len(self._row_ids):
+            raise ValueError("Column {0} has {1} value(s), {2} expected".format(
+                column_name, len(values), len(self._row_ids)))
+        self._columns[self.index(column_name)] = [_intern(value) for value in values]
+
+    def remove_columns(self, column_names):
+        """ Removes columns, rows are not touched """
+        positions = set(self.index(column_name) for column_name in column_names)
+        self._header = [name for position, name in enumerate(self._header) if position not in positions]
+        self._columns = [column for position, column in enumerate(self._columns) if position not in positions]
+        self._update_positions()
+
+    def project(self, column_names):
+        """ Returns table containing specified columns only, column lists are shared with this table """
+        table = Table()
+        table._header = list(column_names)
+        table._update_positions()
+        table._row_ids = list(self._row_ids)
+        table._row_positions = dict(self._row_positions)
+        table._columns = [self._columns[self.index(column_name)] for column_name in column_names]
+        return table
+
+    def select_rows(self, row_ids):
+        """ Returns a new table containing specified rows """
+        table = Table(self._header)
+        positions = [self._row_positions[row_id] for row_id in row_ids]
+        table._row_ids = list(row_ids)
+        table._row_positions = {row_id: position for position, row_id in enumerate(table._row_ids)}
+        table._columns = [[column[position] for position in positions] for column in self._columns]
+        return table
+
+    def remove_rows(self, row_ids):
+        """ Removes rows by row IDs """
+        row_ids_to_remove = set(row_ids)
+        if len(row_ids_to_remove) == 0:
+            return
+        positions = [position for position, row_id in enumerate(self._row_ids) if row_id not in row_ids_to_remove]
+        self._row_ids = [self._row_ids[position] for position in positions]
+        self._row_positions = {row_id: position for position, row_id in enumerate(self._row_ids)}
+        self._columns = [[column[position] for position in positions] for column in self._columns]
+
+    def copy(self):
+        return self.select_rows(self._row_ids)
+
+    def to_dict(self):
+        """ Returns rows in 'row ID': [values] format """
+        return dict(self.items())
@@ -1,6 +1,18 @@
+from collections import OrderedDict
+from helpers.table import Table
+
+import concurrent.futures
+import multiprocessing
 import os
 import yaml
-from collections import OrderedDict
+
+# libyaml based loader and dumper are several times faster
+# Pure Python ones are used if PyYAML was built without libyaml
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+# Smaller sets of files are processed faster than worker processes start
+_MIN_FILES_TO_PROCESS_IN_PARALLEL = 500
+_MAX_CHUNK_SIZE = 500
 
 
 # Loads YAML as an ordered list
@@ -19,17 +31,95 @@ def ordered_load(stream, loader_class=yaml.SafeLoader, object_pairs_hook=Ordered
     return yaml.load(stream, OrderedLoader)
 
 
+def _represent_str(dumper, data):
+    if len(data.splitlines()) > 1:  # check for multi-line string
+        # PyYAML doesn't like carriage return, remove it
+        return dumper.represent_scalar('tag:yaml.org,2002:str', data.replace('\r\n', '\n'), style='|')
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data)
+
+
+# noinspection PyClassHasNoInit
+class _RecordDumper(_SafeDumper):
+    """ Writes multi-line strings as literal blocks """
+    pass
+
+
+_RecordDumper.add_representer(str, _represent_str)
+
+
+def _map_chunks(function, items, max_workers):
+    """ Calls function for chunks of items in worker processes, returns results in the order of chunks """
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(items) < _MIN_FILES_TO_PROCESS_IN_PARALLEL:
+        return [function(items)]
+
+    chunk_size = max(1, min(_MAX_CHUNK_SIZE, len(items) // (max_workers * 4)))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    # Workers are spawned, forking a process running Bulk API and deployment threads is not safe
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(function, chunks))
+
+
+def _load_file(file_name):
+    try:
+        with open(file_name, 'rb') as file:
+            return yaml.load(file, Loader=_SafeLoader)
+    except (OSError, yaml.YAMLError) as ex:
+        raise Exception("Could not load {0}: {1}".format(file_name, ex))
+
+
+def _load_chunk(file_names):
+    """ Loads a chunk of files in a worker process """
+    return [_load_file(file_name) for file_name in file_names]
+
+
+def load_yaml_files(file_names, max_workers=None):
+    """ Loads YAML files in parallel, returns objects in the order of file names
+        Raises an exception naming the first file which could not be loaded """
+    return [obj for objects in _map_chunks(_load_chunk, file_names, max_workers) for obj in objects]
+
+
+def _save_chunk(records):
+    """ Writes a chunk of records in a worker process, returns number of written files """
+    written_count = 0
+    for file_name, header, row in records:
+        data = yaml.dump(dict(zip(header, row)), Dumper=_RecordDumper,
+                         default_flow_style=False, explicit_start=False, width=1024, sort_keys=False)
+        try:
+            with open(file_name, 'r') as file:
+                if file.read() == data:
+                    continue
+        except FileNotFoundError:
+            pass
+        with open(file_name, 'w') as file:
+            file.write(data)
+        written_count += 1
+    return written_count
+
+
+def save_yaml_files(records, max_workers=None):
+    """ Saves records in (file name, header, row) format into YAML files, returns number of written files
+        Files which already contain the same data are not written so their modification time doesn't change """
+    # The last record wins if several records are saved into the same file
+    records = list({record[0]: record for record in records}.values())
+    for dir_name in sorted(set(os.path.dirname(file_name) for file_name, header, row in records)):
+        os.makedirs(dir_name, exist_ok=True)
+    return sum(_map_chunks(_save_chunk, records, max_workers))
+
+
 def load_multiple_yaml(changed_rows, unique_key, root_dir):
-    rows = dict()
-    field_names = list()
-    for file_name in changed_rows:
-        with open(os.path.join(root_dir, file_name), 'r') as file:
-            row = yaml.load(file)
-            rows[row[unique_key]] = list(row.values())
-            field_names = list(row.keys())
-    return field_names, rows
+    """ Loads YAML files into a table keyed by unique key """
+    table = None
+    file_names = [os.path.join(root_dir, file_name) for file_name in changed_rows]
+    for file_name, row in zip(file_names, load_yaml_files(file_names)):
+        if not isinstance(row, dict):
+            raise Exception("Could not load {0}: a record was expected".format(file_name))
+        if table is None:
+            table = Table(row.keys())
+        table.add_row(row[unique_key], list(row.values()))
+    return table if table is not None else Table()
 
 
 def load_one_yaml(file_name):
-    with open(file_name, 'r') as file:
-        return yaml.load(file)
+    return _load_file(file_name)
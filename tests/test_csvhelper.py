@@ -0,0 +1,37 @@
+from helpers import csvhelper
+from helpers.table import Table
+import unittest
+
+
+class GenerateCsvBatchesTest(unittest.TestCase):
+    @staticmethod
+    def _setup_table():
+        return Table(['Name'], {
+            'GUID-3': ['Enchères'],
+            'GUID-1': ['Account'],
+            'GUID-2': ['Contact']
+        })
+
+    def test_batches_are_split_by_row_count(self):
+        batches = list(csvhelper.generate_csv_batches(self._setup_table(), max_rows=2))
+        self.assertEqual([
+            (['GUID-1', 'GUID-2'], '"Name"\r\n"Account"\r\n"Contact"\r\n'),
+            (['GUID-3'], '"Name"\r\n"Enchères"\r\n')
+        ], batches)
+
+    def test_batches_are_split_by_byte_size(self):
+        # Header is 8 bytes, '"Account"\r\n' is 11 bytes and '"Enchères"\r\n' is 13 bytes in UTF-8
+        batches = list(csvhelper.generate_csv_batches(self._setup_table(), max_bytes=30))
+        self.assertEqual([['GUID-1', 'GUID-2'], ['GUID-3']], [row_ids for row_ids, csv_data in batches])
+        for row_ids, csv_data in batches:
+            self.assertLessEqual(len(csv_data.encode('utf-8')), 30)
+
+    def test_ids_are_prepended(self):
+        table = Table(['DDP_Migrator_Id__c'], {('Account',): ['GUID-1']})
+        self.assertEqual(
+            [([('Account',)], '"Id","DDP_Migrator_Id__c"\r\n"a227A000000AAAAQAA","GUID-1"\r\n')],
+            list(csvhelper.generate_csv_batches(table, names_to_ids={('Account',): 'a227A000000AAAAQAA'})))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,397 @@
+from commands.ddpcommandbase import DdpCommandBase
+from helpers.batchsize import BatchSizeController
+from helpers.jobpoller import JobPoller
+from helpers.table import Table
+import os
+import re
+import tempfile
+import threading
+import unittest
+
+
+class DdpCommandBaseTest(unittest.TestCase):
+    @staticmethod
+    def _setup_command():
+        settings = {
+            'excluded-fields': list(),
+            'unique-key': 'DDP_Migrator_Id__c',
+            'update-batch-size': '100',
+            'tables': {
+                'Loop.Loop__DDP__c': {
+                    'name': 'Name',
+                    'alias': 'DDP',
+                    'import-order': 0
+                }
+            }
+        }
+        command = DdpCommandBase(settings, source_dir='..')
+        command.queries = list()
+
+        def retrieve_data(dev_name, query):
+            command.queries.append((dev_name, query))
+            return '"Id","Name"\n"0127A000000AAAAQAA","Documents"\n'
+
+        command._retrieve_data = retrieve_data
+        return command
+
+    def test_retrieve_reference_table_is_cached(self):
+        command = self._setup_command()
+        tables_to_load = {'RecordType': {'id': 'Id', 'query': 'SELECT Id,Name FROM RecordType'}}
+        first = command._retrieve_required_data(tables_to_load)
+        second = command._retrieve_required_data(tables_to_load)
+        self.assertIs(first['RecordType'], second['RecordType'])
+        self.assertEqual({'0127A000000AAAAQAA': ['Documents']}, first['RecordType']['rows'])
+        self.assertEqual(1, len(command.queries))
+
+    def test_invalidate_reference_data(self):
+        command = self._setup_command()
+        command._retrieve_reference_table('RecordType', 'SELECT Id,Name FROM RecordType', 'Id')
+        command._retrieve_reference_table('Profile', 'SELECT Id,Name FROM Profile', 'Id')
+        command._invalidate_reference_data('RecordType')
+        command._retrieve_reference_table('RecordType', 'SELECT Id,Name FROM RecordType', 'Id')
+        command._retrieve_reference_table('Profile', 'SELECT Id,Name FROM Profile', 'Id')
+        self.assertEqual(['RecordType', 'Profile', 'RecordType'], [query[0] for query in command.queries])
+
+    def test_reference_data_cached_during_write_is_invalidated(self):
+        command = self._setup_command()
+
+        def run_job(operation, dev_name, table, external_id_field=None, names_to_ids=None):
+            # Another table reads the object while the job is running
+            command._retrieve_reference_table('RecordType', 'SELECT Id,Name FROM RecordType', 'Id')
+            return dict(), dict()
+        command._run_adaptive_bulk_job = run_job
+        command._upsert_data('RecordType', Table(['Name']), 'DDP_Migrator_Id__c')
+        command._retrieve_reference_table('RecordType', 'SELECT Id,Name FROM RecordType', 'Id')
+        self.assertEqual(['RecordType', 'RecordType'], [query[0] for query in command.queries])
+
+    def test_add_in_clause(self):
+        self.assertEqual(
+            "SELECT Id,Name FROM Group WHERE (Type = 'Regular') AND Name IN ('A','B\\'s') ORDER BY Name",
+            DdpCommandBase._add_in_clause(
+                "SELECT Id,Name FROM Group WHERE Type = 'Regular' ORDER BY Name",
+                'Name', self._setup_command()._split_in_clause_values(['A', "B's"])[0]))
+
+    def test_filter_values_which_cannot_be_ids_are_skipped(self):
+        command = self._setup_command()
+        command._key_prefixes['Loop__Related_Object__c'] = 'a01'
+        command._retrieve_reference_table(
+            'Loop__Related_Object__c', 'SELECT Id,Name FROM Loop__Related_Object__c', 'Id',
+            {'field': 'Id', 'values': ['AccountContactRole', 'ContactRequests', 'a0X7A000000AAAA', 'a017A000000AAAA']})
+        self.assertEqual(
+            [('Loop__Related_Object__c',
+              "SELECT Id,Name FROM Loop__Related_Object__c WHERE Id IN ('a017A000000AAAA')")],
+            command.queries)
+
+    def test_filtered_reference_table_falls_back_to_full_export_on_invalid_filter(self):
+        command = self._setup_command()
+        command._key_prefixes['Loop__Related_Object__c'] = 'a01'
+        errors = ["Batch failed: INVALID_QUERY_FILTER_OPERATOR: invalid ID field: a017A000000AAAA"]
+
+        def retrieve_data(dev_name, query):
+            command.queries.append((dev_name, query))
+            if ' IN (' in query:
+                raise Exception(errors[0])
+            return '"Id","Name"\n"a017A000000AAAAQAA","Account"\n'
+        command._retrieve_data = retrieve_data
+        table = command._retrieve_reference_table(
+            'Loop__Related_Object__c', 'SELECT Id,Name FROM Loop__Related_Object__c', 'Id',
+            {'field': 'Id', 'values': ['a017A000000AAAA']})
+        self.assertEqual({'a017A000000AAAAQAA': ['Account']}, table['rows'])
+        self.assertEqual('SELECT Id,Name FROM Loop__Related_Object__c', command.queries[-1][1])
+        # Other failures are not hidden by the full export
+        errors[0] = "Batch failed: InvalidSessionId"
+        self.assertRaises(
+            Exception, command._retrieve_reference_table,
+            'Loop__Related_Object__c', 'SELECT Id,Name FROM Loop__Related_Object__c', 'Id',
+            {'field': 'Id', 'values': ['a017A000000BBBB']})
+
+    def test_retrieve_table_in_chunks(self):
+        command = self._setup_command()
+        command._MAX_IN_CLAUSE_LENGTH = 25
+        header, rows = command._retrieve_table_in_chunks(
+            'RecordType', 'SELECT Id,Name FROM RecordType', 'Id', 'Id',
+            ['0127A000000AAAAQAA', '0127A000000BBBBQAA'])
+        self.assertEqual(['Name'], header)
+        # Chunks are exported concurrently
+        self.assertEqual([
+            ('RecordType', "SELECT Id,Name FROM RecordType WHERE Id IN ('0127A000000AAAAQAA')"),
+            ('RecordType', "SELECT Id,Name FROM RecordType WHERE Id IN ('0127A000000BBBBQAA')")
+        ], sorted(command.queries))
+
+    def test_retrieve_data_in_chunks_merges_results(self):
+        command = self._setup_command()
+        command._MAX_IN_CLAUSE_LENGTH = 10
+        command.queries = list()
+
+        def retrieve_data(dev_name, query):
+            command.queries.append(query)
+            value = re.search(r"IN \('(\w+)'\)", query).group(1)
+            # Chunk matching no records returns empty result
+            if value == 'CCC':
+                return ''
+            return '"Id","Name"\n"{0}","{1}"\n'.format(value, value.lower())
+
+        command._retrieve_data = retrieve_data
+        self.assertEqual(
+            '"Id","Name"\n"AAA","aaa"\n"BBB","bbb"\n',
+            command._retrieve_data_in_chunks(
+                'Loop__DDP__c', 'SELECT Id,Name FROM Loop__DDP__c ORDER BY Name', 'Name', ['BBB', 'CCC', 'AAA']))
+        self.assertIn("SELECT Id,Name FROM Loop__DDP__c WHERE Name IN ('AAA') ORDER BY Name", command.queries)
+
+    def test_persistent_reference_table_is_revalidated(self):
+        command = self._setup_command()
+        cache_dir = tempfile.TemporaryDirectory()
+        command._reference_cache_dir = cache_dir.name
+        command._reference_cache_objects = ['Profile']
+
+        class Session:
+            @staticmethod
+            def get_session_id():
+                return '00D7A0000000001!AQ4AQ'
+
+            @staticmethod
+            def get_api_version():
+                return '37.0'
+
+        org_records = [
+            {'Id': '00e7A000000BBBBQAA', 'Name': 'Loop User', 'SystemModstamp': '2016-10-14T10:00:00.000+0000'}]
+
+        def rest_query(query):
+            command.queries.append(('REST', query))
+            if query.startswith('SELECT Id FROM'):
+                return [{'Id': '00e7A000000AAAAQAA'}] + [{'Id': record['Id']} for record in org_records]
+            return [record for record in org_records if record['SystemModstamp'] >= '2016-10-13']
+
+        command._session = Session()
+        command._rest_query = rest_query
+        command._retrieve_data = lambda dev_name, query: command.queries.append((dev_name, query)) or \
+            '"Id","Name","SystemModstamp"\n"00e7A000000AAAAQAA","System Administrator","2016-10-13T20:39:50.000Z"\n'
+
+        query = 'SELECT Id,Name FROM Profile'
+        table = command._retrieve_persistent_reference_table('Profile', query, 'Id')
+        self.assertEqual({'00e7A000000AAAAQAA': ['System Administrator']}, table['rows'])
+
+        # Second run revalidates cached table and applies changed records
+        table = command._retrieve_persistent_reference_table('Profile', query, 'Id')
+        self.assertEqual(['Name'], table['header'])
+        self.assertEqual({
+            '00e7A000000AAAAQAA': ['System Administrator'],
+            '00e7A000000BBBBQAA': ['Loop User']
+        }, table['rows'])
+        self.assertEqual([
+            ('Profile', 'SELECT Id,Name,SystemModstamp FROM Profile'),
+            ('REST', 'SELECT Id,Name,SystemModstamp FROM Profile WHERE SystemModstamp >= 2016-10-13T20:39:50Z'),
+            ('REST', 'SELECT Id FROM Profile')
+        ], command.queries)
+
+        # Deleted record is replaced with one having an older SystemModstamp, the number of records is the same
+        org_records[0] = {'Id': '00e7A000000CCCCQAA', 'Name': 'Restored', 'SystemModstamp': '2016-01-01T00:00:00.000Z'}
+        command.queries = list()
+        command._retrieve_persistent_reference_table('Profile', query, 'Id')
+        self.assertEqual(('Profile', 'SELECT Id,Name,SystemModstamp FROM Profile'), command.queries[-1])
+        cache_dir.cleanup()
+
+    def test_deleted_records_are_removed_from_persistent_reference_table(self):
+        command = self._setup_command()
+        cache_dir = tempfile.TemporaryDirectory()
+        command._reference_cache_dir = cache_dir.name
+        command._reference_cache_objects = ['Profile']
+
+        class Session:
+            @staticmethod
+            def get_session_id():
+                return '00D7A0000000001!AQ4AQ'
+
+            @staticmethod
+            def get_api_version():
+                return '37.0'
+
+        command._session = Session()
+        command._rest_query = lambda query: [{'Id': '00e7A000000AAAAQAA'}] if query.startswith('SELECT Id FROM') else []
+        command._retrieve_data = lambda dev_name, query: \
+            '"Id","Name","SystemModstamp"\n"00e7A000000AAAAQAA","System Administrator","2016-10-13T20:39:50.000Z"\n' \
+            '"00e7A000000BBBBQAA","Loop User","2016-10-13T20:39:50.000Z"\n'
+        query = 'SELECT Id,Name FROM Profile'
+        command._retrieve_persistent_reference_table('Profile', query, 'Id')
+        command._retrieve_data = None
+        table = command._retrieve_persistent_reference_table('Profile', query, 'Id')
+        self.assertEqual({'00e7A000000AAAAQAA': ['System Administrator']}, table['rows'])
+        cache_dir.cleanup()
+
+    @staticmethod
+    def _setup_dependent_tables(command):
+        parent_relationship = {
+            'field': 'Loop__DDP__c',
+            'parent-table': 'Loop.Loop__DDP__c',
+            'parent-field': 'DDP_Migrator_Id__c'
+        }
+        command._table_settings.update({
+            'Loop.Loop__DDP_File__c': {'import-order': 1, 'parent-relationship': parent_relationship},
+            'Loop.Loop__Related_Object__c': {'import-order': 3, 'parent-relationship': parent_relationship},
+            'Loop.Loop__PDF_Stamp__c': {
+                'import-order': 4,
+                'parent-relationship': parent_relationship,
+                'field-handlers': {'Loop__DDP_Files__c': {'class': 'LoopDDPFilesHandler'}}
+            }
+        })
+        command._reverse = dict()
+        command._forward = dict()
+        command._resolve_dependencies()
+
+    def test_get_table_dependencies_includes_handler_tables(self):
+        command = self._setup_command()
+        self._setup_dependent_tables(command)
+        self.assertEqual(
+            ['Loop.Loop__DDP__c', 'Loop.Loop__DDP_File__c'],
+            command._get_table_dependencies('Loop.Loop__PDF_Stamp__c'))
+
+    def test_run_in_dependency_order(self):
+        command = self._setup_command()
+        self._setup_dependent_tables(command)
+        # Children of Loop__DDP__c must run at the same time, the barrier would time out otherwise
+        barrier = threading.Barrier(2, timeout=5)
+        events = list()
+
+        def action(table_name):
+            events.append(('start', table_name))
+            if table_name in ['Loop.Loop__DDP_File__c', 'Loop.Loop__Related_Object__c']:
+                barrier.wait()
+            events.append(('end', table_name))
+
+        command._run_in_dependency_order(list(command._table_settings), action)
+        self.assertEqual(('start', 'Loop.Loop__DDP__c'), events[0])
+        self.assertLess(
+            events.index(('end', 'Loop.Loop__DDP_File__c')), events.index(('start', 'Loop.Loop__PDF_Stamp__c')))
+        self.assertEqual(8, len(events))
+
+    def test_run_in_dependency_order_stops_on_error(self):
+        command = self._setup_command()
+        self._setup_dependent_tables(command)
+        started = list()
+
+        def action(table_name):
+            started.append(table_name)
+            if table_name == 'Loop.Loop__DDP__c':
+                raise Exception("Could not upsert")
+
+        self.assertRaises(Exception, command._run_in_dependency_order, list(command._table_settings), action)
+        self.assertEqual(['Loop.Loop__DDP__c'], started)
+
+    @staticmethod
+    def _setup_bulk_api(command, failed_batches=(), max_rows_without_errors=None):
+        class BulkApi:
+            def __init__(self):
+                self.polls = dict()
+                self.batch_rows = dict()
+                self.in_flight = 0
+                self.max_in_flight = 0
+                self.closed = False
+
+            def _create_job(self, operation, object_name, content_type, external_id_field=None):
+                return 'JOB'
+
+            def _add_batch(self, job_id, data):
+                batch_id = 'BATCH-{0}'.format(len(self.polls))
+                self.polls[batch_id] = 0
+                self.batch_rows[batch_id] = data.count('\n') - 1
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                return batch_id
+
+            def _close_job(self, job_id):
+                self.closed = True
+
+            def _get_batch_state(self, job_id, batch_id):
+                self.polls[batch_id] += 1
+                state = 'InProgress'
+                if self.polls[batch_id] == 2:
+                    self.in_flight -= 1
+                    state = 'Failed' if batch_id in failed_batches else 'Completed'
+                return {'state': state, 'message': 'Failed ' + batch_id, 'processed': '1', 'failed': '0'}
+
+            def _get_batch_result(self, job_id, batch_id, is_single_job=False):
+                row_count = self.batch_rows[batch_id]
+                result = '"{0}","true","false",""\n'.format(batch_id)
+                if max_rows_without_errors is not None and row_count > max_rows_without_errors:
+                    result = '"","false","false","CANNOT_INSERT_UPDATE_ACTIVATE_ENTITY:Apex CPU time limit exceeded"\n'
+                return '"Id","Success","Created","Error"\n' + result * row_count
+
+        command._bapi = BulkApi()
+        command._job_poller = JobPoller(initial_interval=0.001, max_interval=0.005)
+        return command._bapi
+
+    @staticmethod
+    def _setup_ids_table(row_count):
+        return Table(['Id'], {str(index): [str(index)] for index in range(row_count)})
+
+    def test_run_bulk_job_limits_parallel_batches(self):
+        command = self._setup_command()
+        command._max_parallel_batches = 2
+        bulk_api = self._setup_bulk_api(command)
+        batches = [([str(index)], '"Id"\n"{0}"\n'.format(index)) for index in range(5)]
+        statuses = command._run_bulk_job('delete', 'Loop__DDP__c', batches)
+        self.assertEqual([['0'], ['1'], ['2'], ['3'], ['4']], [status['row_ids'] for status in statuses])
+        self.assertEqual(2, bulk_api.max_in_flight)
+        self.assertTrue(bulk_api.closed)
+
+    def test_run_bulk_job_closes_job_and_cancels_batches_on_error(self):
+        command = self._setup_command()
+        bulk_api = self._setup_bulk_api(command)
+        add_batch = bulk_api._add_batch
+
+        def add_batch_once(job_id, data):
+            if len(bulk_api.polls) > 0:
+                raise Exception("Could not add batch")
+            return add_batch(job_id, data)
+        bulk_api._add_batch = add_batch_once
+        bulk_api._get_batch_state = lambda job_id, batch_id: {'state': 'InProgress'}
+        batches = [([str(index)], '"Id"\n"{0}"\n'.format(index)) for index in range(2)]
+        self.assertRaises(Exception, command._run_bulk_job, 'delete', 'Loop__DDP__c', batches)
+        self.assertTrue(bulk_api.closed)
+        self.assertEqual([], command._job_poller._jobs)
+
+    def test_run_bulk_job_collects_failed_batches(self):
+        command = self._setup_command()
+        command._batch_sizes = BatchSizeController(None, 1, 10)
+        self._setup_bulk_api(command, failed_batches=('BATCH-0', 'BATCH-2'))
+        with self.assertRaises(Exception) as context:
+            command._delete_data('Loop__DDP__c', self._setup_ids_table(3))
+        self.assertIn('2 of 3 batch(es): Failed BATCH-0; Failed BATCH-2', str(context.exception))
+
+    def test_batches_are_split_on_cpu_time_limit(self):
+        command = self._setup_command()
+        command._batch_sizes = BatchSizeController(None, 8, 10)
+        bulk_api = self._setup_bulk_api(command, max_rows_without_errors=2)
+        ids, errors = command._delete_data('Loop__DDP__c', self._setup_ids_table(5))
+        self.assertEqual({}, errors)
+        self.assertEqual(['0', '1', '2', '3', '4'], sorted(ids))
+        # Failed batch of 5 rows is split into batches of 2, next job starts with twice the size that worked
+        self.assertEqual([5, 2, 2, 1], list(bulk_api.batch_rows.values()))
+        self.assertEqual(4, command._batch_sizes.get('Loop__DDP__c'))
+
+    def test_batches_larger_than_trigger_chunk_are_split_below_it(self):
+        command = self._setup_command()
+        command._batch_sizes = BatchSizeController(None, 1000, 10000)
+        command._BULK_TRIGGER_CHUNK_SIZE = 4
+        bulk_api = self._setup_bulk_api(command, max_rows_without_errors=2)
+        ids, errors = command._delete_data('Loop__DDP__c', self._setup_ids_table(6))
+        self.assertEqual({}, errors)
+        # 6 rows failed, they are retried in batches of 2 rather than 500
+        self.assertEqual([6, 2, 2, 2], list(bulk_api.batch_rows.values()))
+
+    def test_batch_size_is_remembered(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        file_name = os.path.join(cache_dir.name, 'batch-sizes.json')
+        batch_sizes = BatchSizeController(file_name, 2000, 10000)
+        batch_sizes.record_failure('Loop__Related_Object__c', 2000)
+        # Size which has never succeeded isn't saved
+        self.assertEqual(2000, BatchSizeController(file_name, 2000, 10000).get('Loop__Related_Object__c'))
+        batch_sizes.record_success('Loop__Related_Object__c', 1000)
+        self.assertEqual(2000, batch_sizes.get('Loop__Related_Object__c'))
+        self.assertEqual(1000, BatchSizeController(file_name, 2000, 10000).get('Loop__Related_Object__c'))
+        self.assertFalse(batch_sizes.record_failure('Loop__Related_Object__c', 1))
+        cache_dir.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+from commands.ddpexport import DdpExport
+from helpers.jobpoller import JobPoller
+from helpers.table import Table
+import io
+import json
+import os
+import tempfile
+import unittest
+import zipfile
+
+
+class DdpExportTest(unittest.TestCase):
+    @staticmethod
+    def _setup_command(source_dir):
+        settings = {
+            'excluded-fields': list(),
+            'unique-key': 'DDP_Migrator_Id__c',
+            'tables': {
+                'Loop.Loop__DDP__c': {
+                    'name': 'Name',
+                    'alias': 'DDP'
+                },
+                'Loop.Loop__Related_Object__c': {
+                    'name': 'Name',
+                    'alias': 'Relationships',
+                    'parent-relationship': {
+                        'field': 'Loop__DDP__c',
+                        'parent-table': 'Loop.Loop__DDP__c',
+                        'parent-field': 'DDP_Migrator_Id__c'
+                    }
+                }
+            }
+        }
+        command = DdpExport(settings, source_dir=source_dir, incremental=True)
+        command._get_org_id = lambda: '00D7A0000000001'
+        return command
+
+    @staticmethod
+    def _write_file(source_dir, file_name):
+        full_file_name = os.path.join(source_dir, file_name)
+        os.makedirs(os.path.dirname(full_file_name), exist_ok=True)
+        with open(full_file_name, 'w') as file:
+            file.write('Name: Old\n')
+
+    def test_incremental_export_patches_modified_and_deleted_records(self):
+        with tempfile.TemporaryDirectory() as source_dir:
+            command = self._setup_command(source_dir)
+            relationships_dir = os.path.join('loop', 'data', 'One', 'Relationships')
+            command._export_state = {
+                'Loop.Loop__DDP__c': {
+                    'watermark': '2024-01-01T00:00:00.000Z',
+                    'files': {'D1': os.path.join('loop', 'data', 'One', 'DDP.yaml')}
+                },
+                'Loop.Loop__Related_Object__c': {
+                    'watermark': '2024-01-01T00:00:00.000Z',
+                    'files': {
+                        'R1': os.path.join(relationships_dir, 'Account.yaml'),
+                        'R2': os.path.join(relationships_dir, 'Contact.yaml'),
+                        'R3': os.path.join(relationships_dir, 'Lead.yaml')
+                    }
+                }
+            }
+            for state in command._export_state.values():
+                for file_name in state['files'].values():
+                    self._write_file(source_dir, file_name)
+            # R2 was renamed, R3 was deleted and R4 was created
+            command._modstamps = {
+                'Loop.Loop__DDP__c': {'D1': ('2023-12-01T00:00:00.000Z', '')},
+                'Loop.Loop__Related_Object__c': {
+                    'R1': ('2023-12-01T00:00:00.000Z', 'D1'),
+                    'R2': ('2024-02-01T00:00:00.000Z', 'D1'),
+                    'R4': ('2023-12-01T00:00:00.000Z', 'D1')
+                }
+            }
+            self.assertEqual(['R2', 'R4'], command._find_ids_to_export('Loop.Loop__Related_Object__c'))
+
+            command._id_to_uk = {
+                'Loop.Loop__DDP__c': {'D1': 'DDP-1'},
+                'Loop.Loop__Related_Object__c': {'R2': 'GUID-2', 'R4': 'GUID-4'}
+            }
+            command._data = {
+                'Loop.Loop__DDP__c': Table(['Name'], {'DDP-1': ['One']}),
+                'Loop.Loop__Related_Object__c': Table(['Loop__DDP__c', 'Name'], {
+                    'GUID-2': ['DDP-1', 'Contact Role'],
+                    'GUID-4': ['DDP-1', 'Opportunity']
+                })
+            }
+            command._save_data()
+
+            self.assertEqual(
+                ['Account.yaml', 'Contact Role.yaml', 'Opportunity.yaml'],
+                sorted(os.listdir(os.path.join(source_dir, relationships_dir))))
+            with open(command._get_export_state_file_name(), 'r') as file:
+                state = json.load(file)
+            self.assertEqual('2024-02-01T00:00:00.000Z', state['Loop.Loop__Related_Object__c']['watermark'])
+            self.assertEqual({
+                'R1': os.path.join(relationships_dir, 'Account.yaml'),
+                'R2': os.path.join(relationships_dir, 'Contact Role.yaml'),
+                'R4': os.path.join(relationships_dir, 'Opportunity.yaml')
+            }, state['Loop.Loop__Related_Object__c']['files'])
+
+
+    def test_incremental_export_ignores_older_ddps_with_the_same_name(self):
+        with tempfile.TemporaryDirectory() as source_dir:
+            command = self._setup_command(source_dir)
+            command._export_state = dict()
+            # D1 and D2 are both named 'One', D2 was modified later
+            command._ddp_ids = ['D2']
+            command._retrieve_data = lambda dev_name, query: {
+                'Loop__DDP__c': '"Id","SystemModstamp"\n'
+                                '"D1","2024-01-01T00:00:00.000Z"\n'
+                                '"D2","2024-02-01T00:00:00.000Z"\n',
+                'Loop__Related_Object__c': '"Id","SystemModstamp","Loop__DDP__c"\n'
+                                           '"R1","2024-01-01T00:00:00.000Z","D1"\n'
+                                           '"R2","2024-02-01T00:00:00.000Z","D2"\n'
+            }[dev_name]
+            for table_name in command._table_settings:
+                command._modstamps[table_name] = command._retrieve_modstamps(table_name)
+            self.assertEqual({'D2'}, set(command._modstamps['Loop.Loop__DDP__c']))
+            self.assertEqual(['R2'], command._find_ids_to_export('Loop.Loop__Related_Object__c'))
+
+    def test_only_new_and_modified_documents_are_retrieved(self):
+        with tempfile.TemporaryDirectory() as source_dir:
+            command = self._setup_command(source_dir)
+            command._kwargs['incremental'] = False
+            documents_dir = os.path.join('loop', 'documents', 'Templates')
+            for file_name in ('Quote.docx', 'Quote.docx-meta.xml', 'Invoice.xlsx', 'Old.docx', 'Old.docx-meta.xml'):
+                self._write_file(source_dir, os.path.join(documents_dir, file_name))
+            os.makedirs(os.path.dirname(command._get_document_index_file_name()))
+            with open(command._get_document_index_file_name(), 'w') as file:
+                json.dump({
+                    'Templates/Quote': {'Id': '0157A000000AAAA', 'LastModifiedDate': '2024-01-01T00:00:00.000Z',
+                                        'BodyLength': '100'},
+                    'Templates/Invoice': {'Id': '0157A000000BBBB', 'LastModifiedDate': '2024-01-01T00:00:00.000Z',
+                                          'BodyLength': '100'}
+                }, file)
+            command._document_ids = {
+                'Templates/Quote': '0157A000000AAAA',
+                'Templates/Invoice': '0157A000000BBBB',
+                'Templates/Contract': '0157A000000CCCC'
+            }
+            command._retrieve_data = lambda dev_name, query: \
+                '"Id","LastModifiedDate","BodyLength"\n' \
+                '"0157A000000AAAAQAA","2024-01-01T00:00:00.000Z","100"\n' \
+                '"0157A000000BBBBQAA","2024-02-01T00:00:00.000Z","120"\n' \
+                '"0157A000000CCCCQAA","2024-02-01T00:00:00.000Z","200"\n'
+            retrieved = list()
+            command._retrieve_document_chunk = retrieved.append
+            command._MAX_RETRIEVE_BYTES = 250
+            command._retrieve_files()
+
+            # Contract and Invoice don't fit into one request
+            self.assertEqual([['Templates/Contract'], ['Templates/Invoice']], sorted(retrieved))
+            self.assertEqual(
+                ['Invoice.xlsx', 'Quote.docx', 'Quote.docx-meta.xml'],
+                sorted(os.listdir(os.path.join(source_dir, documents_dir))))
+            with open(command._get_document_index_file_name(), 'r') as file:
+                self.assertEqual('120', json.load(file)['Templates/Invoice']['BodyLength'])
+
+    def test_documents_of_other_ddps_are_kept_when_one_ddp_is_exported(self):
+        with tempfile.TemporaryDirectory() as source_dir:
+            command = self._setup_command(source_dir)
+            command._kwargs['incremental'] = False
+            command._kwargs['ddp'] = ['Quote']
+            documents_dir = os.path.join('loop', 'documents', 'Templates')
+            for file_name in ('Quote.docx', 'Invoice.xlsx', 'Old.docx'):
+                self._write_file(source_dir, os.path.join(documents_dir, file_name))
+            for ddp_name, document in (('Quote', 'Templates/Quote'), ('Invoice', 'Templates/Invoice')):
+                full_file_name = os.path.join(command._get_data_dir(), ddp_name, 'Files', 'F1.yaml')
+                os.makedirs(os.path.dirname(full_file_name))
+                with open(full_file_name, 'w') as file:
+                    file.write('Loop__Document_ID__c: {0}\n'.format(document))
+            os.makedirs(os.path.dirname(command._get_document_index_file_name()))
+            with open(command._get_document_index_file_name(), 'w') as file:
+                json.dump({
+                    'Templates/Quote': {'Id': '0157A000000AAAA', 'LastModifiedDate': '2024-01-01T00:00:00.000Z',
+                                        'BodyLength': '100'},
+                    'Templates/Old': {'Id': '0157A000000CCCC', 'LastModifiedDate': '2024-01-01T00:00:00.000Z',
+                                      'BodyLength': '100'}
+                }, file)
+            command._document_ids = {'Templates/Quote': '0157A000000AAAA'}
+            command._retrieve_data = lambda dev_name, query: \
+                '"Id","LastModifiedDate","BodyLength"\n' \
+                '"0157A000000AAAAQAA","2024-01-01T00:00:00.000Z","100"\n'
+            retrieved = list()
+            command._retrieve_document_chunk = retrieved.append
+            command._retrieve_files()
+
+            # Unchanged document of the exported DDP isn't retrieved, document of another DDP is kept
+            self.assertEqual([], retrieved)
+            self.assertEqual(
+                ['Invoice.xlsx', 'Quote.docx'], sorted(os.listdir(os.path.join(source_dir, documents_dir))))
+            with open(command._get_document_index_file_name(), 'r') as file:
+                self.assertEqual(['Templates/Quote'], list(json.load(file)))
+
+    def test_documents_are_split_into_size_bounded_requests(self):
+        with tempfile.TemporaryDirectory() as source_dir:
+            command = self._setup_command(source_dir)
+            command._MAX_RETRIEVE_DOCUMENTS = 3
+            command._MAX_RETRIEVE_BYTES = 100
+            sizes = {'A': 60, 'B': 40, 'C': 30, 'D': 150, 'E': 10, 'F': 10, 'G': 10, 'H': 10}
+            chunks = command._split_documents(sorted(sizes), sizes)
+            self.assertEqual([['A', 'B'], ['C'], ['D'], ['E', 'F', 'G'], ['H']], chunks)
+            # Only a single document larger than the bound exceeds it
+            for chunk in chunks:
+                self.assertTrue(len(chunk) == 1 or sum(sizes[document] for document in chunk) <= 100)
+
+    def test_retrieved_documents_are_extracted_without_package_xml(self):
+        class MetadataApi:
+            def retrieve(self, options):
+                return 'RETRIEVE-1', 'Queued'
+
+            def check_retrieve_status(self, async_process_id):
+                return 'Succeeded', '', list()
+
+            def retrieve_zip(self, async_process_id):
+                zip_bytes = io.BytesIO()
+                with zipfile.ZipFile(zip_bytes, 'w') as zip_file:
+                    zip_file.writestr('package.xml', '<Package/>')
+                    zip_file.writestr('documents/Templates/Quote.docx', 'Quote')
+                return 'Succeeded', '', list(), zip_bytes.getvalue()
+
+        with tempfile.TemporaryDirectory() as source_dir:
+            command = self._setup_command(source_dir)
+            command._mapi = MetadataApi()
+            command._job_poller = JobPoller(initial_interval=0.001, max_interval=0.005)
+            command._retrieve_document_chunk(['Templates/Quote'])
+            self.assertEqual(['documents'], os.listdir(os.path.join(source_dir, 'loop')))
+            self.assertTrue(os.path.exists(os.path.join(source_dir, 'loop', 'documents', 'Templates', 'Quote.docx')))
+
+
+if __name__ == '__main__':
+    unittest.main()
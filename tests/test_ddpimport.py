@@ -0,0 +1,236 @@
+from commands.ddpimport import DdpImport
+from concurrent.futures import Future
+from helpers import csvhelper
+from helpers.table import Table
+import io
+import os
+import unittest
+
+
+class DdpImportTest(unittest.TestCase):
+    @staticmethod
+    def _setup_command():
+        settings = {
+            'excluded-fields': list(),
+            'unique-key': 'DDP_Migrator_Id__c',
+            'update-batch-size': '100',
+            'tables': {
+                'Loop.Loop__Related_Object__c': {
+                    'name': 'Name',
+                    'alias': 'Relationships',
+                    'import-order': 0,
+                    'recreate-on-import': False,
+                    'field-handlers': {
+                        'Loop__Parent_Object__c': {
+                            'class': 'LoopParentObjectHandler',
+                            'retry-failed': True
+                        }
+                    }
+                }
+            }
+        }
+        command = DdpImport(settings, source_dir='..')
+        command._changed_tables = {'Loop.Loop__Related_Object__c': list()}
+        command._data['Loop.Loop__Related_Object__c'] = Table(['Name', 'Loop__Parent_Object__c'], {
+            'GUID-1': ['Opportunity', ''],
+            'GUID-2': ['Account', 'GUID-1'],
+            'GUID-3': ['Contact', 'GUID-2'],
+            'GUID-4': ['Owner', 'GUID-2'],
+            'GUID-5': ['Contract', 'GUID-0']
+        })
+        command._loaded_tables.append('Loop.Loop__Related_Object__c')
+        command.queries = list()
+        command.upserts = list()
+
+        def retrieve_required_data(tables_to_load):
+            command.queries.append(tables_to_load)
+            return {'Loop__Related_Object__c': {
+                'header': ['DDP_Migrator_Id__c'],
+                'rows': {'a227A000000AAAAQAA': ['GUID-0']}
+            }}
+
+        def import_rows(table_name, rows):
+            command.upserts.append(rows.to_dict())
+            return {row_id: 'a227A00000{0}AAQAA'.format(row_id[-1] * 3) for row_id in rows.row_ids()}
+
+        command._retrieve_required_data = retrieve_required_data
+        command._import_rows = import_rows
+        return command
+
+    def test_order_pending_rows(self):
+        self.assertEqual([['GUID-2', 'GUID-5'], ['GUID-3', 'GUID-4']], DdpImport._order_pending_rows({
+            'GUID-2': {'GUID-1'},
+            'GUID-3': {'GUID-2'},
+            'GUID-4': {'GUID-2'},
+            'GUID-5': set()
+        }))
+        self.assertRaises(Exception, DdpImport._order_pending_rows, {'GUID-2': {'GUID-3'}, 'GUID-3': {'GUID-2'}})
+
+    def test_import_data_retries_rows_using_upsert_results(self):
+        command = self._setup_command()
+        command._import_data()
+        self.assertEqual([
+            {'GUID-1': ['Opportunity', ''], 'GUID-5': ['Contract', 'a227A000000AAAAQAA']},
+            {'GUID-2': ['Account', 'a227A00000111AAQAA']},
+            {'GUID-3': ['Contact', 'a227A00000222AAQAA'], 'GUID-4': ['Owner', 'a227A00000222AAQAA']}
+        ], command.upserts)
+        # Reference table is downloaded once
+        self.assertEqual(1, len(command.queries))
+
+    def test_import_data_raises_on_unknown_reference(self):
+        command = self._setup_command()
+        command._data['Loop.Loop__Related_Object__c'].set('GUID-3', 'Loop__Parent_Object__c', 'GUID-9')
+        self.assertRaises(Exception, command._import_data)
+        self.assertEqual(0, len(command.upserts))
+
+    def test_export_parent_table_ids_queries_unknown_guids_only(self):
+        command = self._setup_command()
+        command._table_settings['Loop.Loop__Related_Object__c']['parent-relationship'] = {
+            'field': 'Loop__DDP__c',
+            'parent-table': 'Loop.Loop__DDP__c',
+            'parent-field': 'DDP_Migrator_Id__c'
+        }
+        command._guids_to_ids['Loop.Loop__DDP__c'] = {'DDP-1': 'a1a7A000000AAAAQAA'}
+        command._retrieve_data = lambda dev_name, query: command.queries.append(query) or \
+            '"Id","DDP_Migrator_Id__c"\n"a1a7A000000BBBBQAA","DDP-2"\n'
+        self.assertEqual(
+            {'DDP-1': 'a1a7A000000AAAAQAA', 'DDP-2': 'a1a7A000000BBBBQAA'},
+            command._export_parent_table_ids('Loop.Loop__Related_Object__c', ['DDP-1', 'DDP-2', 'DDP-3']))
+        self.assertEqual(
+            ["SELECT Id,DDP_Migrator_Id__c FROM Loop__DDP__c WHERE DDP_Migrator_Id__c IN ('DDP-2','DDP-3')"],
+            command.queries)
+
+    def test_only_document_handlers_wait_for_file_deployment(self):
+        command = self._setup_command()
+        command._table_settings['Loop.Loop__Related_Object__c']['field-handlers'] = {
+            'RecordTypeId': {'class': 'RecordTypeIdHandler'},
+            'Loop__Document_ID__c': {'class': 'LoopDocumentIdHandler'}
+        }
+        command._file_deployment = Future()
+        command._file_deployment.set_exception(Exception('Deployment of documents failed'))
+        command._retrieve_required_data = lambda tables_to_load: {
+            'RecordType': {'header': list(), 'rows': dict()}
+        }
+        command._data['Loop.Loop__Related_Object__c'] = Table(['RecordTypeId', 'Loop__Document_ID__c'])
+        command._encode_field('Loop.Loop__Related_Object__c', 'RecordTypeId')
+        self.assertRaises(Exception, command._encode_field, 'Loop.Loop__Related_Object__c', 'Loop__Document_ID__c')
+
+    def test_rows_up_to_date_in_org_are_not_upserted(self):
+        command = self._setup_command()
+        command._retrieve_data = lambda dev_name, query: command.queries.append(query) or \
+            '"Id","Name","Loop__Parent_Object__c","DDP_Migrator_Id__c"\n' \
+            '"a227A00000111AAQAA","Account","a227A000000AAAAQAA","GUID-2"\n' \
+            '"a227A00000222AAQAA","Contact","","GUID-3"\n'
+        command._import_table = lambda table_name, rows: command.upserts.append(rows.to_dict()) or dict()
+        rows = Table(['Name', 'Loop__Parent_Object__c'], {
+            'GUID-2': ['Account', 'a227A000000AAAA'],
+            'GUID-3': ['Contract', ''],
+            'GUID-4': ['Owner', '']
+        })
+        self.assertEqual({'GUID-2': 'a227A00000111AAQAA'},
+                         DdpImport._import_rows(command, 'Loop.Loop__Related_Object__c', rows))
+        self.assertEqual([{'GUID-3': ['Contract', ''], 'GUID-4': ['Owner', '']}], command.upserts)
+        self.assertEqual('a227A00000111AAQAA', command._guids_to_ids['Loop.Loop__Related_Object__c']['GUID-2'])
+        # Current values are retrieved with one query
+        self.assertEqual(1, len(command.queries))
+
+    def test_ids_are_compared_by_prefix_only_in_id_fields(self):
+        self.assertTrue(DdpImport._is_value_up_to_date('a227A000000AAAA', 'a227A000000AAAAQAA', True))
+        # Text values that happen to be 15 and 18 characters long are compared as they are
+        self.assertFalse(DdpImport._is_value_up_to_date('ContactRequests', 'ContactRequestsXYZ'))
+
+    def test_sync_deletes_only_records_removed_from_source(self):
+        command = self._setup_command()
+        command._table_settings['Loop.Loop__Related_Object__c']['parent-relationship'] = {
+            'field': 'Loop__DDP__c',
+            'parent-table': 'Loop.Loop__DDP__c',
+            'parent-field': 'DDP_Migrator_Id__c'
+        }
+        # Rows have been converted, parent lookups hold record IDs
+        command._data['Loop.Loop__Related_Object__c'] = Table(['Name', 'Loop__DDP__c'], {
+            'GUID-1': ['Account', 'a1a7A000000AAAAQAA']
+        })
+        command._retrieve_data = lambda dev_name, query: command.queries.append(query) or \
+            '"Id","DDP_Migrator_Id__c"\n"a227A00000111AAQAA","GUID-1"\n' \
+            '"a227A00000222AAQAA","GUID-2"\n"a227A00000333AAQAA","GUID-3"\n"a227A00000444AAQAA",""\n'
+        command._find_source_guids = lambda table_name: {'GUID-1', 'GUID-2'}
+        deleted = list()
+        command._delete_data = lambda dev_name, table: deleted.append(table.row_ids())
+        command._delete_removed_records('Loop.Loop__Related_Object__c')
+        self.assertEqual(
+            ["SELECT Id,DDP_Migrator_Id__c FROM Loop__Related_Object__c WHERE Loop__DDP__c IN ('a1a7A000000AAAAQAA')"],
+            command.queries)
+        self.assertEqual([['a227A00000333AAQAA', 'a227A00000444AAQAA']], deleted)
+
+    def test_sync_on_import_deletes_records_removed_from_source(self):
+        command = self._setup_command()
+        table_settings = command._table_settings['Loop.Loop__Related_Object__c']
+        del table_settings['field-handlers']
+        table_settings['sync-on-import'] = True
+        table_settings['parent-relationship'] = {
+            'field': 'Loop__DDP__c',
+            'parent-table': 'Loop.Loop__DDP__c',
+            'parent-field': 'DDP_Migrator_Id__c'
+        }
+        command._data['Loop.Loop__Related_Object__c'] = Table(['Name', 'Loop__DDP__c'], {
+            'GUID-1': ['Account', 'DDP-1']
+        })
+
+        def retrieve_data(dev_name, query):
+            command.queries.append(query)
+            if dev_name == 'Loop__DDP__c':
+                return '"Id","DDP_Migrator_Id__c"\n"a1a7A000000AAAAQAA","DDP-1"\n'
+            return '"Id","DDP_Migrator_Id__c"\n"a227A00000111AAQAA","GUID-1"\n"a227A00000222AAQAA","GUID-2"\n'
+        command._retrieve_data = retrieve_data
+        command._find_source_guids = lambda table_name: {'GUID-1'}
+        deleted = list()
+        command._delete_data = lambda dev_name, table: deleted.append(table.row_ids())
+        command._import_changed_table('Loop.Loop__Related_Object__c')
+        self.assertEqual([{'GUID-1': ['Account', 'a1a7A000000AAAAQAA']}], command.upserts)
+        self.assertEqual([
+            "SELECT Id,DDP_Migrator_Id__c FROM Loop__DDP__c WHERE DDP_Migrator_Id__c IN ('DDP-1')",
+            "SELECT Id,DDP_Migrator_Id__c FROM Loop__Related_Object__c WHERE Loop__DDP__c IN ('a1a7A000000AAAAQAA')"
+        ], command.queries)
+        self.assertEqual([['a227A00000222AAQAA']], deleted)
+
+    def test_sync_on_import_requires_parent_relationship(self):
+        settings = {
+            'excluded-fields': list(),
+            'unique-key': 'DDP_Migrator_Id__c',
+            'tables': {
+                'Loop.Loop__DDP__c': {
+                    'name': 'Name',
+                    'alias': 'DDP',
+                    'import-order': 0,
+                    'sync-on-import': True
+                }
+            }
+        }
+        self.assertRaises(Exception, DdpImport, settings, source_dir='..')
+
+    def test_nul_delimited_output_is_split_across_chunks(self):
+        fields = ['M', 'loop/data/Ench\u00e8res/DDP.yaml', 'A', 'loop/data/Ench\u00e8res/Files/a b.yaml']
+        output = io.BytesIO(''.join(field + '\0' for field in fields).encode('utf-8'))
+        self.assertEqual(fields, list(DdpImport._read_nul_delimited(output, chunk_size=5)))
+
+    def test_changed_files_are_grouped_by_table(self):
+        command = self._setup_command()
+        command._changed_tables = dict()
+        data_file = os.path.join('loop', 'data', 'DDP one', 'Relationships', 'Account.yaml')
+        document = os.path.join('loop', 'documents', 'Templates', 'Quote.docx')
+        command._add_changed_file('A', data_file)
+        command._add_changed_file('M', document)
+        self.assertEqual({'Loop.Loop__Related_Object__c': [data_file]}, command._changed_tables)
+        self.assertEqual([document], command._file_changes['modified'])
+
+    def test_load_bulk_results(self):
+        results = '"Id","Success","Created","Error"\n' \
+                  '"a227A00000111AAQAA","true","true",""\n' \
+                  '"","false","false","REQUIRED_FIELD_MISSING"\n'
+        self.assertEqual(
+            ({'GUID-1': 'a227A00000111AAQAA'}, {'GUID-2': 'REQUIRED_FIELD_MISSING'}),
+            csvhelper.load_bulk_results(results, ['GUID-1', 'GUID-2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
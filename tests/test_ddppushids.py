@@ -1,4 +1,5 @@
 from commands.ddppushids import DdpPushIds
+from helpers.table import Table
 import unittest
 
 
@@ -55,9 +56,9 @@ class DdpPushIdsTest(unittest.TestCase):
 
         command = self._setup_overwrite(False)
         rows, ids_to_names, names_to_ids = \
-            command._select_latest_rows('Loop.Loop__DDP__c', header, all_rows, ['Name'], True)
+            command._select_latest_rows('Loop.Loop__DDP__c', Table(header, all_rows), ['Name'], True)
 
-        self.assertEqual({tuple(['DDP Name']): ['', '2016-10-15T20:41:07.000Z', 'DDP Name']}, rows)
+        self.assertEqual({tuple(['DDP Name']): ['', '2016-10-15T20:41:07.000Z', 'DDP Name']}, rows.to_dict())
         self.assertEqual({'a1t7A000003SnqkQAC': tuple(['DDP Name'])}, ids_to_names)
 
     def test_select_latest_rows_no_overwrite_guid_already_set(self):
@@ -70,9 +71,9 @@ class DdpPushIdsTest(unittest.TestCase):
 
         command = self._setup_overwrite(False)
         rows, ids_to_names, names_to_ids = \
-            command._select_latest_rows('Loop.Loop__DDP__c', header, all_rows, ['Name'], True)
+            command._select_latest_rows('Loop.Loop__DDP__c', Table(header, all_rows), ['Name'], True)
 
-        self.assertEqual(dict(), rows)
+        self.assertEqual(dict(), rows.to_dict())
         self.assertEqual(dict(), ids_to_names)
 
     def test_select_latest_rows_overwrite_empty_guid(self):
@@ -85,9 +86,9 @@ class DdpPushIdsTest(unittest.TestCase):
 
         command = self._setup_overwrite(True)
         rows, ids_to_names, names_to_ids = \
-            command._select_latest_rows('Loop.Loop__DDP__c', header, all_rows, ['Name'], False)
+            command._select_latest_rows('Loop.Loop__DDP__c', Table(header, all_rows), ['Name'], False)
 
-        self.assertEqual({tuple(['DDP Name']): ['', '2016-10-15T20:41:07.000Z', 'DDP Name']}, rows)
+        self.assertEqual({tuple(['DDP Name']): ['', '2016-10-15T20:41:07.000Z', 'DDP Name']}, rows.to_dict())
         self.assertEqual({'a1t7A000003SnqkQAC': tuple(['DDP Name'])}, ids_to_names)
 
     def test_select_latest_rows_overwrite_guid_already_set(self):
@@ -100,27 +101,26 @@ class DdpPushIdsTest(unittest.TestCase):
 
         command = self._setup_overwrite(True)
         rows, ids_to_names, names_to_ids = \
-            command._select_latest_rows('Loop.Loop__DDP__c', header, all_rows, ['Name'], False)
+            command._select_latest_rows('Loop.Loop__DDP__c', Table(header, all_rows), ['Name'], False)
 
         self.assertEqual(
             {tuple(['DDP Name']): ['F6B2A31C-8AF9-CD20-AF30-7191D98CEE85', '2016-10-15T20:41:07.000Z', 'DDP Name']},
-            rows)
+            rows.to_dict())
         self.assertEqual({'a1t7A000003SnqkQAC': tuple(['DDP Name'])}, ids_to_names)
 
     def test_replace_parent_ids(self):
         command = self._setup_overwrite(False)
-        command._data['Loop.Loop__DDP__c'] = {
-            'header': ['DDP_Migrator_Id__c', 'LastModifiedDate', 'Name'],
-            'rows': {
+        command._data['Loop.Loop__DDP__c'] = Table(
+            ['DDP_Migrator_Id__c', 'LastModifiedDate', 'Name'],
+            {
                 ('DDP Three',): ['FE9C85E3-CA64-EC16-85C1-FE9EFAF15489', '2016-11-24T00:38:03.000Z', 'DDP Three'],
                 ('DDP Two',): ['190A17CB-FA65-FC07-86B4-0B71417026C6', '2016-11-24T00:37:50.000Z', 'DDP Two'],
                 ('DDP One',): ['8ECD16D7-D5DC-41D8-DE5B-2423E21004CB', '2016-11-24T00:39:25.000Z', 'DDP One']
-            },
-            'ids-to-names': {
-                'a1tW0000001fkWkIAI': ('DDP One',),
-                'a1tW0000001fkWrIAI': ('DDP Two',),
-                'a1tW0000001fkWSIAY': ('DDP Three',)
-            }
+            })
+        command._ids_to_names['Loop.Loop__DDP__c'] = {
+            'a1tW0000001fkWkIAI': ('DDP One',),
+            'a1tW0000001fkWrIAI': ('DDP Two',),
+            'a1tW0000001fkWSIAY': ('DDP Three',)
         }
         header = ['DDP_Migrator_Id__c', 'LastModifiedDate', 'Loop__Index__c', 'Name', 'Loop__DDP__c']
         rows = {
@@ -153,7 +153,8 @@ class DdpPushIdsTest(unittest.TestCase):
                 'a1tW1234561fkWrIAI'
             ]
         }
-        command._replace_parent_ids('Loop.Loop__Related_Object__c', header, rows)
+        table = Table(header, rows)
+        command._replace_parent_ids('Loop.Loop__Related_Object__c', table)
         self.assertEqual({
             'a22W0000006hPKoIAM': [
                 'B6D0F499-5CC7-DB80-89BC-A643CDCBCE28',
@@ -176,7 +177,7 @@ class DdpPushIdsTest(unittest.TestCase):
                 'Object_Three__c',
                 '190A17CB-FA65-FC07-86B4-0B71417026C6'
             ]
-        }, rows)
+        }, table.to_dict())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,178 @@
+from fieldhandlers import LoopParentObjectHandler, LoopSecurityHandler, RecordTypeIdHandler
+from fieldhandlers.field_handler_base import FieldHandlerBase
+from helpers.table import Table
+import unittest
+
+
+class FieldHandlerBaseTest(unittest.TestCase):
+    @staticmethod
+    def _setup_security_handler():
+        table_data = Table(['Name', 'Loop__Security__c'], {
+            'DDP-GUID': ['DDP Name', "'00e7A000000HlBn','0PS7A000000ECsPWAW'"]
+        })
+        handler = LoopSecurityHandler(table_data, 'Loop__Security__c')
+        handler.set_required_data({
+            'Profile': {
+                'header': ['Name'],
+                'rows': {'00e7A000000HlBnQAK': ['System Administrator']}
+            },
+            'PermissionSet': {
+                'header': ['Name'],
+                'rows': {'0PS7A000000ECsP': ['Loop_Admin']}
+            },
+            'Group': {'header': ['Name'], 'rows': dict()},
+            'UserRole': {'header': ['Name'], 'rows': dict()}
+        })
+        return table_data, handler
+
+    def test_is_id_in_list_matches_15_and_18_characters_ids(self):
+        table_data, handler = self._setup_security_handler()
+        self.assertTrue(handler._is_id_in_list('00e7A000000HlBnQAK', 'Profile'))
+        self.assertTrue(handler._is_id_in_list('00e7A000000HlBn', 'Profile'))
+        self.assertTrue(handler._is_id_in_list('0PS7A000000ECsPWAW', 'PermissionSet'))
+        self.assertFalse(handler._is_id_in_list('0PS7A000000ECsPWAW', 'Profile'))
+
+    def test_get_value_by_id_raises_on_missing_id(self):
+        table_data, handler = self._setup_security_handler()
+        self.assertEqual(['Loop_Admin'], handler._get_value_by_id('0PS7A000000ECsP', 'PermissionSet'))
+        self.assertRaises(Exception, handler._get_value_by_id, '00G7A000000ECsP', 'Group')
+
+    def test_tables_required_by_decode_are_filtered_by_ids(self):
+        table_data, handler = self._setup_security_handler()
+        tables = handler.tables_required_by_decode()
+        self.assertEqual({'field': 'Id', 'values': ['00e7A000000HlBn']}, tables['Profile']['filter'])
+        self.assertEqual({'field': 'Id', 'values': ['0PS7A000000ECsPWAW']}, tables['PermissionSet']['filter'])
+        self.assertEqual('SELECT Id,Name FROM Profile', tables['Profile']['query'])
+
+    def test_decode_filter_values_must_start_with_key_prefix(self):
+        table_data = Table(['Loop__Security__c'], {
+            'DDP-GUID': ["'00e7A000000HlBn','AccountContactRole','ContactRequests'"]
+        })
+        handler = LoopSecurityHandler(table_data, 'Loop__Security__c')
+        tables = handler.tables_required_by_decode()
+        self.assertEqual(['00e7A000000HlBn'], tables['Profile']['filter']['values'])
+        self.assertEqual([], tables['Group']['filter']['values'])
+
+    def test_tables_required_by_encode_are_filtered_by_names(self):
+        table_data = Table(
+            ['Loop__Security__c'],
+            {'DDP-GUID': ("PermissionSet.Loop_Admin\nProfile.System Administrator",)})
+        handler = LoopSecurityHandler(table_data, 'Loop__Security__c')
+        tables = handler.tables_required_by_encode()
+        self.assertEqual({'field': 'Name', 'values': ['System Administrator']}, tables['Profile']['filter'])
+        self.assertEqual({'field': 'Name', 'values': []}, tables['Group']['filter'])
+
+    def test_decode(self):
+        table_data, handler = self._setup_security_handler()
+        handler.decode()
+        self.assertEqual(
+            "PermissionSet.Loop_Admin\nProfile.System Administrator",
+            table_data.get('DDP-GUID', 'Loop__Security__c'))
+
+
+class RecordTypeIdHandlerTest(unittest.TestCase):
+    def test_encode_uses_natural_key_index(self):
+        table_data = Table(['Name', 'RecordTypeId'], {
+            'GUID-1': ('DDP One', 'Loop.DDP__c.Documents'),
+            'GUID-2': ('DDP Two', 'Loop.DDP__c.Documents'),
+            'GUID-3': ('DDP Three', '.DDP__c.Custom')
+        })
+        required_data = {
+            'RecordType': {
+                'header': ['NamespacePrefix', 'SobjectType', 'DeveloperName'],
+                'rows': {
+                    '0127A000000AAAAQAA': ['Loop', 'DDP__c', 'Documents'],
+                    '0127A000000BBBBQAA': ['', 'DDP__c', 'Custom']
+                }
+            }
+        }
+        handler = RecordTypeIdHandler(table_data, 'RecordTypeId')
+        handler.set_required_data(required_data)
+        handler.encode()
+        self.assertEqual(['DDP One', '0127A000000AAAAQAA'], table_data.row('GUID-1'))
+        self.assertEqual(['DDP Two', '0127A000000AAAAQAA'], table_data.row('GUID-2'))
+        self.assertEqual(['DDP Three', '0127A000000BBBBQAA'], table_data.row('GUID-3'))
+        # Index is stored with the reference table so other handlers can reuse it
+        self.assertIn('key-indexes', required_data['RecordType'])
+
+    def test_encode_raises_on_unknown_value(self):
+        table_data = Table(['RecordTypeId'], {'GUID-1': ('Loop.DDP__c.Missing',)})
+        handler = RecordTypeIdHandler(table_data, 'RecordTypeId')
+        handler.set_required_data({'RecordType': {'header': list(), 'rows': dict()}})
+        self.assertRaises(Exception, handler.encode)
+
+
+class LoopParentObjectHandlerTest(unittest.TestCase):
+    def test_encode_column_marks_rows_with_missing_parents_for_retry(self):
+        table_data = Table(['Loop__Parent_Object__c'], {
+            'GUID-1': ('',),
+            'GUID-2': ('GUID-1',),
+            'GUID-3': ('GUID-2',),
+            'GUID-4': ('GUID-2',)
+        })
+        handler = LoopParentObjectHandler(table_data, 'Loop__Parent_Object__c', True)
+        handler.set_required_data({
+            'Loop__Related_Object__c': {
+                'header': ['DDP_Migrator_Id__c'],
+                'rows': {'a227A000000AAAAQAA': ['GUID-1']}
+            }
+        })
+        handler.encode()
+        self.assertEqual(['a227A000000AAAAQAA'], table_data.row('GUID-2'))
+        self.assertTrue(handler.should_retry())
+        self.assertEqual(['GUID-1', 'GUID-2'], sorted(handler.get_encoded_rows()))
+        self.assertEqual({'GUID-3': {'GUID-2'}, 'GUID-4': {'GUID-2'}}, handler.get_missing_values())
+
+    def test_encode_rows_uses_added_required_rows(self):
+        table_data = Table(['Loop__Parent_Object__c'], {'GUID-2': ('GUID-1',)})
+        handler = LoopParentObjectHandler(table_data, 'Loop__Parent_Object__c', True)
+        handler.set_required_data({'Loop__Related_Object__c': {'header': list(), 'rows': dict()}})
+        handler.encode()
+        self.assertTrue(handler.should_retry())
+        self.assertTrue(handler.add_required_rows(
+            'Loop__Related_Object__c', {'a227A000000AAAAQAA': {'DDP_Migrator_Id__c': 'GUID-1', 'Name': 'Account'}}))
+        handler.encode_rows(['GUID-2'])
+        self.assertFalse(handler.should_retry())
+        self.assertEqual(['a227A000000AAAAQAA'], table_data.row('GUID-2'))
+
+
+class PerValueHandlerTest(unittest.TestCase):
+    def test_per_value_methods_are_called_once_per_distinct_value(self):
+        class UpperCaseHandler(FieldHandlerBase):
+            def __init__(self, table_data, field_name):
+                super().__init__(table_data, field_name)
+                self.decoded = list()
+                self.encoded = list()
+
+            def _decode_one_value(self, value):
+                self.decoded.append(value)
+                return value.upper()
+
+            def _encode_one_value(self, value, value_row_id):
+                self.encoded.append((value, value_row_id))
+                return value.lower()
+
+        table_data = Table(['Name'], {'1': ['a'], '2': ['a'], '3': ['b']})
+        handler = UpperCaseHandler(table_data, 'Name')
+        handler.decode()
+        self.assertEqual({'1': ['A'], '2': ['A'], '3': ['B']}, table_data.to_dict())
+        self.assertEqual(['a', 'b'], handler.decoded)
+        self.assertEqual(['a', 'a', 'b'], handler.encode_column(['A', 'A', 'B'], ['1', '2', '3']))
+        self.assertEqual([('A', '1'), ('B', '3')], handler.encoded)
+
+    def test_rows_sharing_value_of_row_marked_for_retry_are_retried(self):
+        class RowWiseHandler(FieldHandlerBase):
+            def _encode_one_value(self, value, value_row_id):
+                if value == 'MISSING':
+                    self._retry_row_ids.append(value_row_id)
+                return value
+
+        table_data = Table(['Name'], {'1': ['MISSING'], '2': ['OK'], '3': ['MISSING']})
+        handler = RowWiseHandler(table_data, 'Name', True)
+        handler.encode()
+        self.assertEqual({'1', '3'}, handler.get_retry_row_ids())
+        self.assertEqual(['2'], handler.get_encoded_rows().row_ids())
+
+
+if __name__ == '__main__':
+    unittest.main()
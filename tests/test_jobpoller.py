@@ -0,0 +1,48 @@
+from helpers.jobpoller import JobPoller
+import unittest
+
+
+class JobPollerTest(unittest.TestCase):
+    @staticmethod
+    def _setup_job(states):
+        """ Returns status function reporting states one by one """
+        remaining = list(states)
+
+        def check_status():
+            state = remaining.pop(0)
+            if state == 'Failed':
+                raise Exception("Batch failed")
+            return state, state == 'Completed', state
+        return check_status
+
+    def test_jobs_are_polled_until_done(self):
+        poller = JobPoller(initial_interval=0.01, max_interval=0.02)
+        finished = list()
+        first = poller.submit('query Profile', self._setup_job(['Queued', 'InProgress', 'InProgress', 'Completed']),
+                              lambda future: finished.append(future.result()))
+        second = poller.submit('upsert Loop__DDP__c', self._setup_job(['Completed']))
+        self.assertEqual('Completed', first.result(timeout=5))
+        self.assertEqual('Completed', second.result(timeout=5))
+        self.assertEqual(['Completed'], finished)
+        statistics = {job['name']: job for job in poller.get_statistics()}
+        self.assertEqual(4, statistics['query Profile']['polls'])
+        self.assertEqual(1, statistics['upsert Loop__DDP__c']['polls'])
+        self.assertGreater(statistics['query Profile']['processing_time'], 0)
+
+    def test_job_errors_are_raised_by_wait(self):
+        poller = JobPoller(initial_interval=0.01)
+        self.assertRaises(Exception, poller.wait, 'query Profile', self._setup_job(['Queued', 'Failed']))
+        self.assertEqual(2, poller.get_statistics()[0]['polls'])
+
+    def test_cancelled_jobs_are_not_polled(self):
+        poller = JobPoller(initial_interval=0.01)
+        future = poller.submit('query Profile', self._setup_job(['InProgress'] * 1000))
+        self.assertTrue(poller.cancel(future))
+        self.assertTrue(future.cancelled())
+        self.assertFalse(poller.cancel(future))
+        self.assertEqual('Completed', poller.wait('query Group', self._setup_job(['Completed'])))
+        self.assertEqual(['query Group'], [job['name'] for job in poller.get_statistics()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+from helpers.manifest import FileManifest
+import os
+import tempfile
+import unittest
+
+
+class FileManifestTest(unittest.TestCase):
+    def test_only_added_and_modified_files_are_reported(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            for file_name in ('DDP.yaml', 'Files.yaml', 'Template.docx'):
+                with open(os.path.join(root_dir, file_name), 'w') as file:
+                    file.write(file_name)
+            manifest_file_name = os.path.join(root_dir, 'cache', 'manifest.json')
+            manifest = FileManifest(manifest_file_name)
+            self.assertEqual(
+                [('A', 'DDP.yaml'), ('A', 'Files.yaml')],
+                list(manifest.find_changes(root_dir, ['DDP.yaml', 'Files.yaml'])))
+            manifest.save()
+
+            with open(os.path.join(root_dir, 'Files.yaml'), 'w') as file:
+                file.write('Changed')
+            # Touched file with the same content is not reported
+            os.utime(os.path.join(root_dir, 'DDP.yaml'), ns=(0, 0))
+            manifest = FileManifest(manifest_file_name)
+            self.assertEqual(
+                [('M', 'Files.yaml'), ('A', 'Template.docx')],
+                list(manifest.find_changes(root_dir, ['DDP.yaml', 'Files.yaml', 'Template.docx'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+from helpers.table import Table
+import unittest
+
+
+class TableTest(unittest.TestCase):
+    @staticmethod
+    def _setup_table():
+        return Table(['Name', 'LastModifiedDate', 'Loop__DDP__c'], {
+            'a22W0000006hPKoIAM': ['Object_One__c', '2016-11-24T00:38:03.000Z', 'FE9C85E3-CA64-EC16-85C1-FE9EFAF15489'],
+            'a22W0000006hPSeIAM': ['Object_Two__c', '2016-11-24T00:36:57.000Z', 'FE9C85E3-CA64-EC16-85C1-FE9EFAF15489']
+        })
+
+    def test_column_access(self):
+        table = self._setup_table()
+        self.assertEqual(2, table.index('Loop__DDP__c'))
+        self.assertEqual(['Object_One__c', 'Object_Two__c'], table.column('Name'))
+        self.assertEqual('Object_Two__c', table.get('a22W0000006hPSeIAM', 'Name'))
+        self.assertRaises(ValueError, table.index, 'Id')
+
+    def test_repeated_values_are_interned(self):
+        table = self._setup_table()
+        parent_ids = table.column('Loop__DDP__c')
+        self.assertIs(parent_ids[0], parent_ids[1])
+
+    def test_remove_columns(self):
+        table = self._setup_table()
+        table.remove_columns(['LastModifiedDate', 'Loop__DDP__c'])
+        self.assertEqual(['Name'], table.header)
+        self.assertEqual(['Object_One__c'], table.row('a22W0000006hPKoIAM'))
+
+    def test_project_shares_columns(self):
+        table = self._setup_table()
+        projection = table.project(['Name'])
+        self.assertIs(table.column('Name'), projection.column('Name'))
+        self.assertEqual({'a22W0000006hPSeIAM': ['Object_Two__c']}, projection.select_rows(['a22W0000006hPSeIAM']).to_dict())
+
+    def test_remove_rows(self):
+        table = self._setup_table()
+        table.remove_rows(['a22W0000006hPKoIAM'])
+        self.assertEqual(['a22W0000006hPSeIAM'], table.row_ids())
+        self.assertNotIn('a22W0000006hPKoIAM', table)
+        table.set('a22W0000006hPSeIAM', 'Name', 'Object_Three__c')
+        self.assertEqual(['Object_Three__c'], table.column('Name'))
+
+
+if __name__ == '__main__':
+    unittest.main()
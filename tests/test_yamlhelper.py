@@ -0,0 +1,62 @@
+from helpers import yamlhelper
+import os
+import tempfile
+import unittest
+
+
+class LoadMultipleYamlTest(unittest.TestCase):
+    def _write_files(self, root_dir, count):
+        file_names = list()
+        for index in range(count):
+            file_name = "{0}.yaml".format(index)
+            with open(os.path.join(root_dir, file_name), 'w') as file:
+                file.write("DDP_Migrator_Id__c: GUID-{0}\nName: |-\n  Ench\\xE8res\n  {0}\n".format(index))
+            file_names.append(file_name)
+        return file_names
+
+    def test_rows_are_loaded_in_order_by_worker_processes(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            file_names = list(reversed(self._write_files(root_dir, yamlhelper._MIN_FILES_TO_PROCESS_IN_PARALLEL)))
+            table = yamlhelper.load_multiple_yaml(file_names, 'DDP_Migrator_Id__c', root_dir)
+            self.assertEqual(['DDP_Migrator_Id__c', 'Name'], table.header)
+            self.assertEqual(["GUID-{0}".format(index) for index in reversed(range(len(file_names)))], table.row_ids())
+            self.assertEqual('Ench\\xE8res\n7', table.get('GUID-7', 'Name'))
+            # Worker processes are used regardless of the number of CPUs
+            paths = [os.path.join(root_dir, file_name) for file_name in file_names]
+            self.assertEqual(yamlhelper.load_yaml_files(paths, 1), yamlhelper.load_yaml_files(paths, 2))
+
+    def test_errors_name_the_file(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            file_names = self._write_files(root_dir, 2)
+            with open(os.path.join(root_dir, file_names[1]), 'w') as file:
+                file.write("Name: [unclosed\n")
+            with self.assertRaisesRegex(Exception, '1.yaml'):
+                yamlhelper.load_multiple_yaml(file_names, 'DDP_Migrator_Id__c', root_dir)
+
+
+class SaveYamlFilesTest(unittest.TestCase):
+    def test_unchanged_files_are_not_written(self):
+        header = ['DDP_Migrator_Id__c', 'Loop__Filter__c', 'Name']
+        with tempfile.TemporaryDirectory() as root_dir:
+            first = os.path.join(root_dir, 'DDP one', 'Relationships', 'Account.yaml')
+            second = os.path.join(root_dir, 'DDP one', 'Relationships', 'Contact.yaml')
+            records = [
+                (first, header, ['GUID-1', "WHERE Id = 'a'\r\nORDER BY Name", 'Account']),
+                (second, header, ['GUID-2', '', 'Contact'])
+            ]
+            self.assertEqual(2, yamlhelper.save_yaml_files(records))
+            with open(first, 'r') as file:
+                self.assertEqual(
+                    "DDP_Migrator_Id__c: GUID-1\n"
+                    "Loop__Filter__c: |-\n  WHERE Id = 'a'\n  ORDER BY Name\n"
+                    "Name: Account\n", file.read())
+            os.utime(first, ns=(0, 0))
+
+            records[1] = (second, header, ['GUID-2', '', 'Contact Role'])
+            self.assertEqual(1, yamlhelper.save_yaml_files(records, 2))
+            self.assertEqual(0, os.stat(first).st_mtime_ns)
+            self.assertEqual('Contact Role', yamlhelper.load_one_yaml(second)['Name'])
+
+
+if __name__ == '__main__':
+    unittest.main()